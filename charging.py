@@ -0,0 +1,164 @@
+"""
+Bipolar charge distribution of the particles (charge fractions) for the inversion
+
+Fractions of the charges -2...2 are Wiedensohler's (1988) approximation of Fuchs' theory and the other charges are
+Gunn's formula. Both are evaluated once on a dense log-spaced diameter table, which is kept in a .npy file between the
+runs. Lookups interpolate the table with an index computed from the diameter, so they don't search the table.
+"""
+
+import functools
+import logging
+import os
+import typing
+
+import numpy
+
+# Wiedensohler's (1988) approximation, valid from 1 to 1000 nm. Coefficients a0...a5 of the charges -2...2,
+# log10(fraction) = sum(a_i * log10(d / nm)**i)
+WIEDENSOHLER_COEFFICIENTS = {-2: (-26.3328, 35.9044, -21.4608, 7.0867, -1.3088, 0.1051),
+                             -1: (-2.3197, 0.6175, 0.6201, -0.1105, -0.1260, 0.0297),
+                             0: (-0.0003, -0.1014, 0.3073, -0.3372, 0.1023, -0.0105),
+                             1: (-2.3484, 0.6044, 0.4800, 0.0013, -0.1553, 0.0320),
+                             2: (-44.4756, 79.3772, -62.8900, 26.4492, -5.7480, 0.5049)}
+WIEDENSOHLER_D_MAX = 1000e-9  # Gunn's formula is used for all the charges above this (m)
+
+# Gunn's formula
+ELEMENTARY_CHARGE = 1.602E-19  # Unit is C
+VACUUM_PERMITTIVITY = 8.854E-12  # Unit is F/m
+BOLTZMANN_CONSTANT = 1.381E-23  # Unit is J/K
+GAS_TEMP = 298.0  # Unit is K
+ION_MOBILITY_RATIO = 0.875  # Positive / negative ion concentration * mobility
+
+MAX_CHARGE = 6  # Tables have the charges -MAX_CHARGE...MAX_CHARGE
+
+# Table's diameters are log-spaced from 1 nm to 10 µm
+TABLE_LOG_D_RANGE = (-9.0, -5.0)  # log10(d / m)
+TABLE_POINTS = 4001
+FRACTION_MIN = 1e-300  # Fractions are kept as log10, zero is stored as this
+
+
+def approximate_fractions(particle_d_list: numpy.ndarray, charge: int) -> numpy.ndarray:
+    """
+    Return fractions of the particles carrying the charge, computed from the approximations
+    """
+
+    particle_d_list = numpy.asarray(particle_d_list, dtype=float)
+
+    # Gunn's formula
+    reduced_d = 2.0 * numpy.pi * VACUUM_PERMITTIVITY * particle_d_list * BOLTZMANN_CONSTANT * GAS_TEMP / (
+            ELEMENTARY_CHARGE ** 2)
+    fractions = ELEMENTARY_CHARGE / numpy.sqrt(
+        4.0 * numpy.pi ** 2 * VACUUM_PERMITTIVITY * particle_d_list * BOLTZMANN_CONSTANT * GAS_TEMP) * numpy.exp(
+        -(charge - reduced_d * numpy.log(ION_MOBILITY_RATIO)) ** 2 / (2.0 * reduced_d))
+
+    if charge in WIEDENSOHLER_COEFFICIENTS:
+        log_d = numpy.log10(particle_d_list * 1e9)
+        wiedensohler = 10.0 ** numpy.polynomial.polynomial.polyval(log_d, WIEDENSOHLER_COEFFICIENTS[charge])
+        fractions = numpy.where(particle_d_list <= WIEDENSOHLER_D_MAX, wiedensohler, fractions)
+
+    return fractions
+
+
+def _table_header() -> numpy.ndarray:
+    """
+    Return the parameters of the table, a saved table is rebuilt if they have changed
+    """
+
+    return numpy.array([*TABLE_LOG_D_RANGE, TABLE_POINTS, MAX_CHARGE, WIEDENSOHLER_D_MAX, GAS_TEMP,
+                        ION_MOBILITY_RATIO])
+
+
+class ChargingTable:
+    """
+    log10 of the charge fractions of the charges -MAX_CHARGE...MAX_CHARGE on the log-spaced diameters
+
+    Table is read from the file or computed and written to it. Empty file name = table is only kept in memory
+    """
+
+    def __init__(self, file_name: str = "") -> None:
+        self.__file_name = file_name
+        self.__log_d_start = TABLE_LOG_D_RANGE[0]
+        self.__log_d_step = (TABLE_LOG_D_RANGE[1] - TABLE_LOG_D_RANGE[0]) / (TABLE_POINTS - 1)
+        self.__table = self.__load()  # Row = charge + MAX_CHARGE
+
+        if self.__table is None:
+            particle_d_list = numpy.logspace(*TABLE_LOG_D_RANGE, TABLE_POINTS)
+            self.__table = numpy.log10(numpy.maximum(
+                [approximate_fractions(particle_d_list, charge) for charge in range(-MAX_CHARGE, MAX_CHARGE + 1)],
+                FRACTION_MIN))
+            self.__save()
+
+    def __load(self) -> typing.Optional[numpy.ndarray]:
+        """
+        Return the table from the file or None if there is no valid table
+        """
+
+        if not self.__file_name:
+            return None
+
+        try:
+            saved = numpy.load(self.__file_name)
+        except FileNotFoundError:
+            logging.info(f"No charging table {self.__file_name} yet")
+            return None
+        except (ValueError, OSError) as e:
+            logging.error(e)
+            logging.debug(f"Failed to read charging table {self.__file_name}")
+            return None
+
+        header = _table_header()
+        if saved.shape != (2 * MAX_CHARGE + 2, TABLE_POINTS) or not numpy.array_equal(saved[0, :len(header)], header):
+            logging.info(f"Charging table {self.__file_name} has other parameters, computing it again")
+            return None
+
+        logging.info(f"Loaded charging table from {self.__file_name}")
+        return saved[1:]
+
+    def __save(self) -> None:
+        if not self.__file_name:
+            return
+
+        # First row is the header
+        header = numpy.zeros(TABLE_POINTS)
+        header[:len(_table_header())] = _table_header()
+        # Written to a temporary file and renamed, so E.g. the inversion workers never read a partly written table
+        temp_file_name = f"{self.__file_name}.{os.getpid()}.tmp"
+        try:
+            with open(temp_file_name, "wb") as file:
+                numpy.save(file, numpy.vstack((header, self.__table)))
+            os.replace(temp_file_name, self.__file_name)
+            logging.info(f"Saved charging table to {self.__file_name}")
+        except OSError as e:
+            logging.error(e)
+            logging.debug(f"Failed to write charging table {self.__file_name}")
+
+    def fractions(self, particle_d_list: numpy.ndarray,
+                  charge: typing.Union[int, typing.Sequence[int]]) -> numpy.ndarray:
+        """
+        Return fractions of the particles carrying the charge, |charge| <= MAX_CHARGE
+
+        With a sequence of charges the shape is (charges, diameters), the diameters' positions in the table are then
+        computed only once. Table is interpolated linearly in log-log. Diameters outside the table get the fraction of
+        the nearest end
+        """
+
+        charge = numpy.asarray(charge)
+        if numpy.any(numpy.abs(charge) > MAX_CHARGE):
+            raise ValueError(f"Charging table has the charges -{MAX_CHARGE}...{MAX_CHARGE}, not {charge}")
+
+        position = (numpy.log10(particle_d_list) - self.__log_d_start) / self.__log_d_step
+        position = numpy.clip(position, 0.0, TABLE_POINTS - 1)
+        index = numpy.minimum(position.astype(numpy.int64), TABLE_POINTS - 2)
+        weight = position - index
+
+        rows = self.__table[charge + MAX_CHARGE]
+        return 10.0 ** (rows[..., index] * (1.0 - weight) + rows[..., index + 1] * weight)
+
+
+@functools.lru_cache(maxsize=None)
+def get_table(file_name: str = "") -> ChargingTable:
+    """
+    Return the charging table of the file, read or computed on the first call
+    """
+
+    return ChargingTable(file_name)
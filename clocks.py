@@ -0,0 +1,120 @@
+"""
+Clocks used by the threads and the simulated devices to read time and to wait.
+
+Clock is the normal wall clock. AcceleratedClock and VirtualClock are meant for the simulated devices: they let a
+simulated measurement run much faster than the real time, E.g. for soak tests or for profiling the program's own
+overhead without the waiting times.
+"""
+
+import heapq
+import logging
+import time
+from threading import Condition, current_thread
+from weakref import WeakSet
+
+
+class Clock:
+    """
+    Real time clock
+    """
+
+    def time(self) -> float:
+        """
+        Return seconds since the epoch (like time.time)
+        """
+
+        return time.time()
+
+    def monotonic(self) -> float:
+        """
+        Return monotonic seconds, used for measuring durations (like time.monotonic)
+        """
+
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Wait for the given amount of seconds
+        """
+
+        time.sleep(seconds)
+
+
+class AcceleratedClock(Clock):
+    """
+    Clock that runs speedup times faster than the real time
+    """
+
+    def __init__(self, speedup: float) -> None:
+        self.__speedup = speedup
+        self.__start_time = time.time()
+        self.__start_monotonic = time.monotonic()
+        logging.info(f"Created AcceleratedClock with speedup {speedup}")
+
+    def __elapsed(self) -> float:
+        return (time.monotonic() - self.__start_monotonic) * self.__speedup
+
+    def time(self) -> float:
+        return self.__start_time + self.__elapsed()
+
+    def monotonic(self) -> float:
+        return self.__start_monotonic + self.__elapsed()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(max(seconds, 0.0) / self.__speedup)
+
+
+class VirtualClock(Clock):
+    """
+    Clock whose time only advances when threads sleep on it.
+
+    When every thread that uses the clock is sleeping, the time jumps straight to the earliest wake up time.
+    If some of those threads are busy or blocked elsewhere (E.g. waiting for a lock), sleepers advance the time after
+    idle_timeout seconds of real time so the program can't get stuck
+    """
+
+    def __init__(self, idle_timeout: float = 0.005) -> None:
+        self.__time = time.time()  # Virtual time starts from the current time
+        self.__idle_timeout = idle_timeout
+        self.__condition = Condition()
+        self.__wake_times = []  # Heap of the sleeping threads' wake up times
+        self.__threads = WeakSet()  # Threads that have used this clock
+        self.__sleeping = 0  # Number of threads currently sleeping
+        logging.info("Created VirtualClock")
+
+    def time(self) -> float:
+        return self.__time
+
+    def monotonic(self) -> float:
+        return self.__time
+
+    def __advance(self) -> None:
+        """
+        Advance the time to the earliest wake up time. Condition must be held by the caller
+        """
+
+        # If a thread is due to wake up but has not run yet, the time must not advance past it
+        if self.__wake_times and self.__wake_times[0] > self.__time:
+            self.__time = self.__wake_times[0]
+            self.__condition.notify_all()
+
+    def sleep(self, seconds: float) -> None:
+        with self.__condition:
+            self.__threads.add(current_thread())
+            wake_time = self.__time + max(seconds, 0.0)
+            heapq.heappush(self.__wake_times, wake_time)
+            self.__sleeping += 1
+
+            try:
+                while self.__time < wake_time:
+                    alive_threads = sum(1 for thread in self.__threads if thread.is_alive())
+                    if self.__sleeping >= alive_threads:
+                        self.__advance()  # Everyone is sleeping
+                        if self.__time >= wake_time:
+                            break
+                    if not self.__condition.wait(self.__idle_timeout):
+                        self.__advance()  # Some thread is busy elsewhere, don't let the sleepers starve
+            finally:
+                self.__sleeping -= 1
+                self.__wake_times.remove(wake_time)
+                heapq.heapify(self.__wake_times)
@@ -40,9 +40,40 @@ class Config:
                                  "hvo_chan": self.read("NI_DAQ:Scaling", "hvo_chan"),
                                  "f_chan": self.read("NI_DAQ:Scaling", "f_chan")}
 
+        self.__ni_daq_timing = {"ai_sample_rate": self.read("NI_DAQ:Timing", "ai_sample_rate"),
+                                "ai_block_size": self.read("NI_DAQ:Timing", "ai_block_size"),
+                                "ctr_buffered": self.read("NI_DAQ:Timing", "ctr_buffered"),
+                                "ctr_sample_clock": self.read("NI_DAQ:Timing", "ctr_sample_clock"),
+                                "ctr_history_size": self.read("NI_DAQ:Timing", "ctr_history_size"),
+                                "acquisition_process": self.read("NI_DAQ:Timing", "acquisition_process"),
+                                "ai_ring_size": self.read("NI_DAQ:Timing", "ai_ring_size")}
+
         self.__pid_conf = {"frequency": self.read("Pid", "frequency"), "sample_time": self.read("Pid", "sample_time"),
                            "p": self.read("Pid", "p"), "i": self.read("Pid", "i"), "d": self.read("Pid", "d")}
 
+        self.__pid_timing_conf = {"control_rate": self.read("Pid:Timing", "control_rate"),
+                                  "rewrite_t": self.read("Pid:Timing", "rewrite_t")}
+
+        self.__pid_daq_flow_conf = {"enabled": self.read("Pid:Daq_flow", "enabled"),
+                                    "control_rate": self.read("Pid:Daq_flow", "control_rate"),
+                                    "sample_time": self.read("Pid:Daq_flow", "sample_time"),
+                                    "p": self.read("Pid:Daq_flow", "p"), "i": self.read("Pid:Daq_flow", "i"),
+                                    "d": self.read("Pid:Daq_flow", "d"),
+                                    "calibration_t": self.read("Pid:Daq_flow", "calibration_t")}
+
+        self.__pid_feed_forward_conf = {"enabled": self.read("Pid:Feed_forward", "enabled"),
+                                        "steady_tolerance": self.read("Pid:Feed_forward", "steady_tolerance"),
+                                        "steady_t": self.read("Pid:Feed_forward", "steady_t"),
+                                        "learning_rate": self.read("Pid:Feed_forward", "learning_rate"),
+                                        "integral_band": self.read("Pid:Feed_forward", "integral_band"),
+                                        "integral_hold_t": self.read("Pid:Feed_forward", "integral_hold_t"),
+                                        "table_file": self.read("Pid:Feed_forward", "table_file")}
+
+        self.__pid_gain_schedule_conf = {"flows": self.read("Pid:Gain_schedule", "flows"),
+                                         "p": self.read("Pid:Gain_schedule", "p"),
+                                         "i": self.read("Pid:Gain_schedule", "i"),
+                                         "d": self.read("Pid:Gain_schedule", "d")}
+
         self.__flow_meter_conf = {"port": self.read("Flow_Meter:Serial_port", "port"),
                                   "baudrate": self.read("Flow_Meter:Serial_port", "baudrate"),
                                   "bytesize": self.read("Flow_Meter:Serial_port", "bytesize"),
@@ -59,6 +90,11 @@ class Config:
                                      "p_multiplier": self.read("Flow_Meter:Scaling", "p_multiplier"),
                                      "p_offset": self.read("Flow_Meter:Scaling", "p_offset")}
 
+        self.__flow_meter_streaming = {"enabled": self.read("Flow_Meter:Streaming", "enabled"),
+                                       "samples": self.read("Flow_Meter:Streaming", "samples"),
+                                       "sample_interval": self.read("Flow_Meter:Streaming", "sample_interval"),
+                                       "buffer_size": self.read("Flow_Meter:Streaming", "buffer_size")}
+
         self.__cpc_conf = {"port": self.read("Cpc:Serial_port", "port"),
                            "baudrate": self.read("Cpc:Serial_port", "baudrate"),
                            "bytesize": self.read("Cpc:Serial_port", "bytesize"),
@@ -68,6 +104,14 @@ class Config:
                            "xonxoff": self.read("Cpc:Serial_port", "xonxoff"),
                            "rtscts": self.read("Cpc:Serial_port", "rtscts")}
 
+        self.__cpc_protocol_conf = {"framed_reader": self.read("Cpc:Protocol", "framed_reader"),
+                                    "quiet_gap": self.read("Cpc:Protocol", "quiet_gap"),
+                                    "poll_interval": self.read("Cpc:Protocol", "poll_interval"),
+                                    "rd_poll_interval": self.read("Cpc:Protocol", "rd_poll_interval")}
+
+        self.__serial_io_conf = {"enabled": self.read("Serial_io", "enabled"),
+                                 "poll_interval": self.read("Serial_io", "poll_interval")}
+
         self.__dma_conf = {"small_p_d_min": float(self.read("Dma", "small_p_d_min")),
                            "small_p_d_max": float(self.read("Dma", "small_p_d_max")),
                            "number_of_small_p": int(self.read("Dma", "number_of_small_p")),
@@ -84,7 +128,79 @@ class Config:
                                                                                   "between_voltages_wait_t"),
                                              "flow": self.read("Automatic_measurement", "flow"),
                                              "flow_d": self.read("Automatic_measurement", "flow_d"),
-                                             "flow_c": self.read("Automatic_measurement", "flow_c"), }
+                                             "flow_c": self.read("Automatic_measurement", "flow_c"),
+                                             "settle_min_t": self.read("Automatic_measurement", "settle_min_t"),
+                                             "settle_max_t": self.read("Automatic_measurement", "settle_max_t"),
+                                             "settle_hv_tol": self.read("Automatic_measurement", "settle_hv_tol"),
+                                             "settle_hv_abs_tol": self.read("Automatic_measurement",
+                                                                            "settle_hv_abs_tol"),
+                                             "settle_flow_tol": self.read("Automatic_measurement", "settle_flow_tol"),
+                                             "settle_samples": self.read("Automatic_measurement", "settle_samples"),
+                                             "count_target_rel_error": self.read("Automatic_measurement",
+                                                                                 "count_target_rel_error"),
+                                             "count_min_t": self.read("Automatic_measurement", "count_min_t"),
+                                             "count_check_t": self.read("Automatic_measurement", "count_check_t"), }
+
+        self.__scan_plan_conf = {"optimize_order": self.read("Scan_plan", "optimize_order"),
+                                 "flow_change_t": self.read("Scan_plan", "flow_change_t"),
+                                 "valve_change_t": self.read("Scan_plan", "valve_change_t"),
+                                 "flow_settle_tol": self.read("Scan_plan", "flow_settle_tol"),
+                                 "flow_settle_readings": self.read("Scan_plan", "flow_settle_readings"),
+                                 "flow_settle_timeout": self.read("Scan_plan", "flow_settle_timeout")}
+
+        # One dictionary per scan plan segment, the segments' sections are named Scan_plan:<segment>
+        self.__scan_segment_confs = {}
+        for section in self.get_sections("Scan_plan:"):
+            self.__scan_segment_confs[section] = {"particles": self.read(section, "particles"),
+                                                  "sheath_flow": self.read(section, "sheath_flow"),
+                                                  "conc_valve": self.read(section, "conc_valve"),
+                                                  "bypass_valve": self.read(section, "bypass_valve"),
+                                                  "dwell": self.read(section, "dwell"),
+                                                  "settle_t": self.read(section, "settle_t"),
+                                                  "pulse_count_t": self.read(section, "pulse_count_t"),
+                                                  "repeat": self.read(section, "repeat")}
+
+        self.__continuous_scan_conf = {"enabled": self.read("Continuous_scan", "enabled"),
+                                       "particles": self.read("Continuous_scan", "particles"),
+                                       "sheath_flow": self.read("Continuous_scan", "sheath_flow"),
+                                       "bypass_valve": self.read("Continuous_scan", "bypass_valve"),
+                                       "ramp_t": self.read("Continuous_scan", "ramp_t"),
+                                       "retrace_t": self.read("Continuous_scan", "retrace_t"),
+                                       "bin_t": self.read("Continuous_scan", "bin_t"),
+                                       "delay_t": self.read("Continuous_scan", "delay_t")}
+
+        self.__inversion_conf = {"enabled": self.read("Inversion", "enabled"),
+                                 "workers": self.read("Inversion", "workers"),
+                                 "queue_size": self.read("Inversion", "queue_size"),
+                                 "aerosol_flow": self.read("Inversion", "aerosol_flow"),
+                                 "polarity": self.read("Inversion", "polarity"),
+                                 "max_charge": self.read("Inversion", "max_charge"),
+                                 "charging_table_file": self.read("Inversion", "charging_table_file"),
+                                 "cpc_d50": self.read("Inversion", "cpc_d50"),
+                                 "cpc_d0": self.read("Inversion", "cpc_d0"),
+                                 "regularization": self.read("Inversion", "regularization"),
+                                 "max_iterations": self.read("Inversion", "max_iterations"),
+                                 "tolerance": self.read("Inversion", "tolerance")}
+
+        self.__simulation_conf = {"enabled": self.read("Simulation", "enabled"),
+                                  "clock_mode": self.read("Simulation", "clock_mode"),
+                                  "clock_speedup": self.read("Simulation", "clock_speedup"),
+                                  "cpc_latency": self.read("Simulation", "cpc_latency"),
+                                  "cpc_junk_lines": self.read("Simulation", "cpc_junk_lines"),
+                                  "flow_meter_latency": self.read("Simulation", "flow_meter_latency"),
+                                  "daq_latency": self.read("Simulation", "daq_latency"),
+                                  "total_conc": self.read("Simulation", "total_conc"),
+                                  "peak_voltage": self.read("Simulation", "peak_voltage"),
+                                  "peak_width": self.read("Simulation", "peak_width"),
+                                  "cpc_flow": self.read("Simulation", "cpc_flow"),
+                                  "blower_flow_gain": self.read("Simulation", "blower_flow_gain"),
+                                  "blower_time_constant": self.read("Simulation", "blower_time_constant"),
+                                  "daq_flow_gain": self.read("Simulation", "daq_flow_gain"),
+                                  "bypass_flow_factor": self.read("Simulation", "bypass_flow_factor"),
+                                  "hv_time_constant": self.read("Simulation", "hv_time_constant"),
+                                  "gas_temp": self.read("Simulation", "gas_temp"),
+                                  "gas_pressure": self.read("Simulation", "gas_pressure"),
+                                  "rh": self.read("Simulation", "rh")}
 
     def update_configuration(self, conf_dict: dict, section: str) -> None:
         """
@@ -104,21 +220,54 @@ class Config:
             return self.__ni_daq_conf
         elif conf_name == "NI_DAQ_Scaling":
             return self.__ni_daq_scaling
+        elif conf_name == "NI_DAQ_Timing":
+            return self.__ni_daq_timing
         elif conf_name == "Flow_Meter":
             return self.__flow_meter_conf
         elif conf_name == "Flow_Meter_Scaling":
             return self.__flow_meter_scaling
+        elif conf_name == "Flow_Meter_Streaming":
+            return self.__flow_meter_streaming
         elif conf_name == "Pid":
             return self.__pid_conf
+        elif conf_name == "Pid_Timing":
+            return self.__pid_timing_conf
+        elif conf_name == "Pid_Daq_flow":
+            return self.__pid_daq_flow_conf
+        elif conf_name == "Pid_Feed_forward":
+            return self.__pid_feed_forward_conf
+        elif conf_name == "Pid_Gain_schedule":
+            return self.__pid_gain_schedule_conf
         elif conf_name == "Cpc":
             return self.__cpc_conf
+        elif conf_name == "Cpc_Protocol":
+            return self.__cpc_protocol_conf
+        elif conf_name == "Serial_io":
+            return self.__serial_io_conf
         elif conf_name == "Dma":
             return self.__dma_conf
         elif conf_name == "Automatic_measurement":
             return self.__automatic_measurement_conf
+        elif conf_name == "Scan_plan":
+            return self.__scan_plan_conf
+        elif conf_name in self.__scan_segment_confs:  # Scan_plan:<segment>
+            return self.__scan_segment_confs[conf_name]
+        elif conf_name == "Continuous_scan":
+            return self.__continuous_scan_conf
+        elif conf_name == "Inversion":
+            return self.__inversion_conf
+        elif conf_name == "Simulation":
+            return self.__simulation_conf
         else:
             logging.error(f"Invalid configuration dictionary name: {conf_name}")
 
+    def get_sections(self, prefix: str = "") -> list:
+        """
+        Return names of the config.ini file's sections that start with the prefix
+        """
+
+        return [section for section in self.__config_updater.sections() if section.startswith(prefix)]
+
     def read(self, section: str, key: str) -> str:
         """
         Read a value from the config.ini file
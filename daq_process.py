@@ -0,0 +1,421 @@
+"""
+Daq's analog input and counter acquisition in a separate process
+
+The GUI (Tk and matplotlib) and the device threads share one interpreter lock, so a slow redraw can delay the reads of
+the daq's buffers. With NI_DAQ:Timing acquisition_process = 1 the buffered analog input and counter tasks run in a child
+process (python daq_process.py <ai ring> <counter ring>). The child writes the samples to shared memory ring buffers and
+the program's NiDaq reads them from there, so the rest of the program works as with the in-process acquisition.
+
+Rings have one writer (the child). Readers check the seqlock header: the writer makes the sequence number odd before it
+writes and even after it, so a reader that sees the same even number before and after reading has a consistent copy.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import time
+import typing
+from multiprocessing import resource_tracker, shared_memory
+
+import nidaqmx
+import numpy
+
+import config
+import ni_daqs
+
+# Ring header slots (int64)
+_SEQ = 0  # Seqlock sequence number, odd while the writer is writing
+_ROWS_WRITTEN = 1  # Rows written since the start
+_CAPACITY = 2  # Rows in the ring
+_WIDTH = 3  # Values per row
+_STATE = 4  # One of the STATE_* values
+_HEADER_SLOTS = 8
+
+_META_SLOTS = 8  # Float64 values written with the rows, E.g. the acquisition's start time
+
+# States of the ring's writer
+STATE_STARTING = 0
+STATE_RUNNING = 1
+STATE_STOP_REQUESTED = 2  # Set by the reader (program) to stop the child
+STATE_STOPPED = 3
+STATE_DISABLED = 4  # Writer does not write this ring, E.g. the counter is not buffered
+
+# Meta slots of the analog input ring
+_META_START_TIME = 0  # time.time() when the acquisition was started
+_META_SAMPLE_PERIOD = 1  # Time between the samples (s)
+_META_ACQUIRED = 2  # Samples per channel the daq had acquired (total_samp_per_chan_acquired)
+_META_ACQUIRED_TIME = 3  # time.time() just before the acquired samples were read
+
+ACQUIRED_INTERVAL = 0.005  # Child reads the acquired samples at least this often (s)
+
+_READ_RETRIES = 1000
+
+
+class SharedRing:
+    """
+    Ring buffer of float64 rows in shared memory with a seqlock header. One process writes, any process can read
+
+    Rows are numbered from the start, so a reader can continue from the row it read last. Use create in the process
+    that owns the memory and attach in the others
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool) -> None:
+        self.__shm = shm
+        self.__owner = owner  # Owner unlinks the memory
+        self.__header = numpy.ndarray((_HEADER_SLOTS,), dtype=numpy.int64, buffer=shm.buf)
+        self.__meta = numpy.ndarray((_META_SLOTS,), dtype=numpy.float64, buffer=shm.buf,
+                                    offset=self.__header.nbytes)
+        capacity, width = int(self.__header[_CAPACITY]), int(self.__header[_WIDTH])
+        self.__data = numpy.ndarray((capacity, width), dtype=numpy.float64, buffer=shm.buf,
+                                    offset=self.__header.nbytes + self.__meta.nbytes)
+
+    @classmethod
+    def create(cls, capacity: int, width: int) -> "SharedRing":
+        """
+        Allocate a new ring of capacity rows of width values
+        """
+
+        size = (_HEADER_SLOTS + _META_SLOTS + capacity * width) * 8
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        header = numpy.ndarray((_HEADER_SLOTS,), dtype=numpy.int64, buffer=shm.buf)
+        header[:] = 0
+        header[_CAPACITY] = capacity
+        header[_WIDTH] = width
+        del header  # Views must be released before the memory can be closed
+
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedRing":
+        """
+        Attach to a ring created by another process
+        """
+
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            # Python < 3.13 registers attached memory to this process' resource tracker, which would unlink it when
+            # this process exits
+            resource_tracker.unregister(shm._name, "shared_memory")
+
+        return cls(shm, False)
+
+    @property
+    def name(self) -> str:
+        return self.__shm.name
+
+    @property
+    def capacity(self) -> int:
+        return len(self.__data)
+
+    @property
+    def state(self) -> int:
+        return int(self.__header[_STATE])
+
+    @state.setter
+    def state(self, state: int) -> None:
+        self.__header[_STATE] = state
+
+    def write(self, rows: numpy.ndarray, meta: typing.Dict[int, float] = None) -> None:
+        """
+        Append the rows (shape is (n, width)) and set the meta slots {slot: value}. Only one process may write
+        """
+
+        rows = rows[-self.capacity:]  # Older rows would be overwritten anyway
+        written = int(self.__header[_ROWS_WRITTEN])
+        indexes = (written + numpy.arange(len(rows))) % self.capacity
+
+        self.__header[_SEQ] += 1  # Odd, readers retry
+        self.__data[indexes] = rows
+        for slot, value in (meta or {}).items():
+            self.__meta[slot] = value
+        self.__header[_ROWS_WRITTEN] = written + len(rows)
+        self.__header[_SEQ] += 1  # Even, the write is complete
+
+    def write_meta(self, meta: typing.Dict[int, float]) -> None:
+        """
+        Set the meta slots {slot: value} without rows
+        """
+
+        self.write(numpy.empty((0, self.__data.shape[1])), meta)
+
+    def view(self) -> typing.Tuple[int, numpy.ndarray]:
+        """
+        Return the sequence number and the ring's data without copying. Row i is at data[i % capacity]
+
+        Data can change at any time, check the copied values with is_valid(seq)
+        """
+
+        return int(self.__header[_SEQ]), self.__data
+
+    def is_valid(self, seq: int) -> bool:
+        """
+        Return True if the writer was not writing when view returned seq and has not written after that
+        """
+
+        return seq % 2 == 0 and int(self.__header[_SEQ]) == seq
+
+    def read(self, start: int, end: int = None) -> typing.Tuple[int, numpy.ndarray, numpy.ndarray]:
+        """
+        Return rows written so far, copies of the meta slots and the rows start...end - 1 (end None = all written).
+        Negative start counts from the latest row, E.g. -1 = the latest row
+
+        Rows that have been overwritten or are not written yet are left out
+        """
+
+        for _ in range(_READ_RETRIES):
+            seq, data = self.view()
+            written = int(self.__header[_ROWS_WRITTEN])
+            meta = self.__meta.copy()
+            first = max(start if start >= 0 else written + start, written - self.capacity, 0)
+            last = written if end is None else min(end, written)
+            rows = data[numpy.arange(first, max(last, first)) % self.capacity]  # Fancy indexing copies
+            if self.is_valid(seq):
+                return written, meta, rows
+            time.sleep(0)  # Give the writer time to finish
+
+        raise RuntimeError(f"Ring {self.name} was written during every read attempt")
+
+    def close(self) -> None:
+        """
+        Release the memory. Owner also unlinks it
+        """
+
+        del self.__header, self.__meta, self.__data
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+
+
+class AcquisitionProcess:
+    """
+    Starts the acquisition process and reads its rings. Given to ni_daqs.NiDaq, which then leaves the analog input and
+    the buffered counter tasks to the child process
+
+    The analog input ring has one row per sample (columns are the channels). The counter ring has one row per sample
+    clock interval: the interval's counts and the total counts since the start
+    """
+
+    def __init__(self, conf: config.Config) -> None:
+        self.__nidaq_conf = conf.get_configuration("NI_DAQ")
+        self.__timing_conf = conf.get_configuration("NI_DAQ_Timing")
+
+        channels = int(self.__nidaq_conf.get("ai_max")) - int(self.__nidaq_conf.get("ai_min")) + 1
+        self.__ai_ring = SharedRing.create(int(self.__timing_conf.get("ai_ring_size")), channels)
+        self.__ctr_ring = SharedRing.create(int(self.__timing_conf.get("ctr_history_size")), 2)
+        self.__process = None
+
+        self.__ai_samples_read = 0  # Next analog input row to read
+        self.__ctr_samples_read = 0  # Next counter row given by read_ctr_block
+
+        logging.info("Created AcquisitionProcess")
+
+    def start(self, timeout: float = 10.0) -> bool:
+        """
+        Start the child process and wait until it acquires. Return False if it did not start in timeout (s)
+        """
+
+        script = os.path.abspath(__file__)
+        self.__process = subprocess.Popen([sys.executable, script, self.__ai_ring.name, self.__ctr_ring.name])
+
+        deadline = time.monotonic() + timeout
+        while self.__ai_ring.state == STATE_STARTING:
+            if self.__process.poll() is not None or time.monotonic() > deadline:
+                logging.error("Daq acquisition process did not start")
+                self.stop()
+                return False
+            time.sleep(0.05)
+
+        if self.__ai_ring.state != STATE_RUNNING:  # E.g. the analog inputs are not buffered
+            logging.error("Daq acquisition process stopped while starting")
+            self.stop()
+            return False
+
+        logging.info(f"Started daq acquisition process (pid {self.__process.pid})")
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stop the child process and release the rings
+        """
+
+        if self.__process is not None:
+            self.__ai_ring.state = STATE_STOP_REQUESTED
+            try:
+                self.__process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logging.error("Daq acquisition process did not stop, killing it")
+                self.__process.kill()
+                self.__process.wait()
+            self.__process = None
+            logging.info("Stopped daq acquisition process")
+
+        self.__ai_ring.close()
+        self.__ctr_ring.close()
+
+    def __running(self) -> bool:
+        return self.__process is not None and self.__process.poll() is None and self.__ai_ring.state == STATE_RUNNING
+
+    def ai_samples_available(self) -> int:
+        """
+        Return number of analog input samples per channel that have not been read
+        """
+
+        written, _, _ = self.__ai_ring.read(0, 0)
+        return written - self.__ai_samples_read
+
+    def read_ai_block(self) -> typing.Optional[ni_daqs.AiBlock]:
+        """
+        Read the next block of analog input samples. Waits until the whole block is measured
+
+        Return None if the child process has stopped
+        """
+
+        block_size = int(self.__timing_conf.get("ai_block_size"))
+        while self.ai_samples_available() < block_size:
+            if not self.__running():
+                logging.error("Daq acquisition process is not running")
+                return None
+            time.sleep(0.001)
+
+        try:
+            written, meta, rows = self.__ai_ring.read(self.__ai_samples_read, self.__ai_samples_read + block_size)
+        except RuntimeError as e:  # The child died while writing
+            logging.error(e)
+            logging.debug("Failed to read the ai ring")
+            return None
+
+        first = max(self.__ai_samples_read, written - self.__ai_ring.capacity)
+        if first > self.__ai_samples_read:
+            logging.warning(f"Lost {first - self.__ai_samples_read} ai samples, ring buffer was overwritten")
+        self.__ai_samples_read = first + len(rows)
+
+        sample_period = meta[_META_SAMPLE_PERIOD]
+        start_time = meta[_META_START_TIME] + first * sample_period
+        return ni_daqs.AiBlock(start_time, sample_period, rows.T.copy())
+
+    def ai_samples_acquired(self, read_after: float = 0.0, timeout: float = 1.0) -> int:
+        """
+        Return number of analog input samples the daq had acquired when the child read the count. Used as the start of
+        the analog output waveforms, which are clocked by the same sample clock
+
+        Child reads the count every ACQUIRED_INTERVAL, so it can be that old. read_after (time.time()) waits until the
+        child has read the count after that time, so the count is not older than read_after
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            _, meta, _ = self.__ai_ring.read(0, 0)
+            if meta[_META_ACQUIRED_TIME] >= read_after:
+                return int(meta[_META_ACQUIRED])
+            if not self.__running() or time.monotonic() > deadline:
+                logging.warning("Daq acquisition process did not update the acquired ai samples in time")
+                return int(meta[_META_ACQUIRED])
+            time.sleep(ACQUIRED_INTERVAL / 5)
+
+    def ctr_buffered(self) -> bool:
+        """
+        Return True if the child process acquires the buffered counter
+        """
+
+        return self.__running() and self.__ctr_ring.state == STATE_RUNNING
+
+    def read_ctr_block(self) -> numpy.ndarray:
+        """
+        Return counts per sample clock interval that have arrived since the previous call. The child keeps the history
+        """
+
+        written, _, rows = self.__ctr_ring.read(self.__ctr_samples_read)
+        self.__ctr_samples_read = written
+        return rows[:, 0].astype(numpy.int64)
+
+    def get_ctr_position(self) -> typing.Tuple[int, int]:
+        """
+        Return number of sample clock ticks and total counts since the start of the buffered counter
+        """
+
+        written, _, rows = self.__ctr_ring.read(-1)
+        total = int(rows[-1, 1]) if len(rows) > 0 else 0
+        return written, total
+
+    def get_ctr_interval_counts(self, start_sample: int, end_sample: int) -> numpy.ndarray:
+        """
+        Return counts of each sample clock interval from start_sample to end_sample (exclusive). Intervals that are not
+        in the ring anymore or are not measured yet are left out
+        """
+
+        _, _, rows = self.__ctr_ring.read(start_sample, end_sample)
+        return rows[:, 0].astype(numpy.int64)
+
+
+def main(ai_ring_name: str, ctr_ring_name: str) -> None:
+    """
+    Acquisition loop of the child process. Reads the daq's buffers and writes them to the rings until the program
+    requests a stop
+    """
+
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s",
+                        datefmt="%d.%m.%Y %H:%M:%S", filename="debug/daq_process.log", filemode="w")
+
+    conf = config.Config()
+    timing_conf = conf.get_configuration("NI_DAQ_Timing")
+    rate = float(timing_conf.get("ai_sample_rate"))
+    block_size = int(timing_conf.get("ai_block_size"))
+
+    ai_ring = SharedRing.attach(ai_ring_name)
+    ctr_ring = SharedRing.attach(ctr_ring_name)
+
+    # Only the acquisition tasks, the program has the output tasks
+    daq = ni_daqs.NiDaq(conf, output_tasks=False)
+    if not daq.ai_buffered():
+        logging.error("Acquisition process requires buffered analog inputs (ai_sample_rate > 0)")
+        ai_ring.state = STATE_STOPPED
+        daq.close_tasks()
+        return
+
+    ai_ring.write_meta({_META_START_TIME: time.time(), _META_SAMPLE_PERIOD: 1.0 / rate})
+    ctr_ring.state = STATE_RUNNING if daq.ctr_buffered() else STATE_DISABLED
+    ai_ring.state = STATE_RUNNING
+    logging.info("Started acquisition loop")
+
+    samples = 0  # Samples per channel written to the ai ring
+
+    while ai_ring.state != STATE_STOP_REQUESTED:
+        # Program reads this count when it starts an analog output waveform, so it is kept fresh between the blocks
+        acquired_time = time.time()
+        try:
+            ai_ring.write_meta({_META_ACQUIRED: daq.ai_samples_acquired(), _META_ACQUIRED_TIME: acquired_time})
+        except nidaqmx.DaqError as e:
+            logging.error(e)
+            logging.debug("Failed to read acquired ai samples")
+
+        missing = block_size - daq.ai_samples_available()
+        if missing > 0:
+            time.sleep(min(missing / rate, ACQUIRED_INTERVAL))
+            continue
+
+        block = daq.read_ai_block()
+        if block is None:
+            time.sleep(block_size / rate)  # Don't spin if the read fails
+            continue
+        # Blocks are timestamped from the start of the daq's acquisition
+        ai_ring.write(block.voltages.T, {_META_START_TIME: block.start_time - samples * block.sample_period})
+        samples += block.voltages.shape[1]
+
+        if daq.ctr_buffered():
+            interval_counts = daq.read_ctr_block()  # Same sample clock, so the counter's block is ready too
+            if interval_counts is not None:
+                _, total = daq.get_ctr_position()
+                totals = total - interval_counts.sum() + numpy.cumsum(interval_counts)
+                ctr_ring.write(numpy.column_stack((interval_counts, totals)))
+
+    daq.close_tasks()
+    ai_ring.state = STATE_STOPPED
+    ctr_ring.state = STATE_STOPPED
+    ai_ring.close()
+    ctr_ring.close()
+    logging.info("Stopped acquisition loop")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
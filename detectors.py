@@ -4,10 +4,19 @@ Currently it only works with CPC detectors that can use legacy commands
 """
 
 import logging
+import typing
 
 import serial
 
+import clocks
 import config
+import mailboxes
+import serial_io
+import timing_stats
+
+# Framing of the legacy commands' replies, used with the serial I/O engine
+RD_FRAME = serial_io.Frame(b"\r", 1)
+RALL_FRAME = serial_io.Frame(b"\r", 1)
 
 
 class CpcLegacy:
@@ -17,10 +26,22 @@ class CpcLegacy:
     This class uses TSI legacy commands that are used with a serial port connection
     """
 
-    def __init__(self, conf: config.Config) -> None:
-        self.__ser_connection = serial.Serial()  # Serial connection object
+    def __init__(self, conf: config.Config, ser_connection: serial.Serial = None, clock: clocks.Clock = None,
+                 io_engine: serial_io.SerialIoEngine = None, name: str = "cpc") -> None:
+        # Serial connection object. E.g. simulation.SimulatedCpcSerial can be given instead of the real serial port
+        self.__ser_connection = serial.Serial() if ser_connection is None else ser_connection
+        # If the engine is given, commands are executed by it instead of reading and writing the port here
+        self.__io_engine = io_engine
+        self.__name = name  # Device name in the engine
+        self.__rd_polling = None  # (rd mailbox, interval) if RD is polled by the engine
         self.__conf = conf
         self.__configuration = self.__conf.get_configuration("Cpc")  # Dict containing serial settings
+        self.__protocol_conf = self.__conf.get_configuration("Cpc_Protocol")
+        self.__clock = clock if clock is not None else clocks.Clock()  # Used for timing the replies
+        # Queue wait ("<command> wait") and round-trip time ("<command> rtt") of each command
+        self.__latency_stats = timing_stats.LatencyStats("Cpc")
+        # Serializes the commands of the threads in the order of priority when the engine is not used
+        self.__command_lock = serial_io.PriorityLock()
 
         self.__set_serial_settings()  # Set serial settings and open the connection
         logging.info("Created a CpcLegacy object")
@@ -30,6 +51,9 @@ class CpcLegacy:
         Close the serial connection
         """
 
+        if self.__io_engine is not None:
+            self.__io_engine.remove_device(self.__name)
+
         if self.__ser_connection.isOpen():
             self.__ser_connection.close()
             logging.info("Closed the Cpc's serial connection")
@@ -62,10 +86,117 @@ class CpcLegacy:
         try:
             self.__ser_connection.open()
             logging.info("Set serial settings and opened connection to the cpc")
+            if self.__io_engine is not None:
+                self.__io_engine.add_device(self.__name, self.__ser_connection, self.__latency_stats)
+                if self.__rd_polling is not None:  # Periodic commands are removed with the device
+                    self.__add_rd_polling(*self.__rd_polling)
         except serial.SerialException as e:
             logging.error(e)
             logging.debug("Cpc's serial port settings are probably set wrong")
 
+    def get_latency_stats(self) -> timing_stats.LatencyStats:
+        """
+        Return latency statistics of the commands
+        """
+
+        return self.__latency_stats
+
+    def __drain_reply(self) -> None:
+        """
+        Read and discard the rest of the reply
+
+        With the framed reader the reply is complete when no bytes have arrived for quiet_gap seconds, but at most the
+        serial timeout is waited. Otherwise lines are read until the read times out
+        """
+
+        if self.__protocol_conf.get("framed_reader") != "1":
+            # I tried to flush the buffer but with flush junk lines were not removed
+            # Also read_all command did not solve this problem
+            junk_line = self.__ser_connection.read_until("\r".encode("UTF-8"))
+            while len(junk_line) != 0:
+                junk_line = self.__ser_connection.read_until("\r".encode("UTF-8"))
+            return
+
+        quiet_gap = float(self.__protocol_conf.get("quiet_gap"))
+        poll_interval = float(self.__protocol_conf.get("poll_interval"))
+        start_time = last_byte_time = self.__clock.monotonic()
+        timeout = self.__ser_connection.timeout
+
+        while self.__clock.monotonic() - last_byte_time < quiet_gap:
+            if timeout is not None and self.__clock.monotonic() - start_time >= timeout:
+                logging.debug("Cpc's reply did not end before the timeout")
+                break
+            waiting = self.__ser_connection.in_waiting
+            if waiting > 0:
+                self.__ser_connection.read(waiting)
+                last_byte_time = self.__clock.monotonic()
+            else:
+                self.__clock.sleep(poll_interval)
+
+    def __d_frame(self) -> serial_io.Frame:
+        """
+        Return framing of the D command's reply: time and counts lines followed by the junk lines
+        """
+
+        if self.__protocol_conf.get("framed_reader") != "1":
+            return serial_io.Frame(b"\r", 2, float(self.__ser_connection.timeout))
+        return serial_io.Frame(b"\r", 2, float(self.__protocol_conf.get("quiet_gap")))
+
+    def __query(self, command: str, frame: serial_io.Frame,
+                priority: int = serial_io.PRIORITY_NORMAL) -> typing.List[bytes]:
+        """
+        Write the command and read its reply. Return frame.lines lines of the reply, missing lines are empty
+
+        Commands waiting for the port are executed in the order of priority. The command's queue wait and round-trip
+        time are recorded to the latency stats (by the engine if it is used)
+        """
+
+        if self.__io_engine is not None:
+            reply = self.__io_engine.request(self.__name, command.encode("UTF-8"), frame, priority)
+            lines = [line + frame.terminator for line in reply.split(frame.terminator)][:frame.lines]
+            return lines + [b""] * (frame.lines - len(lines))
+
+        submit_time = self.__clock.monotonic()
+        self.__command_lock.acquire(priority)
+        start_time = self.__clock.monotonic()
+        try:
+            self.__ser_connection.write(command.encode("UTF-8"))
+            lines = [self.__ser_connection.read_until(frame.terminator) for _ in range(frame.lines)]
+            if frame.quiet_gap > 0.0:
+                self.__drain_reply()  # Read all the remaining junk lines in the buffer
+        finally:
+            self.__command_lock.release()
+
+        operation = command.strip()
+        self.__latency_stats.add(f"{operation} wait", start_time - submit_time)
+        self.__latency_stats.add(f"{operation} rtt", self.__clock.monotonic() - start_time)
+
+        return lines
+
+    def start_rd_polling(self, rd: mailboxes.LatestValue, interval: float) -> bool:
+        """
+        Read RD every interval (s) with the serial I/O engine and put the values to the mailbox
+        Replaces threads.detector_thead.DetectorThead
+
+        Return False if the engine is not in use
+        """
+
+        if self.__io_engine is None:
+            return False
+
+        self.__rd_polling = (rd, interval)
+        if self.__ser_connection.isOpen():
+            self.__add_rd_polling(rd, interval)
+        return True
+
+    def __add_rd_polling(self, rd: mailboxes.LatestValue, interval: float) -> None:
+        def put_rd(reply: bytes) -> None:
+            rd.put(self.__parse_rd(reply.split(RD_FRAME.terminator)[0]))  # Empty reply gives None like read_rd
+
+        self.__io_engine.add_periodic(self.__name, "RD\r".encode("UTF-8"), RD_FRAME, interval, put_rd,
+                                      serial_io.PRIORITY_BACKGROUND)
+        logging.info(f"Started polling cpc's RD every {interval} s")
+
     def update_settings(self) -> None:
         """
         Update serial settings
@@ -73,54 +204,70 @@ class CpcLegacy:
 
         # Update the conf dict
         self.__conf.update_configuration(self.__configuration, "Cpc:Serial_port")
-        self.__set_serial_settings()  # Restart ser connection with the new settings
+        self.__conf.update_configuration(self.__protocol_conf, "Cpc:Protocol")
 
-    def read_rd(self) -> float:
+        # Wait for the command in progress before restarting the connection
+        self.__command_lock.acquire(serial_io.PRIORITY_HIGH)
+        try:
+            self.__set_serial_settings()  # Restart ser connection with the new settings
+        finally:
+            self.__command_lock.release()
+
+    def __parse_rd(self, conc_line: bytes) -> float:
         """
-        Return 1s average concentration in p/cm^3
+        Return concentration from RD command's reply line
         """
 
         rd = None  # Ensure that rd is defined
+        encoding = "UTF-8"
 
-        if self.__ser_connection.isOpen():
-            encoding = "UTF-8"
-            carriage_return = "\r".encode(encoding)  # Str to UTF-8
-            str_out = "RD\r".encode(encoding)
+        # Try to decode the line and handle event if it can't be decoded
+        try:
+            conc_line = conc_line.decode(encoding)  # UTF-8 to str
+            conc_line = conc_line.strip()  # Remove any possible whitespace
+        except Exception as e:
+            logging.error(e)
+            logging.debug(f"Can't decode line: {conc_line}")
+            conc_line = None
 
-            # Request 1s average of the concentration
-            self.__ser_connection.write(str_out)
-            # Read the line
-            conc_line = self.__ser_connection.read_until(
-                carriage_return)  # Read until \r is encountered
+        # Try to convert line to float and handle event if it can't be converted
+        try:
+            rd = float(conc_line)  # Convert to float
+        except (ValueError, TypeError) as e:
+            logging.error(e)
+            logging.debug("Read_rd method returned invalid value")
+            logging.debug("Double check Cpc's serial port settings")
 
-            # Try to decode the line and handle event if it can't be decoded
-            try:
-                conc_line = conc_line.decode(encoding)  # UTF-8 to str
-                conc_line = conc_line.strip()  # Remove any possible whitespace
-            except Exception as e:
-                logging.error(e)
-                logging.debug(f"Can't decode line: {conc_line}")
-                conc_line = None
+        return rd
 
-            # Try to convert line to float and handle event if it can't be converted
-            try:
-                rd = float(conc_line)  # Convert to float
-            except ValueError as e:
-                logging.error(e)
-                logging.debug("Read_rd method returned invalid value")
-                logging.debug("Double check Cpc's serial port settings")
+    def read_rd(self, priority: int = serial_io.PRIORITY_NORMAL) -> float:
+        """
+        Return 1s average concentration in p/cm^3
+
+        Polling threads should use serial_io.PRIORITY_BACKGROUND so that the measurement's commands go first
+        """
+
+        rd = None  # Ensure that rd is defined
+
+        if self.__ser_connection.isOpen():
+            # Request 1s average of the concentration and read the line
+            conc_line = self.__query("RD\r", RD_FRAME, priority)[0]
+            rd = self.__parse_rd(conc_line)
         else:
             logging.debug("Can't read from the cpc because the serial connection is closed")
 
         return rd
 
-    def read_d(self) -> float:
+    def read_d(self, priority: int = serial_io.PRIORITY_HIGH) -> float:
         """
         Read dead accumulative time (s) and accumulative counts since last time this method was used
         In other words used to get Cpc's counts and time counted since last time this method was used
 
         After reading two useful lines outputted by this command (time and counts) there is still a bunch of
-        junk lines ("0,0") left to be read and that must be handled in order for the dmps program to work
+        junk lines ("0,0") left to be read and that must be handled in order for the dmps program to work.
+        The number of junk lines is not known, so the reply ends when no more bytes arrive (see __drain_reply)
+
+        D marks the start and the end of a count window, so by default it goes before the other queued commands
 
         Return counts per second
         """
@@ -131,15 +278,11 @@ class CpcLegacy:
 
         if self.__ser_connection.isOpen():
             encoding = "UTF-8"
-            carriage_return = "\r".encode(encoding)  # Str to UTF-8
-            str_out = "D\r".encode(encoding)
 
-            # Request accumulative time and counts
-            self.__ser_connection.write(str_out)
+            # Request accumulative time and counts. Junk lines after them are read and discarded
+            time_line, counts_line = self.__query("D\r", self.__d_frame(), priority)
 
             # Get time
-            time_line = self.__ser_connection.read_until(
-                carriage_return)  # Read until \r is encountered
 
             # Try to decode the line and handle event if it can't be decoded
             try:
@@ -158,8 +301,6 @@ class CpcLegacy:
 
             # Get counts
             # Returns line with 'counts, 0' I'm not sure what the zero stands for
-            counts_line = self.__ser_connection.read_until(
-                carriage_return)
 
             # Try to decode the line and handle event if it can't be decoded
             try:
@@ -179,15 +320,6 @@ class CpcLegacy:
                 logging.error(e)
                 logging.debug("read_d method tried to return invalid out value")
 
-            # Read all the remaining junk lines in the buffer
-            # I tried to flush the buffer but with flush junk lines were not removed
-            # Also read_all command did not solve this problem
-            # TODO: Find a better way to handle this
-            junk_line = self.__ser_connection.read_until(
-                carriage_return)
-            while len(junk_line) != 0:
-                junk_line = self.__ser_connection.read_until(
-                    carriage_return)
         else:
             logging.debug("Can't read from the cpc because the serial connection is closed")
 
@@ -207,14 +339,9 @@ class CpcLegacy:
 
         if self.__ser_connection.isOpen():
             encoding = "UTF-8"
-            carriage_return = "\r".encode(encoding)  # Str to UTF-8
-            str_out = "RALL\r".encode(encoding)
-
-            # Request the data
-            self.__ser_connection.write(str_out)
-            # Read the data
-            data = self.__ser_connection.read_until(
-                carriage_return)  # Read until \r is encountered
+
+            # Request and read the data
+            data = self.__query("RALL\r", RALL_FRAME)[0]
 
             # Try to decode the line and handle event if it can't be decoded
             try:
@@ -0,0 +1,331 @@
+"""
+Physics of the DMA: particle diameters, electrical mobilities and the DMA voltages
+
+Used by the measurement threads. Gas pressure is given in kPa and gas temperature in °C like the flow meter outputs
+them.
+
+The gas state functions work on numpy arrays too. gen_dma_voltages_list caches its results with the gas temperature,
+pressure and sheath flow rounded to TEMP_QUANTUM, PRESSURE_QUANTUM and FLOW_QUANTUM, so the measurement cycle doesn't
+recompute the same lists. batch_dma_voltages evaluates many gas states at once, E.g. when a long measurement is
+reprocessed. gen_p_diameters_list is the inverse, it solves the diameters of measured voltages with Halley's method.
+"""
+
+import functools
+import typing
+
+import numpy
+
+
+GAS_TEMP_0 = 293.0  # Unit is K
+ELEMENTARY_CHARGE = 1.602E-19  # Unit is C
+
+# Resolution of the cache keys. Rounding changes the voltages less than 1e-4 relative
+TEMP_QUANTUM = 0.01  # Unit is °C
+PRESSURE_QUANTUM = 0.01  # Unit is kPa
+FLOW_QUANTUM = 0.001  # Unit is L/min
+CACHE_SIZE = 256  # Voltage lists kept in the cache
+
+# Cunningham correction Cc = 1 + 2 * mfp / d * (A + B * exp(-C * d / 2 / mfp))
+CUNNINGHAM_A = 1.165
+CUNNINGHAM_B = 0.483
+CUNNINGHAM_C = 0.997
+
+# Inverse solver of the diameter, see gen_p_diameters_list
+GUESS_TABLE_RANGE = (1e-6, 1e6)  # Range of the slip-free diameter / 2 / mfp in the initial guess table
+GUESS_TABLE_SIZE = 512
+SOLVER_MAX_ITERATIONS = 10
+SOLVER_TOLERANCE = 1e-12  # Relative step of the diameter that ends the iteration
+
+ArrayLike = typing.Union[float, typing.Sequence[float], numpy.ndarray]
+
+
+class DmaGeometry(typing.NamedTuple):
+    """
+    Dimensions of the DMA (m)
+    """
+
+    length: float
+    in_electrode_r: float
+    out_electrode_r: float
+
+
+def dma_geometry(dma_conf: dict) -> DmaGeometry:
+    """
+    Return the DMA's dimensions from the Dma section
+    """
+
+    return DmaGeometry(float(dma_conf.get("length")), float(dma_conf.get("in_electrode_r")),
+                       float(dma_conf.get("out_electrode_r")))
+
+
+def calc_p_mean_free_path(gas_pressure: ArrayLike, gas_temp: ArrayLike) -> ArrayLike:
+    """
+    Return particle's mean free path at gas_temp_0 and 1013.25 hPa
+    """
+
+    mean_free_path_0 = 67.3e-9  # Unit is m
+    gas_pressure_0 = 101325.0
+    gas_pressure = numpy.asarray(gas_pressure, dtype=float) * 1000.0  # kPa to Pa
+    gas_temp = numpy.asarray(gas_temp, dtype=float) + 273.15  # °C to K
+
+    particle_mean_free_path = mean_free_path_0 * ((gas_temp / GAS_TEMP_0) ** 2.0) * (
+            gas_pressure_0 / gas_pressure) * ((GAS_TEMP_0 + 110.4) / (gas_temp + 110.4))
+
+    return particle_mean_free_path
+
+
+def gen_cunningham_corrected_list(p_mean_free_path: float, p_d_list: list) -> list:
+    """
+    Generates list of particle diameters with cunningham correction
+    """
+
+    p_cunn_corr_list = 1.0 + numpy.divide(2.0 * p_mean_free_path, p_d_list) * (
+            CUNNINGHAM_A + CUNNINGHAM_B * numpy.exp(-CUNNINGHAM_C * numpy.divide(p_d_list, 2.0 * p_mean_free_path)))
+
+    return p_cunn_corr_list
+
+
+def calc_dyn_gas_visc(gas_temp: ArrayLike) -> ArrayLike:
+    """
+    Return dynamic gas viscosity at gas_temp_0 and 1013.25 hPa
+    """
+
+    n0 = 1.83245e-5  # Unit is kg/ms
+    gas_temp = numpy.asarray(gas_temp, dtype=float) + 273.15  # Convert °C to K
+
+    dynamic_gas_visc = n0 * ((gas_temp / GAS_TEMP_0) ** (3.0 / 2.0)) * ((GAS_TEMP_0 + 110.4) / (gas_temp + 110.4))
+
+    return dynamic_gas_visc
+
+
+def gen_p_mobility_list(particle_cunningham_correction: list, dynamic_gas_visc: float,
+                        particle_diameters_list: list) -> list:
+    """
+    Return list of particle motion values
+    """
+
+    particle_mobility_list = numpy.divide(numpy.multiply(ELEMENTARY_CHARGE, particle_cunningham_correction),
+                                          numpy.multiply(3.0 * numpy.pi * dynamic_gas_visc, particle_diameters_list))
+
+    return particle_mobility_list
+
+
+def _dma_constant(geometry: DmaGeometry, dma_sheath_flow: ArrayLike) -> ArrayLike:
+    """
+    Return voltage * mobility of the DMA's center mobility at the sheath flow (L/min)
+    """
+
+    # Convert to m**3/s
+    dma_sheath_flow = numpy.asarray(dma_sheath_flow, dtype=float) / 1000.0 / 60.0
+
+    return dma_sheath_flow / 2.0 / numpy.pi / geometry.length * numpy.log(geometry.out_electrode_r /
+                                                                          geometry.in_electrode_r)
+
+
+def calc_dma_center_mobility(geometry: DmaGeometry, dma_sheath_flow: ArrayLike,
+                             dma_voltages_list: ArrayLike) -> numpy.ndarray:
+    """
+    Return electrical mobilities (m**2/Vs) at the center of the DMA's transfer function at the voltages
+    """
+
+    with numpy.errstate(divide="ignore"):
+        return numpy.divide(_dma_constant(geometry, dma_sheath_flow), numpy.asarray(dma_voltages_list, dtype=float))
+
+
+def _dma_voltages(geometry: DmaGeometry, dma_sheath_flow: ArrayLike, gas_pressure: ArrayLike, gas_temp: ArrayLike,
+                  particle_d_list: numpy.ndarray) -> numpy.ndarray:
+    """
+    Return dma voltages of the diameters. Gas states are broadcast against each other and the diameters are the last
+    axis of the result
+    """
+
+    # Gas states get an axis for the diameters
+    dma_sheath_flow, gas_pressure, gas_temp = (numpy.asarray(value, dtype=float)[..., numpy.newaxis]
+                                               for value in (dma_sheath_flow, gas_pressure, gas_temp))
+
+    particle_mean_free_path = calc_p_mean_free_path(gas_pressure, gas_temp)
+    cunningham_correction_list = gen_cunningham_corrected_list(particle_mean_free_path, particle_d_list)
+    dynamic_gas_viscosity = calc_dyn_gas_visc(gas_temp)
+    particle_mobility_list = gen_p_mobility_list(cunningham_correction_list, dynamic_gas_viscosity, particle_d_list)
+
+    return numpy.divide(_dma_constant(geometry, dma_sheath_flow), particle_mobility_list)
+
+
+def _quantize(value: ArrayLike, quantum: float) -> ArrayLike:
+    """
+    Return value as a count of quanta, integers are exact cache keys
+    """
+
+    return numpy.rint(numpy.asarray(value, dtype=float) / quantum).astype(numpy.int64)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached_dma_voltages(geometry: DmaGeometry, flow_key: int, pressure_key: int, temp_key: int,
+                         particle_d_key: bytes) -> numpy.ndarray:
+    voltages = _dma_voltages(geometry, flow_key * FLOW_QUANTUM, pressure_key * PRESSURE_QUANTUM,
+                             temp_key * TEMP_QUANTUM, numpy.frombuffer(particle_d_key))
+    voltages.flags.writeable = False  # Shared by the callers
+    return voltages
+
+
+def gen_dma_voltages_list(dma_conf: dict, dma_sheath_flow: float, flow_meter_pressure: float,
+                          flow_meter_temp: float, particle_d_list: list) -> numpy.ndarray:
+    """
+    Return list of dma voltages corresponding to desired particle diameters
+
+    Lists are cached with the rounded gas state, see TEMP_QUANTUM, PRESSURE_QUANTUM and FLOW_QUANTUM
+    """
+
+    particle_d_list = numpy.ascontiguousarray(particle_d_list, dtype=float)
+    voltages = _cached_dma_voltages(dma_geometry(dma_conf), round(dma_sheath_flow / FLOW_QUANTUM),
+                                    round(flow_meter_pressure / PRESSURE_QUANTUM),
+                                    round(flow_meter_temp / TEMP_QUANTUM), particle_d_list.tobytes())
+
+    return voltages.copy()
+
+
+def group_gas_states(dma_sheath_flow: ArrayLike, gas_pressure: ArrayLike,
+                     gas_temp: ArrayLike) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Round the gas states like the cache keys and find the distinct ones
+
+    Sheath flows, pressures and temperatures are broadcast against each other. Return the distinct rounded states as
+    rows of (flow, pressure, temp) and the index of each state's row, shaped like the broadcast states
+    """
+
+    flow_keys, pressure_keys, temp_keys = numpy.broadcast_arrays(_quantize(dma_sheath_flow, FLOW_QUANTUM),
+                                                                 _quantize(gas_pressure, PRESSURE_QUANTUM),
+                                                                 _quantize(gas_temp, TEMP_QUANTUM))
+    keys = numpy.stack((flow_keys.ravel(), pressure_keys.ravel(), temp_keys.ravel()))
+
+    # Distinct states are found from the keys packed into one integer, sorting rows of three would be much slower
+    min_keys = keys.min(axis=1, keepdims=True)
+    dims = tuple(keys.max(axis=1) - min_keys[:, 0] + 1)
+    unique_packed, inverse = numpy.unique(numpy.ravel_multi_index(keys - min_keys, dims), return_inverse=True)
+    unique_keys = numpy.array(numpy.unravel_index(unique_packed, dims)) + min_keys
+    states = unique_keys.T * numpy.array([FLOW_QUANTUM, PRESSURE_QUANTUM, TEMP_QUANTUM])
+
+    return states, inverse.reshape(flow_keys.shape)
+
+
+def batch_dma_voltages(dma_conf: dict, dma_sheath_flow: ArrayLike, flow_meter_pressure: ArrayLike,
+                       flow_meter_temp: ArrayLike, particle_d_list: list) -> numpy.ndarray:
+    """
+    Return dma voltages of the diameters for many gas states, shape is (gas states, diameters)
+
+    Sheath flows, pressures and temperatures are broadcast against each other, so E.g. one flow can be given with
+    arrays of pressures and temperatures. Gas states are rounded like in gen_dma_voltages_list and each distinct
+    rounded state is computed once
+    """
+
+    states, inverse = group_gas_states(dma_sheath_flow, flow_meter_pressure, flow_meter_temp)
+    voltages = _dma_voltages(dma_geometry(dma_conf), states[:, 0], states[:, 1], states[:, 2],
+                             numpy.asarray(particle_d_list, dtype=float))
+
+    return voltages[inverse]
+
+
+def cache_info() -> typing.NamedTuple:
+    """
+    Return hits, misses and size of the voltage list cache
+    """
+
+    return _cached_dma_voltages.cache_info()
+
+
+def _halley_steps(x0: numpy.ndarray, x: numpy.ndarray, max_iterations: int) -> numpy.ndarray:
+    """
+    Refine x, the root of g(x) = x**2 - x0 * x - x0 * (A + B * exp(-C * x)), with Halley's method
+
+    x = d / 2 / mfp and x0 is the same for the slip-free diameter, so g(x) = 0 is d = d_no_slip * Cc(d) multiplied by
+    x. g is convex near the root and has one positive root
+    """
+
+    for _ in range(max_iterations):
+        b_exp = x0 * CUNNINGHAM_B * numpy.exp(-CUNNINGHAM_C * x)
+        g = x * x - x0 * x - x0 * CUNNINGHAM_A - b_exp
+        g_1 = 2.0 * x - x0 + CUNNINGHAM_C * b_exp
+        g_2 = 2.0 - CUNNINGHAM_C * CUNNINGHAM_C * b_exp
+        step = 2.0 * g * g_1 / (2.0 * g_1 * g_1 - g * g_2)
+        x = numpy.maximum(x - step, x / 2.0)  # Positive
+        if not numpy.any(numpy.abs(step) > SOLVER_TOLERANCE * x):  # NaNs don't keep iterating
+            break
+
+    return x
+
+
+def _quadratic_guess(x0: numpy.ndarray) -> numpy.ndarray:
+    """
+    Return the root of g with exp(-C * x) = 1, right at both the small and the large particle limit
+    """
+
+    return (x0 + numpy.sqrt(x0 * x0 + 4.0 * x0 * (CUNNINGHAM_A + CUNNINGHAM_B))) / 2.0
+
+
+@functools.lru_cache(maxsize=1)
+def _initial_guess_table() -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Return log(x0) and log(x) of the solved roots on a log-spaced grid, computed on the first use
+    """
+
+    log_x0 = numpy.linspace(numpy.log(GUESS_TABLE_RANGE[0]), numpy.log(GUESS_TABLE_RANGE[1]), GUESS_TABLE_SIZE)
+    x0 = numpy.exp(log_x0)
+    x = _halley_steps(x0, _quadratic_guess(x0), 100)
+
+    return log_x0, numpy.log(x)
+
+
+def mobility_to_diameter(p_mobility: ArrayLike, gas_pressure: ArrayLike, gas_temp: ArrayLike) -> numpy.ndarray:
+    """
+    Return particle diameters (m) of singly charged particles with the electrical mobilities (m**2/Vs)
+
+    Arguments are broadcast against each other. Diameter is NaN if the mobility is not positive
+    """
+
+    p_mobility = numpy.asarray(p_mobility, dtype=float)
+    particle_mean_free_path = calc_p_mean_free_path(gas_pressure, gas_temp)
+    dynamic_gas_viscosity = calc_dyn_gas_visc(gas_temp)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # Slip-free diameter in units of 2 * mfp
+        x0 = ELEMENTARY_CHARGE / (3.0 * numpy.pi * dynamic_gas_viscosity * p_mobility) / 2.0 / particle_mean_free_path
+        x0 = numpy.where(x0 > 0.0, x0, numpy.nan)
+
+        # Interpolated from the table, outside it the quadratic guess is already close
+        log_x0, log_x = _initial_guess_table()
+        x = numpy.where((x0 >= GUESS_TABLE_RANGE[0]) & (x0 <= GUESS_TABLE_RANGE[1]),
+                        numpy.exp(numpy.interp(numpy.log(x0), log_x0, log_x)), _quadratic_guess(x0))
+        x = _halley_steps(x0, x, SOLVER_MAX_ITERATIONS)
+
+    return x * 2.0 * particle_mean_free_path
+
+
+def gen_p_diameters_list(dma_conf: dict, dma_sheath_flow: ArrayLike, flow_meter_pressure: ArrayLike,
+                         flow_meter_temp: ArrayLike, dma_voltages_list: ArrayLike) -> numpy.ndarray:
+    """
+    Return list of particle diameters corresponding to the dma voltages, inverse of gen_dma_voltages_list
+
+    Voltages, sheath flows, pressures and temperatures are broadcast against each other, so E.g. each measured voltage
+    can have its own gas state. Diameter is NaN if the voltage is not positive
+    """
+
+    particle_mobility_list = calc_dma_center_mobility(dma_geometry(dma_conf), dma_sheath_flow, dma_voltages_list)
+
+    return mobility_to_diameter(particle_mobility_list, flow_meter_pressure, flow_meter_temp)
+
+
+def gen_particle_diameters_list(dma_conf: dict, particle_size: str) -> numpy.ndarray:
+    """
+    Return list of particle diameters with desired interval between diameters
+
+    You must give parameter from the ini file(E.g. small or large) depending on what kind of list you want
+    """
+
+    p_d_min = float(dma_conf.get(f"{particle_size}_p_d_min"))
+    p_d_max = float(dma_conf.get(f"{particle_size}_p_d_max"))
+    p_d_list_size = int(dma_conf.get(f"number_of_{particle_size}_p"))
+
+    # Use log and then **10 to get list of diameters at correct interval
+    particle_diameter_list = numpy.linspace(numpy.log10(p_d_min), numpy.log10(p_d_max), p_d_list_size)
+
+    return numpy.power(10, particle_diameter_list)
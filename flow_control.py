@@ -0,0 +1,125 @@
+"""
+Feed-forward and gain scheduling of the blower pid
+
+The measurement cycle switches the sheath flow between a few target flows and valve states. FeedForwardTable learns the
+duty cycles that have held these flows steady, so the pid can start a flow change from a nearly correct duty cycle
+instead of integrating its way there. GainSchedule gives the pid its own tunings for each flow range.
+"""
+
+import json
+import logging
+import typing
+
+import numpy
+
+
+def _float_list(value: str) -> typing.List[float]:
+    """
+    Return comma separated numbers as a list, empty string = empty list
+    """
+
+    return [float(item) for item in value.split(",") if item.strip()]
+
+
+class FeedForwardTable:
+    """
+    Steady duty cycles of the blower per target flow and bypass valve state
+
+    Flows are kept with 0.1 L/min resolution. Flows between the learned flows are interpolated and flows outside them
+    are scaled from the nearest learned flow, because the blower's flow is roughly proportional to its duty cycle
+    """
+
+    def __init__(self, learning_rate: float, file_name: str = "") -> None:
+        self.__learning_rate = learning_rate  # Weight of a new duty cycle
+        self.__file_name = file_name  # Table is kept in this json file between the runs, empty = not kept
+        self.__duty_cycles = {False: {}, True: {}}  # Bypass valve state -> {flow: duty cycle}
+        self.load()
+
+    def learn(self, flow: float, bypass_valve: bool, duty_cycle: float) -> None:
+        """
+        Move the flow's duty cycle towards the duty cycle that held the flow steady
+        """
+
+        flow = round(flow, 1)
+        table = self.__duty_cycles[bypass_valve]
+        old = table.get(flow)
+        table[flow] = duty_cycle if old is None else old + (duty_cycle - old) * self.__learning_rate
+        logging.debug(f"Feed-forward of {flow} L/min (bypass {bypass_valve}): {table[flow]:.4f}")
+
+    def lookup(self, flow: float, bypass_valve: bool) -> typing.Optional[float]:
+        """
+        Return the duty cycle for the flow or None if nothing has been learned with the valve state
+        """
+
+        table = self.__duty_cycles[bypass_valve]
+        if len(table) == 0:
+            return None
+
+        flows = numpy.array(sorted(table))
+        duty_cycles = numpy.array([table[f] for f in flows])
+        if flows[0] <= flow <= flows[-1]:
+            return float(numpy.interp(flow, flows, duty_cycles))
+
+        nearest = 0 if flow < flows[0] else -1
+        return float(duty_cycles[nearest] * flow / flows[nearest]) if flows[nearest] > 0 else None
+
+    def load(self) -> None:
+        """
+        Read the table from the file if it exists
+        """
+
+        if not self.__file_name:
+            return
+
+        try:
+            with open(self.__file_name) as file:
+                for flow, bypass_valve, duty_cycle in json.load(file):
+                    self.__duty_cycles[bool(bypass_valve)][round(float(flow), 1)] = float(duty_cycle)
+            logging.info(f"Loaded feed-forward table from {self.__file_name}")
+        except FileNotFoundError:
+            logging.info(f"No feed-forward table {self.__file_name} yet")
+        except (ValueError, TypeError, OSError) as e:
+            logging.error(e)
+            logging.debug(f"Failed to read feed-forward table {self.__file_name}")
+
+    def save(self) -> None:
+        """
+        Write the table to the file
+        """
+
+        if not self.__file_name:
+            return
+
+        rows = [[flow, bypass_valve, duty_cycle] for bypass_valve, table in self.__duty_cycles.items()
+                for flow, duty_cycle in sorted(table.items())]
+        try:
+            with open(self.__file_name, "w") as file:
+                json.dump(rows, file, indent=1)
+            logging.info(f"Saved feed-forward table to {self.__file_name}")
+        except OSError as e:
+            logging.error(e)
+            logging.debug(f"Failed to write feed-forward table {self.__file_name}")
+
+
+class GainSchedule:
+    """
+    Pid tunings per flow range from the Pid:Gain_schedule section
+    """
+
+    def __init__(self, schedule_conf: dict) -> None:
+        self.__flows = _float_list(schedule_conf.get("flows"))  # Limits between the ranges
+        self.__tunings = list(zip(*(_float_list(schedule_conf.get(name)) for name in ("p", "i", "d"))))
+
+        if self.__flows and len(self.__tunings) != len(self.__flows) + 1:
+            logging.error("Gain schedule needs p, i and d for each flow range, gain scheduling is disabled")
+            self.__flows = []
+
+    def tunings(self, flow: float) -> typing.Optional[typing.Tuple[float, float, float]]:
+        """
+        Return (p, i, d) of the flow's range or None if the schedule is not used
+        """
+
+        if not self.__flows:
+            return None
+
+        return self.__tunings[int(numpy.searchsorted(self.__flows, flow, side="right"))]
@@ -5,10 +5,19 @@ Classes for TSI 4000 (and 5000) series flow meters
 
 import logging
 import typing  # Used for providing tuple type hint
+from threading import Lock
 
+import numpy
 import serial
 
+import clocks
 import config
+import serial_io
+
+# Reply of DAFTP0001 is OK and the data line, or an error line
+FTP_FRAME = serial_io.Frame(b"\n", 2, error_prefix=b"ERR")
+# Reply of SSR (set sample rate) is OK or an error line
+SSR_FRAME = serial_io.Frame(b"\n", 1)
 
 
 class FlowMeter4000:
@@ -17,11 +26,30 @@ class FlowMeter4000:
     The constructor automatically opens the serial connection, remember to close it!
     """
 
-    def __init__(self, conf: config.Config) -> None:
-        self.__ser_connection = serial.Serial()  # Serial connection object
+    def __init__(self, conf: config.Config, ser_connection: serial.Serial = None, clock: clocks.Clock = None,
+                 io_engine: serial_io.SerialIoEngine = None, name: str = "flow_meter") -> None:
+        # Serial connection object. E.g. simulation.SimulatedFlowMeterSerial can be given instead of the real serial
+        # port
+        self.__ser_connection = serial.Serial() if ser_connection is None else ser_connection
+        # If the engine is given, commands are executed by it instead of reading and writing the port here
+        self.__io_engine = io_engine
+        self.__name = name  # Device name in the engine
         self.__conf = conf
         self.__ser_conf = self.__conf.get_configuration("Flow_Meter")  # Dict containing serial settings
         self.__scaling_conf = self.__conf.get_configuration("Flow_Meter_Scaling")
+        self.__streaming_conf = self.__conf.get_configuration("Flow_Meter_Streaming")
+        self.__clock = clock if clock is not None else clocks.Clock()  # Used for timestamping the samples
+        self.__sample_rate_set = False  # Sample rate is sent to the flow meter once per connection
+
+        # Scaling parsed from the conf dict, updated with update_scaling
+        self.__multipliers = numpy.ones(3)
+        self.__offsets = numpy.zeros(3)
+        self.update_scaling()
+
+        # Ring buffer of the latest samples. Rows are time (s), flow, temperature and pressure
+        self.__samples = numpy.full((int(self.__streaming_conf.get("buffer_size")), 4), numpy.nan)
+        self.__samples_written = 0
+        self.__samples_lock = Lock()  # Samples are written by the pid thread and read by the others
 
         self.__set_serial_settings()  # Set serial settings and open the connection
         logging.info("Created FlowMeter4000 object")
@@ -33,6 +61,7 @@ class FlowMeter4000:
 
         # Ensure that connection is closed before changing settings
         self.close_ser_connection()
+        self.__sample_rate_set = False
 
         # Set serial settings with values from the configuration dict
         try:
@@ -55,6 +84,8 @@ class FlowMeter4000:
         try:
             self.__ser_connection.open()
             logging.info("Set serial settings and opened connection to the flow meter")
+            if self.__io_engine is not None:
+                self.__io_engine.add_device(self.__name, self.__ser_connection)
         except serial.SerialException as e:
             logging.error(e)
             logging.debug("Flow meter's serial port settings are probably set wrong")
@@ -64,6 +95,9 @@ class FlowMeter4000:
         If serial connection is open close it
         """
 
+        if self.__io_engine is not None:
+            self.__io_engine.remove_device(self.__name)
+
         if self.__ser_connection.isOpen():
             self.__ser_connection.close()
             logging.info("Closed the flow meter's serial connection")
@@ -75,8 +109,87 @@ class FlowMeter4000:
 
         # Update the conf dict
         self.__conf.update_configuration(self.__ser_conf, "Flow_Meter:Serial_port")
+        self.__conf.update_configuration(self.__streaming_conf, "Flow_Meter:Streaming")
         self.__set_serial_settings()  # Restart ser connection with the new settings
 
+    def update_scaling(self) -> None:
+        """
+        Parse the multipliers and offsets from the scaling conf dict. Call after the dict has been updated
+        """
+
+        try:
+            self.__multipliers = numpy.array([float(self.__scaling_conf.get(f"{value}_multiplier"))
+                                              for value in ("f", "t", "p")])
+            self.__offsets = numpy.array([float(self.__scaling_conf.get(f"{value}_offset"))
+                                          for value in ("f", "t", "p")])
+        except (ValueError, TypeError) as e:
+            logging.error(e)
+            logging.debug("Flow meter's multipliers or offsets are invalid, using the previous ones")
+
+    def streaming(self) -> bool:
+        """
+        Return True if the samples are read in blocks with read_ftp_stream
+        """
+
+        return self.__streaming_conf.get("enabled") == "1"
+
+    def __parse_ftp(self, line: bytes) -> typing.Optional[numpy.ndarray]:
+        """
+        Return scaled flow, temperature and pressure from the data line or None if the line is invalid
+        """
+
+        try:
+            values = numpy.array(line.decode("UTF-8").strip().split(","), dtype=float)
+        except (UnicodeDecodeError, ValueError) as e:
+            logging.error(e)
+            logging.debug(f"Invalid flow meter data line: {line}")
+            return None
+
+        # Ensure that flow meter measures all the three values
+        if len(values) != 3:
+            return None
+
+        return values * self.__multipliers + self.__offsets
+
+    def __store_sample(self, timestamp: float, ftp: numpy.ndarray) -> None:
+        """
+        Add the sample to the ring buffer
+        """
+
+        with self.__samples_lock:
+            self.__samples[self.__samples_written % len(self.__samples)] = (timestamp, *ftp)
+            self.__samples_written += 1
+
+    def get_samples(self, count: int = None) -> numpy.ndarray:
+        """
+        Return latest count samples (all samples in the buffer if None) in the chronological order
+
+        Rows are clock time (s), flow (L/min), temperature (°C) and pressure (kPa)
+        """
+
+        with self.__samples_lock:
+            size = min(self.__samples_written, len(self.__samples))
+            count = size if count is None else min(count, size)
+            indexes = numpy.arange(self.__samples_written - count, self.__samples_written) % len(self.__samples)
+            return self.__samples[indexes].copy()
+
+    def __query(self, command: str, frame: serial_io.Frame) -> typing.List[bytes]:
+        """
+        Write the command and read its reply. Return frame.lines lines of the reply, missing lines are empty
+        """
+
+        if self.__io_engine is not None:
+            reply = self.__io_engine.request(self.__name, command.encode("UTF-8"), frame)
+            lines = [line + frame.terminator for line in reply.split(frame.terminator)][:frame.lines]
+        else:
+            self.__ser_connection.write(command.encode("UTF-8"))
+            # Data line is not sent after an error
+            lines = [self.__ser_connection.read_until(frame.terminator)]
+            if frame.error_prefix is None or not lines[0].startswith(frame.error_prefix):
+                lines += [self.__ser_connection.read_until(frame.terminator) for _ in range(frame.lines - 1)]
+
+        return lines + [b""] * (frame.lines - len(lines))
+
     def read_ftp(self) -> typing.Tuple[float, float, float]:
         """
         Read flow [L/min], temperature [°C] and pressure [kPa] from the flow meter and return them
@@ -86,42 +199,106 @@ class FlowMeter4000:
 
         if self.__ser_connection.isOpen():
             encoding = "UTF-8"
-            new_line = "\n".encode(encoding)  # Str to utf-8
 
             # Request one sample of flow rate, temperature and pressure
-            str_out = "DAFTP0001\r".encode(encoding)  # Str to utf-8
-            self.__ser_connection.write(str_out)  # Send the command
-
-            # Read OK or ERR from the TSI
+            # Reply is OK or ERR from the TSI and the data line after OK
             # TODO: If the serial settings are wrong program can get stuck on this step
-            str_in = self.__ser_connection.read_until(new_line)
+            str_in, data_line = self.__query("DAFTP0001\r", FTP_FRAME)
             str_in = str_in.decode(encoding)  # ASCII(bytes) to str
             str_in = str_in.strip()  # Remove whitespace
 
             # Check that the command worked successfully, handle things if not
             if str_in != "OK":
-                logging.error("Flow meter's measurements can not be read!")
-                # Log the error code if the flow meter gave one
-                if len(str_in) != 0:
-                    logging.debug(str_in)
-                logging.debug("The flow meter's serial port settings are probably set wrong")
+                self.__log_reply_error(str_in)
 
             elif str_in == "OK":
                 # Read flow(L/min), temp(°C) and pressure(kPa)
-                str_in = self.__ser_connection.read_until(new_line)
-                str_in = str_in.decode(encoding)  # ASCII(bytes) to str
-                str_in = str_in.strip()  # Remove whitespace
-                str_split = str_in.split(",")  # Split str_in by comma to a list
-
-                # Ensure that flow meter measures all the three values
-                if len(str_split) == 3:
-                    flow = float(str_split[0]) * float(self.__scaling_conf.get("f_multiplier")) + float(
-                        self.__scaling_conf.get("f_offset"))
-                    temp = float(str_split[1]) * float(self.__scaling_conf.get("t_multiplier")) + float(
-                        self.__scaling_conf.get("t_offset"))
-                    pressure = float(str_split[2]) * float(self.__scaling_conf.get("p_multiplier")) + float(
-                        self.__scaling_conf.get("p_offset"))
+                ftp = self.__parse_ftp(data_line)
+                if ftp is not None:
+                    self.__store_sample(self.__clock.monotonic(), ftp)
+                    flow, temp, pressure = ftp.tolist()
         else:
             logging.debug("Flow meter's serial port is not open!")
 
         return flow, temp, pressure
+
+    def read_ftp_stream(self, callback: typing.Callable[[typing.Tuple[float, float, float], float], None] = None) \
+            -> numpy.ndarray:
+        """
+        Request a block of samples with one DAFTP command and read them as they arrive
+
+        The flow meter sends the block's samples at the sample interval of the Flow_Meter:Streaming section. Each sample
+        is timestamped, added to the ring buffer (see get_samples) and given to the callback as a (flow, temp, pressure)
+        tuple and its timestamp right after it has been parsed. With the serial I/O engine the block is parsed after the
+        whole reply has arrived, so the callbacks come at once and the timestamps are spaced by the sample interval.
+
+        Return the block's samples like get_samples does
+        """
+
+        if not self.__ser_connection.isOpen():
+            logging.debug("Flow meter's serial port is not open!")
+            return numpy.empty((0, 4))
+
+        samples = int(self.__streaming_conf.get("samples"))
+        interval = int(self.__streaming_conf.get("sample_interval"))  # Unit is ms
+        if not self.__sample_rate_set:
+            self.__set_sample_rate(interval)
+
+        command = f"DAFTP{samples:04d}\r"
+        block = []
+
+        def add_sample(timestamp: float, line: bytes) -> None:
+            ftp = self.__parse_ftp(line)
+            if ftp is None:
+                return
+            self.__store_sample(timestamp, ftp)
+            block.append((timestamp, *ftp))
+            if callback is not None:
+                callback(tuple(ftp.tolist()), timestamp)
+
+        if self.__io_engine is not None:
+            # Reply must arrive before the block has been measured and the serial timeout has passed after that
+            frame = serial_io.Frame(b"\n", samples + 1, error_prefix=b"ERR",
+                                    timeout=samples * interval / 1000.0 + float(self.__ser_conf.get("timeout")))
+            lines = self.__io_engine.request(self.__name, command.encode("UTF-8"), frame).split(b"\n")
+            if lines[0].strip() != b"OK":
+                self.__log_reply_error(lines[0].decode("UTF-8", errors="replace").strip())
+                return numpy.empty((0, 4))
+            data_lines = [line for line in lines[1:samples + 1] if line.strip()]
+            now = self.__clock.monotonic()
+            for i, line in enumerate(data_lines):
+                add_sample(now - (len(data_lines) - 1 - i) * interval / 1000.0, line)
+        else:
+            self.__ser_connection.write(command.encode("UTF-8"))
+            str_in = self.__ser_connection.read_until(b"\n").decode("UTF-8", errors="replace").strip()
+            if str_in != "OK":
+                self.__log_reply_error(str_in)
+                return numpy.empty((0, 4))
+            for _ in range(samples):
+                line = self.__ser_connection.read_until(b"\n")
+                if len(line) == 0:  # Timeout
+                    logging.debug("Flow meter's sample block ended before all the samples were read")
+                    break
+                add_sample(self.__clock.monotonic(), line)
+
+        return numpy.array(block).reshape(-1, 4)
+
+    def __set_sample_rate(self, interval: int) -> None:
+        """
+        Set the interval (ms) between the samples of a DAFTP block
+        """
+
+        reply = self.__query(f"SSR{interval:04d}\r", SSR_FRAME)[0].decode("UTF-8", errors="replace").strip()
+        if reply != "OK":
+            self.__log_reply_error(reply)
+            return
+        self.__sample_rate_set = True
+        logging.info(f"Set flow meter's sample interval to {interval} ms")
+
+    @staticmethod
+    def __log_reply_error(reply: str) -> None:
+        logging.error("Flow meter's measurements can not be read!")
+        # Log the error code if the flow meter gave one
+        if len(reply) != 0:
+            logging.debug(reply)
+        logging.debug("The flow meter's serial port settings are probably set wrong")
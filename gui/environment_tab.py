@@ -2,7 +2,6 @@
 Provides environment tab for the main window
 """
 
-import queue
 import tkinter as tk
 from multiprocessing import Lock
 from tkinter import ttk
@@ -12,6 +11,7 @@ from matplotlib.backends.backend_tkagg import (
 from matplotlib.figure import Figure
 
 import config
+import mailboxes
 import ni_daqs
 from threads import automatic_measurement
 
@@ -23,12 +23,12 @@ class EnvironmentTab(ttk.Frame):
 
     def __init__(self, container, daq: ni_daqs,
                  automatic_measurement_thread: automatic_measurement.AutomaticMeasurementThread,
-                 daq_ai_queue: queue.Queue, conf: config.Config, daq_lock: Lock) -> None:
+                 daq_ai: mailboxes.LatestValue, conf: config.Config, daq_lock: Lock) -> None:
         super().__init__(container)  # Inherit Frame class
 
         self.__daq = daq
         self.__daq_scaling_conf = conf.get_configuration("NI_DAQ_Scaling")
-        self.__daq_ai_queue = daq_ai_queue
+        self.__daq_ai = daq_ai
         self.__daq_lock = daq_lock
 
         self.__plt_fig = Figure(figsize=(8, 5), dpi=100)
@@ -91,7 +91,7 @@ class EnvironmentTab(ttk.Frame):
         t += 0.5
         x_coord.append(t)
 
-        volts = self.__daq_ai_queue.get() # ADD: Check whether the queue is empty or not
+        volts = self.__daq_ai.get([0, 0, 0, 0, 0, 0])  # Latest voltages, zeros if there are none yet
         self.__daq_lock.acquire()
         y1_coord.append(self.__daq.scale_value("t", volts[int(self.__daq_scaling_conf.get("t_chan"))]))
         y2_coord.append(self.__daq.scale_value("rh", volts[int(self.__daq_scaling_conf.get("rh_chan"))]))
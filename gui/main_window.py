@@ -4,7 +4,6 @@ E.g. MenuBar implements functionality to all top menu related things
 """
 
 import logging
-import queue
 import tkinter as tk
 from multiprocessing import Lock
 from tkinter import ttk
@@ -12,6 +11,8 @@ from tkinter import ttk
 import config
 import detectors
 import flow_meters
+import mailboxes
+import measurement_bus
 import ni_daqs
 from gui import maintenance_tab, menu_bar, measurement_tab, environment_tab
 from threads import pid_ftp_thread, automatic_measurement
@@ -25,8 +26,8 @@ class MainWindow(tk.Tk):
     def __init__(self, conf: config.Config, daq: ni_daqs.NiDaq, flow_meter: flow_meters.FlowMeter4000,
                  detector: detectors.CpcLegacy, blower_thread: pid_ftp_thread.BlowerPidThread,
                  automatic_measurement_thread: automatic_measurement.AutomaticMeasurementThread,
-                 flow_meter_ftp_queue: queue.Queue, hv_voltage_queue: queue.Queue, conc_queue: queue.Queue,
-                 daq_ai_queue: queue.Queue, rd_queue: queue.Queue, flow_meter_lock: Lock, daq_lock: Lock,
+                 flow_meter_ftp: mailboxes.LatestValue, bus: measurement_bus.MeasurementBus,
+                 daq_ai: mailboxes.LatestValue, rd: mailboxes.LatestValue, flow_meter_lock: Lock, daq_lock: Lock,
                  detector_lock: Lock) -> None:
         logging.info("Starting to create the main gui window")
 
@@ -59,18 +60,17 @@ class MainWindow(tk.Tk):
 
         # Maintenance tab
         maint_tab = maintenance_tab.MaintenanceTab(self, conf, flow_meter, daq, detector, blower_thread,
-                                                   flow_meter_ftp_queue, daq_ai_queue, rd_queue, notebook,
+                                                   flow_meter_ftp, daq_ai, rd, notebook,
                                                    flow_meter_lock,
                                                    daq_lock)
         logging.info("Maintenance tab created")
 
         # Measurement tab
-        measure_tab = measurement_tab.MeasurementTab(self, conf, automatic_measurement_thread, hv_voltage_queue,
-                                                     conc_queue)
+        measure_tab = measurement_tab.MeasurementTab(self, conf, automatic_measurement_thread, bus)
         logging.info("Measurement tab created")
 
         # Environment tab
-        env_tab = environment_tab.EnvironmentTab(self, daq, automatic_measurement_thread, daq_ai_queue, conf, daq_lock)
+        env_tab = environment_tab.EnvironmentTab(self, daq, automatic_measurement_thread, daq_ai, conf, daq_lock)
         logging.info("Environment tab created")
 
         # Add tabs to the notebook (container)
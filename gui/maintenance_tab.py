@@ -1,5 +1,4 @@
 import logging
-import queue
 import tkinter as tk
 from multiprocessing import Lock
 from tkinter import ttk, messagebox
@@ -9,10 +8,14 @@ import nidaqmx
 import config
 import detectors
 import flow_meters
+import mailboxes
 import ni_daqs
 from gui.general_functions import create_labels, create_entries
 from threads import pid_ftp_thread
 
+# Values older than this (s) are shown as None
+STALE_AFTER = 5.0
+
 
 class MaintenanceTab(ttk.Frame):
     """
@@ -20,8 +23,9 @@ class MaintenanceTab(ttk.Frame):
     """
 
     def __init__(self, container, conf: config.Config, flow_meter: flow_meters, daq: ni_daqs, detector: detectors,
-                 blower_pid_thread: pid_ftp_thread, flow_meter_queue: queue.Queue, daq_queue: queue.Queue,
-                 rd_queue: queue.Queue, notebook: ttk.Notebook, flow_meter_lock: Lock, daq_lock: Lock) -> None:
+                 blower_pid_thread: pid_ftp_thread, flow_meter_ftp: mailboxes.LatestValue,
+                 daq_ai: mailboxes.LatestValue, rd: mailboxes.LatestValue, notebook: ttk.Notebook,
+                 flow_meter_lock: Lock, daq_lock: Lock) -> None:
         super().__init__(container)  # Inherit Frame class
 
         # Initialize
@@ -30,9 +34,9 @@ class MaintenanceTab(ttk.Frame):
         self.__daq = daq
         self.__detector = detector
         self.__blower_pid_thread = blower_pid_thread
-        self.__fw_queue = flow_meter_queue
-        self.__daq_queue = daq_queue
-        self.__rd_queue = rd_queue
+        self.__fw_ftp = flow_meter_ftp
+        self.__daq_ai = daq_ai
+        self.__rd = rd
         self.__notebook = notebook
         self.__fw_lock = flow_meter_lock
         self.__daq_lock = daq_lock
@@ -119,16 +123,16 @@ class MaintenanceTab(ttk.Frame):
 
     def __ftp_measure_start(self, ftp_labels: list, measure_ftp_btn: ttk.Button) -> None:
         """
-        Start reading flow, temp and pressure from the flow meter ftp queue and update GUI to display the measurements
+        Start reading flow, temp and pressure from the flow meter ftp mailbox and update GUI to display the measurements
 
         Change button command to stop the measurement if button is clicked again
         """
 
-        # Handle the event that the queue is empty(should not happen on normal circumstances)
-        if self.__fw_queue.empty():
+        # Values are not shown if the pid thread has stopped reading the flow meter
+        if self.__fw_ftp.is_stale(STALE_AFTER):
             flow, temp, pressure = None, None, None
         else:
-            flow, temp, pressure = self.__fw_queue.get()  # Read the queue
+            flow, temp, pressure = self.__fw_ftp.get()  # Read the latest values
 
         # Update the labels
         ftp_labels[0].config(text=f"{flow} L/min")
@@ -171,6 +175,7 @@ class MaintenanceTab(ttk.Frame):
             # Update value in the ini file
             self.__conf.write("Flow_Meter:Scaling", entries[name], entries[name].get())
         self.__conf.update_configuration(self.__fw_scaling_conf, "Flow_Meter:Scaling")  # Update the conf dict
+        self.__flow_meter.update_scaling()  # Flow meter parses the values once
         self.__fw_lock.release()
 
         messagebox.showinfo(message="Saved!")  # Display message
@@ -309,11 +314,8 @@ class MaintenanceTab(ttk.Frame):
         Reads analog inputs from the daq and updates GUI to display the values
         """
 
-        # Handle the event that the queue is empty(should not happen on normal circumstances)
-        if self.__daq_queue.empty():
-            volts = [0, 0, 0, 0, 0, 0]
-        else:
-            volts = self.__daq_queue.get()  # Read the queue
+        # Handle the event that there are no voltages yet (should not happen on normal circumstances)
+        volts = self.__daq_ai.get([0, 0, 0, 0, 0, 0])  # Read the latest voltages
 
         self.__daq_lock.acquire()
         # Scale measured voltages to proper units
@@ -380,11 +382,8 @@ class MaintenanceTab(ttk.Frame):
         Start measuring avg concentration from the cpc every 0.5s
         """
 
-        # Handle the event that the queue is empty(should not happen on normal circumstances)
-        if self.__rd_queue.empty():
-            conc = None
-        else:
-            conc = self.__rd_queue.get()  # Read the queue
+        # Concentration is not shown if the cpc has not been read lately
+        conc = None if self.__rd.is_stale(STALE_AFTER) else self.__rd.get()
 
         if conc is not None:
             cpc_label.config(text=f"{round(conc, 2)} p/cm^3")
@@ -1,4 +1,3 @@
-import queue
 from tkinter import ttk
 
 from matplotlib.backends.backend_tkagg import (
@@ -6,6 +5,7 @@ from matplotlib.backends.backend_tkagg import (
 from matplotlib.figure import Figure
 
 import config
+import measurement_bus
 from threads import automatic_measurement
 
 
@@ -16,18 +16,19 @@ class MeasurementTab(ttk.Frame):
 
     def __init__(self, container, conf: config.Config,
                  automatic_measurement_thread: automatic_measurement.AutomaticMeasurementThread,
-                 voltage_queue: queue.Queue,
-                 conc_queue: queue.Queue) -> None:
+                 bus: measurement_bus.MeasurementBus) -> None:
         super().__init__(container)  # Inherit Frame class
 
         self.__measurement_conf = conf.get_configuration("Automatic_measurement")
+        # Bins of the current scan are plotted, the plot is cleared when the scan ends
+        self.__subscription = bus.subscribe("Measurement tab", ("bin", "scan", "total", "size_distribution"),
+                                            size=1000)
         self.__x_coord = []
         self.__y_coord = []
-        self.__plt_fig = Figure(figsize=(7, 4), dpi=100)
-        self.__ax = self.__plt_fig.add_subplot()
-        self.__ax.grid()
-        self.__ax.set_xlabel("Voltage [V]")
-        self.__ax.set_ylabel("Concentration [1/cm^3]")
+        self.__distribution = None  # Latest inverted scan
+        self.__plt_fig = Figure(figsize=(7, 7), dpi=100)
+        self.__ax, self.__distribution_ax = self.__plt_fig.subplots(2, 1)
+        self.__set_labels()
 
         # Draw plot
         canvas = FigureCanvasTkAgg(self.__plt_fig, master=self)  # A tk.DrawingArea
@@ -37,54 +38,63 @@ class MeasurementTab(ttk.Frame):
         # Measure button
         measurement_btn = ttk.Button(
             self, text="Start",
-            command=lambda: self.__automatic_measurement_start(automatic_measurement_thread, measurement_btn,
-                                                               voltage_queue, conc_queue, canvas))
+            command=lambda: self.__automatic_measurement_start(automatic_measurement_thread, measurement_btn, canvas))
         measurement_btn.grid(row=1, column=0, sticky="w", padx=5, pady=5)
 
+    def __set_labels(self) -> None:
+        self.__ax.grid()
+        self.__ax.set_xlabel("Voltage [V]")
+        self.__ax.set_ylabel("Concentration [1/cm^3]")
+        self.__distribution_ax.grid()
+        self.__distribution_ax.set_xlabel("Diameter [nm]")
+        self.__distribution_ax.set_ylabel("dN/dlogDp [1/cm^3]")
+
     def __automatic_measurement_start(self,
                                       automatic_measurement_thread: automatic_measurement.AutomaticMeasurementThread,
-                                      measure_btn: ttk.Button, voltage_queue: queue.Queue, conc_queue: queue.Queue,
-                                      canvas: FigureCanvasTkAgg) -> None:
+                                      measure_btn: ttk.Button, canvas: FigureCanvasTkAgg) -> None:
         """
         Start automatic measurement thread and plot the results
         """
 
         automatic_measurement_thread.started = True  # Start the thread
 
-        if automatic_measurement_thread.reset_plot:  # Clear the plot between particle sizes measurements
-            self.__x_coord.clear()
-            self.__y_coord.clear()
-            self.__ax.cla()  # Clear the plot
-            self.__ax.grid()
-            self.__ax.set_xlabel("Voltage [V]")
-            self.__ax.set_ylabel("Concentration [1/cm^3]")
-            automatic_measurement_thread.reset_plot = False
-        else:
-            if voltage_queue.empty() or conc_queue.empty():
-                pass
-            else:
-                # Plot the results
-                self.__x_coord.append(voltage_queue.get())
-                self.__y_coord.append(conc_queue.get())
-                self.__ax.plot(self.__x_coord, self.__y_coord, marker="o")
-            # Draw
-            canvas.draw()
-            canvas.get_tk_widget().grid(padx=10, pady=10)
+        for message in self.__subscription.get_all():
+            if message.topic == "bin":
+                self.__x_coord.append(message.value["voltage"])
+                self.__y_coord.append(message.value["conc"])
+            elif message.topic == "size_distribution":
+                self.__distribution = message.value
+            else:  # Clear the plot between particle sizes measurements
+                self.__x_coord.clear()
+                self.__y_coord.clear()
+
+        # Plot the results
+        self.__ax.cla()
+        self.__distribution_ax.cla()
+        self.__set_labels()
+        if self.__x_coord:
+            self.__ax.plot(self.__x_coord, self.__y_coord, marker="o")
+        if self.__distribution is not None:
+            self.__distribution_ax.plot(self.__distribution["diameter"] * 1e9, self.__distribution["dndlogdp"],
+                                        marker="o")
+            self.__distribution_ax.set_xscale("log")
+            self.__distribution_ax.set_title(f"{self.__distribution['segment']} {self.__distribution['time']}")
+        # Draw
+        canvas.draw()
+        canvas.get_tk_widget().grid(padx=10, pady=10)
 
         # Call this method every between_voltages_wait_t [s]
         wait_t = float(self.__measurement_conf["between_voltages_wait_t"]) * 1000  # Convert to ms
         # after_id is used to stop calling this method
         plot_after_id = self.after(
-            int(wait_t), lambda: self.__automatic_measurement_start(automatic_measurement_thread, measure_btn, voltage_queue,
-                                                               conc_queue, canvas))
+            int(wait_t), lambda: self.__automatic_measurement_start(automatic_measurement_thread, measure_btn, canvas))
 
         # Configure button to stop the measurement if it is clicked again
         measure_btn.configure(text="Stop", command=lambda: self.automatic_measurement_stop(
-            automatic_measurement_thread, measure_btn, voltage_queue, conc_queue, canvas, plot_after_id))
+            automatic_measurement_thread, measure_btn, canvas, plot_after_id))
 
     def automatic_measurement_stop(self, automatic_measurement_thread: automatic_measurement.AutomaticMeasurementThread,
-                                   measure_btn: ttk.Button, voltage_queue: queue.Queue, conc_queue: queue.Queue,
-                                   canvas: FigureCanvasTkAgg, plot_after_id) -> None:
+                                   measure_btn: ttk.Button, canvas: FigureCanvasTkAgg, plot_after_id) -> None:
         """
         Stop automatic measurement thread and stop plotting the results
         """
@@ -95,7 +105,7 @@ class MeasurementTab(ttk.Frame):
 
         # Configure button to stop the measurement if it is clicked again
         measure_btn.configure(text="Start", command=lambda: self.__automatic_measurement_start(
-            automatic_measurement_thread, measure_btn, voltage_queue, conc_queue, canvas))
+            automatic_measurement_thread, measure_btn, canvas))
 
         # End the call loop
         self.after_cancel(plot_after_id)
@@ -0,0 +1,248 @@
+"""
+Size distribution inversion of the measured scans
+
+Concentrations y measured at the scan's DMA voltages (channels) are y = A n, where n is the size distribution
+dN/dlogDp on the inversion grid. The kernel A includes the DMA's transfer function, multiple charging and the cpc's
+counting efficiency. Kernels are cached per channel voltages, inversion grid and gas state rounded like in dma_physics,
+so a campaign measured with the same scan plan builds only a few of them.
+
+Distributions are solved as non-negative least squares with a smoothness (second difference) term. The solver is FISTA
+(accelerated projected gradient), which solves all the scans of a kernel at once with matrix products.
+"""
+
+import functools
+import logging
+import typing
+
+import numpy
+
+import charging
+import dma_physics
+
+KERNEL_CACHE_SIZE = 64
+QUADRATURE_STEPS = 40  # Integration steps per transfer function's half width
+CHECK_INTERVAL = 10  # Solver's convergence is checked every CHECK_INTERVAL iterations
+
+
+class InversionSettings(typing.NamedTuple):
+    """
+    Values of the Inversion section
+    """
+
+    aerosol_flow: float  # Unit is L/min
+    polarity: int  # Sign of the particles' charges, -1 or 1
+    max_charge: int
+    charging_table_file: str  # Empty = charging table is not kept in a file
+    cpc_d50: float  # Unit is m, 0 = efficiency is 1
+    cpc_d0: float  # Unit is m
+    regularization: float
+    max_iterations: int
+    tolerance: float
+
+
+class Kernel(typing.NamedTuple):
+    """
+    Kernel of the channels and the inversion grid with the solver's precomputed matrices
+    """
+
+    matrix: numpy.ndarray  # A, shape is (channels, grid)
+    grid_d: numpy.ndarray  # Inversion grid's diameters (m)
+    normal_matrix: numpy.ndarray  # A^T A + regularization term
+    pseudo_inverse: numpy.ndarray  # Pseudo-inverse of the normal matrix, gives the solver's initial guess
+    step: float  # Gradient step, 1 / largest eigenvalue of the normal matrix
+
+
+def inversion_settings(inversion_conf: dict) -> InversionSettings:
+    """
+    Return the Inversion section's values as InversionSettings
+    """
+
+    max_charge = int(inversion_conf.get("max_charge"))
+    if not 1 <= max_charge <= charging.MAX_CHARGE:
+        logging.warning(f"Inversion max_charge must be 1...{charging.MAX_CHARGE}, using {charging.MAX_CHARGE}")
+        max_charge = charging.MAX_CHARGE
+
+    return InversionSettings(float(inversion_conf.get("aerosol_flow")),
+                             1 if inversion_conf.get("polarity") == "positive" else -1, max_charge,
+                             inversion_conf.get("charging_table_file"),
+                             float(inversion_conf.get("cpc_d50")), float(inversion_conf.get("cpc_d0")),
+                             float(inversion_conf.get("regularization")), int(inversion_conf.get("max_iterations")),
+                             float(inversion_conf.get("tolerance")))
+
+
+def cpc_efficiency(settings: InversionSettings, particle_d_list: numpy.ndarray) -> numpy.ndarray:
+    """
+    Return the cpc's counting efficiencies of the diameters
+
+    Efficiency is 1 - exp(-ln(2) * (d - d0) / (d50 - d0)) above cpc_d0 and zero below it
+    """
+
+    particle_d_list = numpy.asarray(particle_d_list, dtype=float)
+    if settings.cpc_d50 <= 0.0:
+        return numpy.ones_like(particle_d_list)
+
+    reduced_d = (particle_d_list - settings.cpc_d0) / (settings.cpc_d50 - settings.cpc_d0)
+    return numpy.where(reduced_d > 0.0, 1.0 - numpy.exp(-numpy.log(2.0) * reduced_d), 0.0)
+
+
+def _hat_functions(grid_d: numpy.ndarray, log_d: numpy.ndarray) -> numpy.ndarray:
+    """
+    Return values of the grid's piecewise linear basis functions (in log10 d) at log_d, shape is (log_d, grid)
+
+    Edge functions fall to zero one grid interval outside the grid
+    """
+
+    nodes = numpy.log10(grid_d)
+    nodes = numpy.concatenate(([2.0 * nodes[0] - nodes[1]], nodes, [2.0 * nodes[-1] - nodes[-2]]))
+    identity = numpy.eye(len(grid_d))
+
+    return numpy.stack([numpy.interp(log_d, nodes, numpy.concatenate(([0.0], row, [0.0]))) for row in identity],
+                       axis=1)
+
+
+def build_kernel(settings: InversionSettings, geometry: dma_physics.DmaGeometry, channel_voltages: numpy.ndarray,
+                 grid_d: numpy.ndarray, sheath_flow: float, gas_pressure: float, gas_temp: float) -> Kernel:
+    """
+    Return the kernel of the channels' voltages and the inversion grid at the gas state
+
+    Transfer function is the DMA's triangular transfer function of balanced flows (sample flow = aerosol flow). Counts
+    of the channel i are y_i = sum over charges of the integral of transfer * charge fraction * cpc efficiency * n(d)
+    over log10 d
+    """
+
+    channel_voltages = numpy.asarray(channel_voltages, dtype=float)
+    grid_d = numpy.asarray(grid_d, dtype=float)
+    if len(grid_d) < 2:
+        raise ValueError("Inversion grid needs at least two diameters")
+
+    flow_ratio = settings.aerosol_flow / sheath_flow  # Half width of the transfer function in mobility / center
+
+    # Quadrature points cover the grid's basis functions, the step resolves the transfer function
+    log_grid = numpy.log10(grid_d)
+    step = min(flow_ratio / QUADRATURE_STEPS / numpy.log(10.0), numpy.min(numpy.diff(log_grid)) / 10.0)
+    log_d = numpy.arange(2.0 * log_grid[0] - log_grid[1], 2.0 * log_grid[-1] - log_grid[-2] + step, step)
+    particle_d_list = 10.0 ** log_d
+
+    particle_mean_free_path = dma_physics.calc_p_mean_free_path(gas_pressure, gas_temp)
+    p_mobility_list = dma_physics.gen_p_mobility_list(
+        dma_physics.gen_cunningham_corrected_list(particle_mean_free_path, particle_d_list),
+        dma_physics.calc_dyn_gas_visc(gas_temp), particle_d_list)
+    center_mobility = dma_physics.calc_dma_center_mobility(geometry, sheath_flow, channel_voltages)
+
+    # Response of each channel to each quadrature point, shape is (channels, points)
+    response = numpy.zeros((len(channel_voltages), len(particle_d_list)))
+    charge_fractions = charging.get_table(settings.charging_table_file).fractions(
+        particle_d_list, [settings.polarity * charges for charges in range(1, settings.max_charge + 1)])
+    for charges, fractions in enumerate(charge_fractions, start=1):
+        mobility_ratio = charges * p_mobility_list[numpy.newaxis, :] / center_mobility[:, numpy.newaxis]
+        transfer = numpy.maximum(1.0 - numpy.abs(mobility_ratio - 1.0) / flow_ratio, 0.0)
+        response += transfer * fractions
+    response *= cpc_efficiency(settings, particle_d_list)
+
+    matrix = response @ _hat_functions(grid_d, log_d) * step
+
+    # Second differences of the distribution are the smoothness term, scaled to the size of the data term
+    normal_matrix = matrix.T @ matrix
+    if len(grid_d) >= 3 and settings.regularization > 0.0:
+        second_difference = numpy.diff(numpy.eye(len(grid_d)), n=2, axis=0)
+        smoothness = second_difference.T @ second_difference
+        normal_matrix += settings.regularization * numpy.trace(normal_matrix) / numpy.trace(smoothness) * smoothness
+
+    largest_eigenvalue = numpy.linalg.eigvalsh(normal_matrix)[-1]
+
+    return Kernel(matrix, grid_d, normal_matrix, numpy.linalg.pinv(normal_matrix, hermitian=True),
+                  1.0 / largest_eigenvalue if largest_eigenvalue > 0.0 else 0.0)
+
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _cached_kernel(settings: InversionSettings, geometry: dma_physics.DmaGeometry, voltages_key: bytes,
+                   grid_key: bytes, sheath_flow: float, gas_pressure: float, gas_temp: float) -> Kernel:
+    return build_kernel(settings, geometry, numpy.frombuffer(voltages_key), numpy.frombuffer(grid_key), sheath_flow,
+                        gas_pressure, gas_temp)
+
+
+def get_kernel(inversion_conf: dict, dma_conf: dict, channel_voltages: numpy.ndarray, grid_d: numpy.ndarray,
+               sheath_flow: float, gas_pressure: float, gas_temp: float) -> Kernel:
+    """
+    Return the cached kernel of the channels' voltages and the inversion grid, gas state is rounded like in dma_physics
+    """
+
+    (state,), _ = dma_physics.group_gas_states(sheath_flow, gas_pressure, gas_temp)
+
+    return _cached_kernel(inversion_settings(inversion_conf), dma_physics.dma_geometry(dma_conf),
+                          numpy.ascontiguousarray(channel_voltages, dtype=float).tobytes(),
+                          numpy.ascontiguousarray(grid_d, dtype=float).tobytes(), *(float(value) for value in state))
+
+
+def solve(kernel: Kernel, concentrations: numpy.ndarray, settings: InversionSettings) -> numpy.ndarray:
+    """
+    Return the size distributions (dN/dlogDp) of the scans' channel concentrations, shape is (scans, grid)
+
+    Concentrations' shape is (scans, channels) or (channels,) for one scan, the result has the same number of
+    dimensions. Distributions of the scans with a missing (NaN) concentration are NaN
+    """
+
+    concentrations = numpy.asarray(concentrations, dtype=float)
+    measured = numpy.atleast_2d(concentrations)
+    distributions = numpy.full((len(measured), len(kernel.grid_d)), numpy.nan)
+    valid = numpy.all(numpy.isfinite(measured), axis=1)
+
+    # Scans are rows, so the gradient of the rows is x H - A^T y
+    data_term = measured[valid] @ kernel.matrix
+    distribution = numpy.maximum(data_term @ kernel.pseudo_inverse, 0.0)  # Clipped unconstrained solution
+    extrapolated = distribution
+    momentum = 1.0
+
+    iterations = 0
+    for iterations in range(1, settings.max_iterations + 1):
+        gradient = extrapolated @ kernel.normal_matrix - data_term
+        new_distribution = numpy.maximum(extrapolated - kernel.step * gradient, 0.0)
+        new_momentum = (1.0 + numpy.sqrt(1.0 + 4.0 * momentum * momentum)) / 2.0
+        extrapolated = new_distribution + (momentum - 1.0) / new_momentum * (new_distribution - distribution)
+
+        if iterations % CHECK_INTERVAL == 0:
+            change = numpy.max(numpy.abs(new_distribution - distribution), axis=1, initial=0.0)
+            scale = numpy.max(new_distribution, axis=1, initial=0.0)
+            if numpy.all(change <= settings.tolerance * scale):
+                distribution = new_distribution
+                break
+
+        distribution, momentum = new_distribution, new_momentum
+
+    logging.debug(f"Inverted {len(distribution)} scans in {iterations} iterations")
+    distributions[valid] = distribution
+
+    return distributions if concentrations.ndim > 1 else distributions[0]
+
+
+def invert_scans(inversion_conf: dict, dma_conf: dict, channel_voltages: numpy.ndarray, grid_d: numpy.ndarray,
+                 concentrations: numpy.ndarray, sheath_flow: typing.Union[float, numpy.ndarray],
+                 gas_pressure: typing.Union[float, numpy.ndarray],
+                 gas_temp: typing.Union[float, numpy.ndarray]) -> numpy.ndarray:
+    """
+    Return the size distributions (dN/dlogDp) of the scans on the grid, shape is (scans, grid)
+
+    Concentrations' shape is (scans, channels). Each scan has its own sheath flow, pressure and temperature or the same
+    ones are given for all the scans. Scans are grouped by the rounded gas state and each group is solved at once
+    """
+
+    settings = inversion_settings(inversion_conf)
+    concentrations = numpy.atleast_2d(numpy.asarray(concentrations, dtype=float))
+    states, inverse = dma_physics.group_gas_states(*numpy.broadcast_arrays(sheath_flow, gas_pressure, gas_temp,
+                                                                           numpy.zeros(len(concentrations)))[:3])
+    distributions = numpy.empty((len(concentrations), len(grid_d)))
+
+    for index, state in enumerate(states):
+        scans = inverse == index
+        kernel = get_kernel(inversion_conf, dma_conf, channel_voltages, grid_d, *state)
+        distributions[scans] = solve(kernel, concentrations[scans], settings)
+
+    return distributions
+
+
+def cache_info() -> typing.NamedTuple:
+    """
+    Return hits, misses and size of the kernel cache
+    """
+
+    return _cached_kernel.cache_info()
@@ -0,0 +1,280 @@
+"""
+Size distribution inversion in worker processes
+
+Inverting a scan in the measurement thread would delay the next scan and inverting it in the Tk thread would freeze
+the GUI, so the scans are inverted in child processes (python inversion_pool.py <worker>). Workers are started as
+scripts like the daq acquisition process, so they don't import main.py. Jobs and results are pickled through the
+workers' stdin and stdout. Each worker keeps its own kernel cache, so jobs of the same segment reuse the kernels.
+"""
+
+import logging
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import time
+import typing
+from threading import Lock, Thread
+
+import numpy
+
+import config
+import inversion
+
+WORKER_RESTARTS = 3  # Dead worker is restarted at most this many times, E.g. a job that crashes it
+
+
+class InversionJob(typing.NamedTuple):
+    """
+    Completed scan to be inverted, the bins are numpy arrays
+    """
+
+    scan_id: int
+    segment: str
+    time: str  # Local time when the scan was started
+    voltages: numpy.ndarray  # Bins' DMA voltages (V)
+    diameters: numpy.ndarray  # Bins' diameters (m), used as the inversion grid
+    concentrations: numpy.ndarray  # Bins' concentrations (1/cm^3)
+    sheath_flow: float  # Unit is L/min
+    temp: float  # Unit is °C
+    pressure: float  # Unit is kPa
+    submit_time: float  # time.monotonic() when the job was submitted
+
+
+class InversionResult(typing.NamedTuple):
+    job: InversionJob
+    distribution: typing.Optional[numpy.ndarray]  # dN/dlogDp at the job's diameters, None if the inversion failed
+    compute_time: float  # Time the inversion took (s)
+    latency: float  # Time from the submit to the result (s)
+
+
+def invert_job(inversion_conf: dict, dma_conf: dict, job: InversionJob) -> typing.Optional[numpy.ndarray]:
+    """
+    Return the job's size distribution or None if the inversion failed
+    """
+
+    try:
+        return inversion.invert_scans(inversion_conf, dma_conf, job.voltages, job.diameters,
+                                      job.concentrations[numpy.newaxis, :], job.sheath_flow, job.pressure,
+                                      job.temp)[0]
+    except (ValueError, ArithmeticError, numpy.linalg.LinAlgError) as e:
+        logging.error(e)
+        logging.debug(f"Failed to invert scan {job.scan_id} ({job.segment})")
+        return None
+
+
+class InversionPool:
+    """
+    Worker processes and a bounded queue of the jobs. Results are put to the results queue
+
+    Each worker has a dispatcher thread that gives it one job at a time. A worker that dies is restarted, after
+    WORKER_RESTARTS restarts its dispatcher stops. alive is False when no worker is left
+    """
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self.__workers = workers
+        self.__queue_size = queue_size  # Jobs waiting for a worker at most
+        self.__jobs = queue.Queue()  # Jobs waiting for a worker, None stops a dispatcher
+        self.results = queue.Queue()  # InversionResults
+        self.__processes = []  # Index = worker
+        self.__restarts = [0] * workers  # Index = worker
+        self.__dispatchers = []
+        self.__in_progress = 0  # Jobs given to the workers
+        self.__lock = Lock()  # Protects in_progress
+
+        logging.info("Created InversionPool")
+
+    def start(self) -> bool:
+        """
+        Start the worker processes. Return False if they could not be started
+        """
+
+        try:
+            for index in range(self.__workers):
+                self.__processes.append(self.__start_worker(index))
+        except OSError as e:
+            logging.error(e)
+            logging.debug("Failed to start the inversion workers")
+            self.stop()
+            return False
+
+        for index in range(self.__workers):
+            dispatcher = Thread(target=self.__dispatch, args=(index,), name=f"InversionDispatcher{index}", daemon=True)
+            dispatcher.start()
+            self.__dispatchers.append(dispatcher)
+
+        logging.info(f"Started {self.__workers} inversion workers "
+                     f"(pids {', '.join(str(process.pid) for process in self.__processes)})")
+        return True
+
+    def __start_worker(self, index: int) -> subprocess.Popen:
+        """
+        Start the worker's process. Raises OSError if it can't be started
+        """
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inversion_pool.py")
+        return subprocess.Popen([sys.executable, script, str(index), str(self.__restarts[index])],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self, timeout: float = 5.0) -> typing.List[InversionJob]:
+        """
+        Remove the waiting jobs, let the workers finish their jobs and stop them
+
+        Return the removed jobs
+        """
+
+        waiting = []
+        while True:
+            try:
+                job = self.__jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                waiting.append(job)
+        for _ in self.__dispatchers:
+            self.__jobs.put(None)
+        for dispatcher in self.__dispatchers:
+            dispatcher.join(timeout)
+
+        for process in self.__processes:
+            try:
+                process.stdin.close()  # Worker exits at the end of its input
+                process.wait(timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                logging.error("Inversion worker did not stop, killing it")
+                process.kill()
+                process.wait()
+        if self.__processes:
+            logging.info("Stopped inversion workers")
+        self.__processes = []
+        self.__dispatchers = []
+
+        return waiting
+
+    def submit(self, job: InversionJob) -> bool:
+        """
+        Queue the job. Return False if the queue is full
+        """
+
+        if self.__jobs.qsize() >= self.__queue_size:
+            return False
+
+        self.__jobs.put(job)
+        return True
+
+    @property
+    def alive(self) -> bool:
+        """
+        True if at least one worker is running
+        """
+
+        return any(dispatcher.is_alive() for dispatcher in self.__dispatchers)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Jobs waiting for a worker or being inverted
+        """
+
+        with self.__lock:
+            return self.__jobs.qsize() + self.__in_progress
+
+    def __restart_worker(self, index: int) -> bool:
+        """
+        Stop the worker's broken process and start a new one. Return False if the worker is not restarted
+        """
+
+        process = self.__processes[index]
+        process.kill()  # E.g. the worker wrote something else than a result and is still running
+        for pipe in (process.stdin, process.stdout):
+            try:
+                pipe.close()
+            except OSError:  # Unflushed job to a dead process
+                pass
+        logging.error(f"Inversion worker {index} stopped with exit code {process.wait()}, "
+                      f"see debug/inversion_worker_{index}.log")
+
+        if self.__restarts[index] >= WORKER_RESTARTS:
+            logging.error(f"Inversion worker {index} has been restarted {WORKER_RESTARTS} times, not restarting it")
+            return False
+
+        self.__restarts[index] += 1
+        try:
+            self.__processes[index] = self.__start_worker(index)
+        except OSError as e:
+            logging.error(e)
+            logging.debug(f"Failed to restart inversion worker {index}")
+            return False
+
+        logging.info(f"Restarted inversion worker {index} (pid {self.__processes[index].pid})")
+        return True
+
+    def __dispatch(self, index: int) -> None:
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+
+            process = self.__processes[index]
+            with self.__lock:
+                self.__in_progress += 1
+            try:
+                pickle.dump(job, process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+                process.stdin.flush()
+                distribution, compute_time = pickle.load(process.stdout)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logging.error(e)
+                logging.debug(f"Inversion worker {index} failed to invert scan {job.scan_id} ({job.segment})")
+                self.results.put(InversionResult(job, None, 0.0, time.monotonic() - job.submit_time))
+                if not self.__restart_worker(index):
+                    return
+                continue
+            finally:
+                with self.__lock:
+                    self.__in_progress -= 1
+
+            self.results.put(InversionResult(job, distribution, compute_time, time.monotonic() - job.submit_time))
+
+
+def main(index: int, restart: int) -> None:
+    """
+    Worker loop of the child process. Inverts the jobs from stdin and writes the results to stdout until stdin ends
+
+    Restarted worker appends to the log, so the log keeps the reason of the restart
+    """
+
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s",
+                        datefmt="%d.%m.%Y %H:%M:%S", filename=f"debug/inversion_worker_{index}.log",
+                        filemode="w" if restart == 0 else "a")
+
+    # Stdout is the result stream, anything printed goes to stderr
+    jobs = sys.stdin.buffer
+    results = sys.stdout.buffer
+    sys.stdout = sys.stderr
+
+    conf = config.Config()
+    inversion_conf = conf.get_configuration("Inversion")
+    dma_conf = conf.get_configuration("Dma")
+    logging.info(f"Started inversion worker (restart {restart})")
+
+    while True:
+        try:
+            job = pickle.load(jobs)
+        except EOFError:
+            break
+
+        try:
+            start_time = time.perf_counter()
+            distribution = invert_job(inversion_conf, dma_conf, job)
+        except Exception:
+            logging.exception(f"Inversion worker crashed on scan {job.scan_id} ({job.segment})")
+            raise
+        pickle.dump((distribution, time.perf_counter() - start_time), results, protocol=pickle.HIGHEST_PROTOCOL)
+        results.flush()
+
+    logging.info(f"Stopped inversion worker, kernel cache: {inversion.cache_info()}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,118 @@
+"""
+Mailboxes for sharing the latest values between the threads
+
+Producers (E.g. the pid thread's flow meter readings) overwrite the value and consumers read it without removing it, so
+the measurement thread and the GUI tabs don't take samples from each other.
+"""
+
+import math
+import typing
+from threading import Condition
+
+import clocks
+
+
+class Sample(typing.NamedTuple):
+    """
+    Value with its sequence number (0 = no value yet) and the clock's monotonic time when it was put or measured
+    """
+
+    value: typing.Any
+    seq: int
+    timestamp: float
+
+
+class LatestValue:
+    """
+    Holds the latest value put by the producer
+
+    Reads are not locked, put replaces the sample as a whole. Sequence numbers increase by one with every put, so a
+    consumer can wait for a value newer than the one it has already seen
+    """
+
+    def __init__(self, clock: clocks.Clock = None, poll_interval: float = 0.01,
+                 publish: typing.Callable[[typing.Any], None] = None) -> None:
+        self.__clock = clock if clock is not None else clocks.Clock()
+        self.__publish = publish  # Every value is also given to this, E.g. measurement_bus.MeasurementBus.publisher
+        self.__poll_interval = poll_interval  # Maximum real time between the checks when waiting (s)
+        self.__sample = Sample(None, 0, -math.inf)
+        self.__condition = Condition()  # Wakes up the waiting consumers
+
+    def put(self, value: typing.Any, timestamp: float = None) -> int:
+        """
+        Replace the value. Return its sequence number
+
+        timestamp is the clock's monotonic time of the value, E.g. when it was measured. None = now
+        """
+
+        with self.__condition:
+            self.__sample = Sample(value, self.__sample.seq + 1,
+                                   timestamp if timestamp is not None else self.__clock.monotonic())
+            self.__condition.notify_all()
+            seq = self.__sample.seq
+
+        if self.__publish is not None:
+            self.__publish(value)
+
+        return seq
+
+    def get(self, default: typing.Any = None) -> typing.Any:
+        """
+        Return the latest value or default if no value has been put
+        """
+
+        sample = self.__sample
+        return sample.value if sample.seq > 0 else default
+
+    def read(self) -> Sample:
+        """
+        Return the latest sample
+        """
+
+        return self.__sample
+
+    @property
+    def seq(self) -> int:
+        """
+        Sequence number of the latest value, 0 = no value yet
+        """
+
+        return self.__sample.seq
+
+    def wait_newer_than(self, seq: int, timeout: float = None) -> typing.Optional[Sample]:
+        """
+        Wait until a value newer than seq has been put and return its sample. wait_newer_than(0) waits for any value
+
+        Timeout (s) is measured with the clock. Return None if the timeout expires
+        """
+
+        deadline = self.__clock.monotonic() + timeout if timeout is not None else math.inf
+
+        while True:
+            sample = self.__sample
+            if sample.seq > seq:
+                return sample
+            if self.__clock.monotonic() >= deadline:
+                return None
+
+            if isinstance(self.__clock, clocks.VirtualClock):
+                # Virtual time only advances when the threads sleep on the clock
+                self.__clock.sleep(self.__poll_interval)
+            else:
+                with self.__condition:
+                    if self.__sample.seq <= seq:
+                        self.__condition.wait(self.__poll_interval)
+
+    def age(self) -> float:
+        """
+        Return seconds since the latest value was put, infinite if no value has been put
+        """
+
+        return self.__clock.monotonic() - self.__sample.timestamp
+
+    def is_stale(self, max_age: float) -> bool:
+        """
+        Return True if there is no value or the value is older than max_age (s)
+        """
+
+        return self.age() > max_age
@@ -7,15 +7,20 @@ E.g. Create flow_meter object with FlowMeter5000 class instead of FlowMeter4000
 """
 
 import logging
-import queue
 from multiprocessing import Lock
 
+import clocks
 import config
+import daq_process
 import detectors
 import flow_meters
+import mailboxes
+import measurement_bus
 import ni_daqs
+import serial_io
+import simulation
 from gui import main_window
-from threads import pid_ftp_thread, automatic_measurement, daq_thread, detector_thead
+from threads import pid_ftp_thread, automatic_measurement, daq_thread, detector_thead, inversion_thread
 
 # Set logging settings
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s",
@@ -24,27 +29,61 @@ logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %
 # Manages access to the config file and holds the config data
 conf = config.Config()
 
-# Create flow meter object
-flow_meter_4000 = flow_meters.FlowMeter4000(conf)
-
-# Create NI DAQ object
-daq = ni_daqs.NiDaq(conf)
-
-# Create CPC object
-cpc_3750 = detectors.CpcLegacy(conf)
-
-# Pid_ftp_thread outputs flow meter's ftp values to the queue. Dmps_measure_thread uses the queue to gets those values.
-# The Queue only holds one sample. Pid_ftp_thread will overwrite the sample if it is consumed.
-flow_meter_ftp_queue = queue.Queue(maxsize=1)
+# Serial I/O engine executes the cpc's and the flow meter's commands in one event loop thread if it is enabled
+serial_io_conf = conf.get_configuration("Serial_io")
+io_engine = None
+if serial_io_conf.get("enabled") == "1":
+    io_engine = serial_io.SerialIoEngine(float(serial_io_conf.get("poll_interval")))
+
+# Clock used for waiting and timing by the threads. Only the simulation can use a faster clock than the real time
+clock = clocks.Clock()
+
+sim_conf = conf.get_configuration("Simulation")
+if sim_conf.get("enabled") == "1":
+    if sim_conf.get("clock_mode") == "accelerated":
+        clock = clocks.AcceleratedClock(float(sim_conf.get("clock_speedup")))
+    elif sim_conf.get("clock_mode") == "virtual":
+        clock = clocks.VirtualClock()
+
+    # Use simulated devices instead of the real hardware. All the devices share the same simulated environment
+    environment = simulation.SimulatedEnvironment(conf, clock)
+    flow_meter_4000 = flow_meters.FlowMeter4000(conf, simulation.SimulatedFlowMeterSerial(conf, environment, clock),
+                                                clock, io_engine)
+    daq = simulation.SimulatedNiDaq(conf, environment, clock)
+    daq_acquisition = None  # Simulated environment is in this process
+    cpc_3750 = detectors.CpcLegacy(conf, simulation.SimulatedCpcSerial(conf, environment, clock), clock, io_engine)
+else:
+    # Create flow meter object
+    flow_meter_4000 = flow_meters.FlowMeter4000(conf, clock=clock, io_engine=io_engine)
+
+    # Analog inputs and the buffered counter are read in a separate process if it is enabled
+    daq_acquisition = None
+    timing_conf = conf.get_configuration("NI_DAQ_Timing")
+    if timing_conf.get("acquisition_process") == "1" and float(timing_conf.get("ai_sample_rate")) > 0:
+        daq_acquisition = daq_process.AcquisitionProcess(conf)
+        if not daq_acquisition.start():
+            logging.warning("Reading the daq in this process instead")
+            daq_acquisition = None
+
+    # Create NI DAQ object
+    daq = ni_daqs.NiDaq(conf, clock, daq_acquisition)
+
+    # Create CPC object
+    cpc_3750 = detectors.CpcLegacy(conf, clock=clock, io_engine=io_engine)
+
+# Measurement data is published to the bus. GUI tabs, file writers etc. subscribe to the topics they need and each
+# subscriber has its own bounded buffer
+bus = measurement_bus.MeasurementBus(clock)
+
+# Pid_ftp_thread puts flow meter's ftp values to the mailbox. Dmps_measure_thread and the gui read the latest values.
+# Reading does not remove the values, so the readers don't take values from each other. Values are published to the bus
+flow_meter_ftp = mailboxes.LatestValue(clock, publish=bus.publisher("ftp"))
 
 # AI voltages, constantly measured by daq thread
-daq_ai_queue = queue.Queue(maxsize=1)
-
-rd_queue = queue.Queue(maxsize=1)
+daq_ai = mailboxes.LatestValue(clock, publish=bus.publisher("ai"))
 
-# These queues are used to get data from automatic_measurement_thread to main_window.py
-hv_voltage_queue = queue.Queue()
-conc_queue = queue.Queue()
+# Cpc's RD, polled by the detector thread or the serial I/O engine
+rd = mailboxes.LatestValue(clock, publish=bus.publisher("cpc.rd"))
 
 # When lock is acquired any other thread that tries to acquire lock waits until first thread to acquire it releases it.
 # Used for E.g. Prevent trying to read flow meter's ftp value and changing its serial settings at the same time.
@@ -52,34 +91,54 @@ flow_meter_lock = Lock()  # Flow meter access lock
 daq_lock = Lock()
 detector_lock = Lock()
 
-# Create pid thread to control the blower
-blower_thread = pid_ftp_thread.BlowerPidThread(conf, daq, flow_meter_4000, flow_meter_ftp_queue, flow_meter_lock,
-                                               daq_lock, 5)
+# Create pid thread to control the blower. Daq's ai values are the pid's feedback if Pid:Daq_flow is enabled
+blower_thread = pid_ftp_thread.BlowerPidThread(conf, daq, flow_meter_4000, flow_meter_ftp, flow_meter_lock,
+                                               daq_lock, 5, clock, daq_ai)
 
 # Create daq thread to measure AI voltages
-daq_thread = daq_thread.DaqThread(daq, daq_ai_queue, daq_lock)
-
-cpc_thread = detector_thead.DetectorThead(cpc_3750, rd_queue, detector_lock)
-
-# Create dmps automatic measurement thread
-dmps_measure_thread = automatic_measurement.AutomaticMeasurementThread(conf, daq, flow_meter_4000, cpc_3750,
-                                                                       blower_thread, flow_meter_ftp_queue,
-                                                                       hv_voltage_queue, conc_queue, daq_ai_queue,
-                                                                       detector_lock, daq_lock)
+daq_thread = daq_thread.DaqThread(conf, daq, daq_ai, daq_lock, clock)
+
+# The engine polls RD itself, otherwise the detector thread reads it
+rd_poll_interval = float(conf.get_configuration("Cpc_Protocol").get("rd_poll_interval"))
+cpc_thread = None
+if io_engine is None:
+    cpc_thread = detector_thead.DetectorThead(cpc_3750, rd, rd_poll_interval, clock)
+
+if conf.get_configuration("Continuous_scan").get("enabled") == "1":
+    # Create smps continuous scan thread, it is controlled by the gui like the dmps measurement thread
+    dmps_measure_thread = automatic_measurement.ContinuousScanThread(conf, daq, blower_thread, flow_meter_ftp,
+                                                                     bus, daq_lock, clock)
+else:
+    # Create dmps automatic measurement thread
+    dmps_measure_thread = automatic_measurement.AutomaticMeasurementThread(conf, daq, flow_meter_4000, cpc_3750,
+                                                                           blower_thread, flow_meter_ftp,
+                                                                           bus, daq_ai,
+                                                                           detector_lock, daq_lock, clock)
+
+# Completed scans are inverted to size distributions in the background if the inversion is enabled
+scan_inversion_thread = None
+if conf.get_configuration("Inversion").get("enabled") == "1":
+    scan_inversion_thread = inversion_thread.InversionThread(conf, bus, clock)
 
 # Create the GUI main window
 gui = main_window.MainWindow(conf, daq, flow_meter_4000, cpc_3750, blower_thread, dmps_measure_thread,
-                             flow_meter_ftp_queue, hv_voltage_queue, conc_queue, daq_ai_queue, rd_queue,
+                             flow_meter_ftp, bus, daq_ai, rd,
                              flow_meter_lock, daq_lock, detector_lock)
 
 # Execute the program
 if __name__ == "__main__":  # Means that code is executed only if this file is run directly and not imported
     logging.info("Program started")
 
+    if io_engine is not None:
+        io_engine.start()  # Devices' commands queued before this are executed now
+        cpc_3750.start_rd_polling(rd, rd_poll_interval)
     blower_thread.start()  # Start the blower thread
     daq_thread.start()  # Start the daq thread
-    cpc_thread.start()
+    if cpc_thread is not None:
+        cpc_thread.start()
     dmps_measure_thread.start()  # Start the automatic measurement thread(doesn't start measuring automatically)
+    if scan_inversion_thread is not None:
+        scan_inversion_thread.start()
     gui.mainloop()  # Start TKinter loop for the gui
 
     # After GUI window is closed stop all the threads
@@ -87,16 +146,30 @@ if __name__ == "__main__":  # Means that code is executed only if this file is r
     blower_thread.join()  # Wait for thread to terminate
     daq_thread.stop = True
     daq_thread.join()
-    cpc_thread.stop = True
-    cpc_thread.join()
+    if cpc_thread is not None:
+        cpc_thread.stop = True
+        cpc_thread.join()
     dmps_measure_thread.stop = True
     dmps_measure_thread.join()
+    if scan_inversion_thread is not None:  # Stopped after the measurement, so it gets the last scan
+        scan_inversion_thread.stop = True
+        scan_inversion_thread.join()
+
+    cpc_3750.get_latency_stats().log_summary()
+    blower_thread.log_timing()
+    if scan_inversion_thread is not None:
+        scan_inversion_thread.log_timing()
+    bus.log_stats()
 
     # Ensure that all tasks are closed
     daq.close_tasks()
+    if daq_acquisition is not None:
+        daq_acquisition.stop()
 
     # Ensure that all serial connections are closed
     cpc_3750.close_ser_connection()
     flow_meter_4000.close_ser_connection()
+    if io_engine is not None:
+        io_engine.stop()
 
     logging.info("Closed the GUI")
@@ -0,0 +1,164 @@
+"""
+In-process publish/subscribe bus for the measurement data
+
+Producers publish messages to topics and every subscriber gets its own bounded buffer of the topics it subscribed, so
+the GUI, file writers or a network exporter don't need to know about each other. A slow or stopped subscriber only
+loses its own messages, it can't make the memory grow or block the producers.
+"""
+
+import collections
+import functools
+import logging
+import typing
+from threading import Condition, Lock
+
+import clocks
+
+# Topics published by the program
+TOPICS = ("ai",  # Daq's AI voltages (list, index = channel)
+          "ftp",  # Flow meter's (flow, temp, pressure)
+          "cpc.rd",  # Cpc's 1 s average concentration
+          "bin",  # One measured voltage of a scan (dict)
+          "scan",  # Segment's or continuous scan's all bins after the scan has ended (dict)
+          "total",  # Total concentration measurement (dict)
+          "size_distribution")  # Inverted size distribution of a scan (dict)
+
+# What a full buffer does with a new message
+DROP_POLICIES = ("oldest",  # Drop the oldest message in the buffer
+                 "newest")  # Drop the new message
+
+
+class Message(typing.NamedTuple):
+    topic: str
+    value: typing.Any
+    seq: int  # Increases by one with every message published to the bus
+    timestamp: float  # Clock's monotonic time when the message was published
+
+
+class Subscription:
+    """
+    Bounded buffer of a subscriber. Created with MeasurementBus.subscribe
+    """
+
+    def __init__(self, name: str, topics: typing.Iterable[str], size: int, drop_policy: str) -> None:
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy: {drop_policy}")
+
+        self.name = name
+        self.topics = frozenset(topics)
+        self.__size = size
+        self.__drop_policy = drop_policy
+        self.__messages = collections.deque()
+        self.__condition = Condition()
+        self.received = 0  # Messages put to the buffer
+        self.dropped = 0  # Messages lost because the buffer was full
+
+    def _deliver(self, message: Message) -> None:
+        """
+        Put the message to the buffer. Called by the bus
+        """
+
+        with self.__condition:
+            if len(self.__messages) >= self.__size:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logging.warning(f"Subscriber {self.name} has dropped {self.dropped} messages")
+                if self.__drop_policy == "newest":
+                    return
+                self.__messages.popleft()
+
+            self.__messages.append(message)
+            self.received += 1
+            self.__condition.notify_all()
+
+    def get(self, timeout: float = 0.0) -> typing.Optional[Message]:
+        """
+        Return the oldest message in the buffer. Wait at most timeout (s, real time, None = forever) for a message,
+        return None if there is none
+        """
+
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: len(self.__messages) > 0, timeout):
+                return None
+            return self.__messages.popleft()
+
+    def get_all(self) -> typing.List[Message]:
+        """
+        Return and remove all the messages in the buffer
+        """
+
+        with self.__condition:
+            messages = list(self.__messages)
+            self.__messages.clear()
+            return messages
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+
+class MeasurementBus:
+    """
+    Delivers the published messages to the subscribers of the topic
+    """
+
+    def __init__(self, clock: clocks.Clock = None) -> None:
+        self.__clock = clock if clock is not None else clocks.Clock()
+        self.__subscriptions = []
+        self.__seq = 0
+        self.__lock = Lock()  # Protects the subscriptions and the sequence number
+
+        logging.info("Created MeasurementBus")
+
+    def subscribe(self, name: str, topics: typing.Iterable[str], size: int = 1000,
+                  drop_policy: str = "oldest") -> Subscription:
+        """
+        Return a new subscription to the topics whose buffer holds size messages
+        """
+
+        subscription = Subscription(name, topics, size, drop_policy)
+        unknown = subscription.topics.difference(TOPICS)
+        if unknown:
+            logging.warning(f"Subscriber {name} subscribed to unknown topics: {', '.join(sorted(unknown))}")
+
+        with self.__lock:
+            self.__subscriptions.append(subscription)
+        logging.info(f"{name} subscribed to {', '.join(sorted(subscription.topics))}")
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.__lock:
+            if subscription in self.__subscriptions:
+                self.__subscriptions.remove(subscription)
+
+    def publish(self, topic: str, value: typing.Any) -> None:
+        """
+        Deliver the value to the topic's subscribers
+        """
+
+        with self.__lock:
+            self.__seq += 1
+            message = Message(topic, value, self.__seq, self.__clock.monotonic())
+            subscriptions = [subscription for subscription in self.__subscriptions if topic in subscription.topics]
+
+        for subscription in subscriptions:
+            subscription._deliver(message)
+
+    def publisher(self, topic: str) -> typing.Callable[[typing.Any], None]:
+        """
+        Return a function that publishes its argument to the topic, E.g. for mailboxes.LatestValue
+        """
+
+        return functools.partial(self.publish, topic)
+
+    def log_stats(self) -> None:
+        """
+        Log received and dropped message counts of the subscribers
+        """
+
+        with self.__lock:
+            subscriptions = list(self.__subscriptions)
+
+        for subscription in subscriptions:
+            logging.info(f"Subscriber {subscription.name}: received {subscription.received}, "
+                         f"dropped {subscription.dropped}, buffered {len(subscription)}")
@@ -3,38 +3,208 @@ This module provides functionality for National Instruments data acquisition dev
 """
 
 import logging
+import time
+import typing  # Used for providing tuple type hint
 
 import nidaqmx
-from nidaqmx.constants import AcquisitionType
+import numpy
+from nidaqmx.constants import AcquisitionType, SampleTimingType
+from nidaqmx.stream_readers import AnalogMultiChannelReader, CounterReader
 from nidaqmx.stream_writers import CounterWriter
 
+import clocks
 import config
 
+if typing.TYPE_CHECKING:
+    import daq_process
+
+
+class AiBlock(typing.NamedTuple):
+    """
+    Block of analog input samples measured with the daq's sample clock
+    """
+
+    start_time: float  # Time of the first sample (s since the epoch)
+    sample_period: float  # Time between the samples (s)
+    voltages: numpy.ndarray  # Shape is (channels, samples). voltages[0] is the lowest ai channel
+
+
+def scaling_coefficients(conf: config.Config, name: str) -> typing.Tuple[float, float]:
+    """
+    Return slope and intercept (m, b) of the linear scaling y = m*x + b for the sensor "name" from the ini file.
+    E.g. "rh" scales the relative humidity sensor's voltage to %
+
+    Raises ValueError if the scaling values in the ini file are not numbers
+    """
+
+    section = "NI_DAQ:Scaling"
+    x1 = float(conf.read(section, f"{name}_v_min"))
+    x2 = float(conf.read(section, f"{name}_v_max"))
+    y1 = float(conf.read(section, f"{name}_value_min"))
+    y2 = float(conf.read(section, f"{name}_value_max"))
+    m = (y1 - y2) / (x1 - x2)
+    b = (x1 * y2 - x2 * y1) / (x1 - x2)
+
+    return m, b
+
+
+def staircase_steps(settle_time: float, count_time: float, rate: float) -> typing.Tuple[int, int]:
+    """
+    Return a voltage staircase's settle samples and step samples (settle + count) at the sample rate (Hz)
+    """
+
+    settle_samples = round(settle_time * rate)
+    return settle_samples, settle_samples + max(round(count_time * rate), 1)
+
+
+def staircase_windows(start: typing.Tuple[int, int], steps: int, settle_samples: int,
+                      step_samples: int) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Return the counting windows (start sample, end sample) of the staircase's steps. start is the waveform's earliest
+    start sample and its start window (samples) from NiDaq's waveform start
+    """
+
+    first_sample, start_window = start
+    # Steps can start up to start_window samples after the windows' positions, so that time is settle time too
+    if start_window > settle_samples:
+        logging.warning(f"Staircase's start is known within {start_window} samples, longer than the settle time "
+                        f"({settle_samples} samples). Counting windows are shortened")
+    settle_samples = min(max(settle_samples, start_window), step_samples - 1)
+
+    return [(first_sample + i * step_samples + settle_samples, first_sample + (i + 1) * step_samples)
+            for i in range(steps)]
+
+
+def ramp_waveform(start_voltage: float, end_voltage: float, ramp_time: float, rate: float) -> numpy.ndarray:
+    """
+    Return the voltages of an exponential ramp from start_voltage to end_voltage in ramp_time (s) at the sample rate
+    (Hz). Voltage of sample i is start_voltage * (end_voltage / start_voltage) ** (i / samples)
+    """
+
+    samples = max(round(ramp_time * rate), 1)
+    return start_voltage * (end_voltage / start_voltage) ** (numpy.arange(samples) / samples)
+
+
+def ramp_samples(start: typing.Tuple[int, int], samples: int) -> typing.Tuple[int, int]:
+    """
+    Return the ramp's (start sample, end sample). start is the waveform's earliest start sample and its start window
+    """
+
+    # Middle of the start window, so the samples' voltages are off by half of the window at most
+    first_sample = start[0] + start[1] // 2
+    return first_sample, first_sample + samples
+
+
+class CounterHistory:
+    """
+    Counts of the buffered counter task per sample clock interval. Holds the latest size intervals
+
+    Samples are numbered from the start of the acquisition, so positions taken at different times can be compared
+    """
+
+    def __init__(self, size: int) -> None:
+        self.__counts = numpy.zeros(size, dtype=numpy.int64)  # Ring buffer
+        self.samples = 0  # Number of intervals added since the start
+        self.total = 0  # Counts added since the start
+
+    def add(self, interval_counts: numpy.ndarray) -> None:
+        """
+        Add counts of consecutive sample clock intervals
+        """
+
+        indexes = (self.samples + numpy.arange(len(interval_counts))) % len(self.__counts)
+        self.__counts[indexes] = interval_counts
+        self.samples += len(interval_counts)
+        self.total += int(interval_counts.sum())
+
+    def interval_counts(self, start_sample: int, end_sample: int) -> numpy.ndarray:
+        """
+        Return counts of the intervals start_sample...end_sample - 1. Intervals that are not in the history anymore or
+        are not measured yet are left out
+        """
+
+        start_sample = max(start_sample, self.samples - len(self.__counts), 0)
+        end_sample = min(end_sample, self.samples)
+        indexes = numpy.arange(start_sample, end_sample) % len(self.__counts)
+
+        return self.__counts[indexes]
+
 
 class NiDaq:
     """
     This class is used for reading and writing data to/from NI DAQ. It is tested to work with NI6211
     """
 
-    def __init__(self, conf: config.Config) -> None:
+    def __init__(self, conf: config.Config, clock: clocks.Clock = None,
+                 acquisition: "daq_process.AcquisitionProcess" = None, output_tasks: bool = True) -> None:
         self.__conf = conf
         self.__nidaq_conf = self.__conf.get_configuration("NI_DAQ")  # Get configuration dict
         self.__scaling_conf = self.__conf.get_configuration("NI_DAQ_Scaling")  # Get scaling dict
+        self.__timing_conf = self.__conf.get_configuration("NI_DAQ_Timing")  # Get sample clock settings dict
+        self.__clock = clock if clock is not None else clocks.Clock()  # Used for the sample timestamps
+
+        # If the acquisition process is given, it has the buffered analog input and counter tasks and this object reads
+        # them from its shared memory. The acquisition process itself creates the daq without the output tasks
+        self.__acquisition = acquisition
+        self.__output_tasks = output_tasks
+
+        # Buffered (sample clocked) analog input. Set when the ai task is created
+        self.__ai_reader = None
+        self.__ai_buffer = None  # Preallocated buffer for the blocks
+        self.__ai_start_time = 0.0  # Time when the buffered acquisition was started
+        self.__ai_samples_read = 0  # Samples per channel read since the start
+        self.__ai_latest = None  # Mean voltages of the latest block
+
+        # Buffered counter, sampled with the same sample clock as the analog inputs. Set when the counter task is
+        # created
+        self.__ctr_reader = None
+        self.__ctr_buffer = None  # Preallocated buffer for the cumulative counts
+        self.__ctr_last_raw = 0  # Last cumulative count read from the daq
+        self.__ctr_history = None
+        self.__ctr_rst_position = (0, 0)  # Position when rst_ctr_task was used last time
+
+        self.__create_tasks()
+
+        logging.info("Created NiDaq object")
 
-        self.__ai_task = self.__create_ai_task()  # Analog input task
-        self.__ao_task = self.__create_ao_task()  # Analog output task
+    def __create_tasks(self) -> None:
+        """
+        Create the tasks this object uses. Task attributes that are not used are None
+        """
 
-        # Get line numbers and create tasks for the valves
-        # TODO: This could be done with only one task containing virtual tasks(?)
-        conc_line = self.__nidaq_conf.get("conc_line_chan")
-        bypass_line = self.__nidaq_conf.get("bypass_line_chan")
-        self.conc_valve_task = self.__create_do_task(conc_line)  # Task to control total concentration valve
-        self.bypass_valve_task = self.__create_do_task(bypass_line)  # Task to control sample flow bypass valve
+        self.__ai_task = None
+        self.__ao_task = None
+        self.conc_valve_task = None
+        self.bypass_valve_task = None
+        self.__counter_task = None
+        self.__pulse_task = None
 
-        self.__counter_task = self.__create_counter_task()
-        self.__pulse_task = self.__create_pulse_task()
+        if self.__acquisition is None:
+            self.__ai_task = self.__create_ai_task()  # Analog input task
 
-        logging.info("Created NiDaq object")
+        if self.__output_tasks:
+            self.__ao_task = self.__create_ao_task()  # Analog output task
+
+            # Get line numbers and create tasks for the valves
+            # TODO: This could be done with only one task containing virtual tasks(?)
+            conc_line = self.__nidaq_conf.get("conc_line_chan")
+            bypass_line = self.__nidaq_conf.get("bypass_line_chan")
+            self.conc_valve_task = self.__create_do_task(conc_line)  # Task to control total concentration valve
+            self.bypass_valve_task = self.__create_do_task(bypass_line)  # Task to control sample flow bypass valve
+
+        # Acquisition process has the buffered counter, the counter that is restarted for every count stays here.
+        # Only one task can reserve the counter, so the acquisition process itself creates only the buffered one
+        ctr_buffered = self.__timing_conf.get("ctr_buffered") == "1"
+        if self.__acquisition is not None:
+            create_counter = not ctr_buffered
+        else:
+            create_counter = self.__output_tasks or ctr_buffered
+        if create_counter:
+            self.__counter_task = self.__create_counter_task()
+        if self.__output_tasks:
+            self.__pulse_task = self.__create_pulse_task()
+        if self.__ai_task is not None:
+            self.__start_ai_task()  # Buffered counter is armed before, so it counts from the first sample clock tick
 
     def __create_ai_task(self) -> nidaqmx.Task:
         """
@@ -62,8 +232,41 @@ class NiDaq:
             logging.debug("Can't create ai task. Check device id and ai channel settings from the ini file")
             ai_task.close()
 
+        # Sample the inputs continuously with the daq's sample clock if the sample rate is set
+        self.__ai_reader = None
+        if self.ai_buffered():
+            rate = float(self.__timing_conf.get("ai_sample_rate"))
+            block_size = int(self.__timing_conf.get("ai_block_size"))
+            try:
+                # Daq's buffer holds 10 blocks, so the reads can be late without losing samples
+                ai_task.timing.cfg_samp_clk_timing(rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                                   samps_per_chan=10 * block_size)
+                self.__ai_reader = AnalogMultiChannelReader(ai_task.in_stream)
+                self.__ai_buffer = numpy.zeros((int(ai_max) - int(ai_min) + 1, block_size))
+                logging.info(f"Configured buffered ai acquisition at {rate} Hz")
+            except nidaqmx.DaqError as e:
+                logging.error(e)
+                logging.debug("Can't configure buffered ai acquisition. Check ai sample clock settings from ini file")
+
         return ai_task
 
+    def __start_ai_task(self) -> None:
+        """
+        Start the buffered analog input acquisition. Its sample clock also clocks the buffered counter
+        """
+
+        if self.__ai_reader is None:
+            return
+
+        try:
+            self.__ai_task.start()
+            self.__ai_start_time = self.__clock.time()
+            self.__ai_samples_read = 0
+            logging.info("Started buffered ai acquisition")
+        except nidaqmx.DaqError as e:
+            logging.error(e)
+            logging.debug("Buffered ai acquisition failed to start!")
+
     def __create_ao_task(self) -> nidaqmx.Task:
         """
         Create analog output task to write analog output voltage
@@ -139,6 +342,26 @@ class NiDaq:
             logging.debug("Can't create counter task. Check counter settings from the ini file")
             counter_task.close()
 
+        # Latch the count on every tick of the sample clock, so one continuously running task gives counts per interval
+        self.__ctr_reader = None
+        if self.ai_buffered() and self.__timing_conf.get("ctr_buffered") == "1" and self.__acquisition is None:
+            rate = float(self.__timing_conf.get("ai_sample_rate"))
+            block_size = int(self.__timing_conf.get("ai_block_size"))
+            sample_clock = self.__timing_conf.get("ctr_sample_clock")
+            try:
+                counter_task.timing.cfg_samp_clk_timing(rate, source=f"/Dev{device_id}/{sample_clock}",
+                                                        sample_mode=AcquisitionType.CONTINUOUS,
+                                                        samps_per_chan=10 * block_size)
+                self.__ctr_reader = CounterReader(counter_task.in_stream)
+                self.__ctr_buffer = numpy.zeros(block_size, dtype=numpy.uint32)
+                self.__ctr_last_raw = 0
+                self.__ctr_history = CounterHistory(int(self.__timing_conf.get("ctr_history_size")))
+                self.__ctr_rst_position = (0, 0)
+                logging.info(f"Configured buffered counter with sample clock {sample_clock}")
+            except nidaqmx.DaqError as e:
+                logging.error(e)
+                logging.debug("Can't configure buffered counter. Check counter sample clock settings from the ini file")
+
         try:
             counter_task.start()
             logging.info("Started counter task")
@@ -188,19 +411,24 @@ class NiDaq:
         """
 
         # TODO: Catch warning message if tasks were already closed
-        self.__ai_task.close()
-        self.__ao_task.close()
-        self.bypass_valve_task.close()
-        self.conc_valve_task.close()
-        self.__counter_task.close()
-        self.__pulse_task.close()
+        for task in (self.__ai_task, self.__ao_task, self.bypass_valve_task, self.conc_valve_task,
+                     self.__counter_task, self.__pulse_task):
+            if task is not None:  # Tasks of the acquisition process or the output tasks are not in every object
+                task.close()
         logging.info("Closed all NIDAQ tasks")
 
     def rst_ctr_task(self) -> None:
         """
         Reset counter task counter
+
+        Buffered counter is not restarted, the counts are counted from the current position instead
         """
 
+        if self.ctr_buffered():
+            self.__ctr_rst_position = self.get_ctr_position()
+            logging.info("Counter task reset successfully")
+            return
+
         try:
             self.__counter_task.stop()
         except nidaqmx.DaqError as e:
@@ -221,6 +449,11 @@ class NiDaq:
         Return None if read failed
         """
 
+        if self.ctr_buffered():
+            counts = self.get_ctr_position()[1] - self.__ctr_rst_position[1]
+            logging.info(f"Counter task read: {counts}")
+            return counts
+
         counts = None
         try:
             counts = self.__counter_task.read()
@@ -231,11 +464,131 @@ class NiDaq:
         logging.info(f"Counter task read: {counts}")
         return counts
 
+    def ai_buffered(self) -> bool:
+        """
+        Return True if analog inputs are sampled continuously with the daq's sample clock
+        """
+
+        return float(self.__timing_conf.get("ai_sample_rate")) > 0.0
+
+    def ai_samples_available(self) -> int:
+        """
+        Return number of buffered analog input samples per channel that can be read
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.ai_samples_available()
+
+        try:
+            return self.__ai_task.in_stream.avail_samp_per_chan
+        except nidaqmx.DaqError as e:
+            logging.error(e)
+            logging.debug("Failed to read available ai samples")
+            return 0
+
+    def read_ai_block(self) -> AiBlock:
+        """
+        Read one block of buffered analog input samples. Waits until the whole block is measured
+
+        Return None if read failed
+        """
+
+        if self.__acquisition is not None:
+            block = self.__acquisition.read_ai_block()
+            if block is not None:
+                self.__ai_latest = block.voltages.mean(axis=1).tolist()
+            return block
+
+        block = None
+        try:
+            samples = self.__ai_buffer.shape[1]
+            self.__ai_reader.read_many_sample(self.__ai_buffer, number_of_samples_per_channel=samples)
+            sample_period = 1.0 / float(self.__timing_conf.get("ai_sample_rate"))
+            start_time = self.__ai_start_time + self.__ai_samples_read * sample_period
+            self.__ai_samples_read += samples
+
+            # The buffer is reused in the next read
+            block = AiBlock(start_time, sample_period, self.__ai_buffer.copy())
+            self.__ai_latest = block.voltages.mean(axis=1).tolist()
+        except (nidaqmx.DaqError, AttributeError) as e:
+            logging.error(e)
+            logging.debug("Failed to read buffered analog input voltages")
+
+        return block
+
+    def ctr_buffered(self) -> bool:
+        """
+        Return True if the counter is latched with the analog inputs' sample clock
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.ctr_buffered()
+
+        return self.__ctr_reader is not None
+
+    def read_ctr_block(self) -> numpy.ndarray:
+        """
+        Read one block (same size as the ai block) of the buffered counter and add it to the counter history.
+        Waits until the whole block is measured
+
+        Return counts per sample clock interval or None if read failed
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.read_ctr_block()
+
+        interval_counts = None
+        try:
+            samples = len(self.__ctr_buffer)
+            self.__ctr_reader.read_many_sample_uint32(self.__ctr_buffer, number_of_samples_per_channel=samples)
+            # Daq gives cumulative 32 bit counts, take the differences and handle the rollover
+            cumulative = self.__ctr_buffer.astype(numpy.int64)
+            interval_counts = numpy.diff(cumulative, prepend=self.__ctr_last_raw) % 2 ** 32
+            self.__ctr_last_raw = int(cumulative[-1])
+            self.__ctr_history.add(interval_counts)
+        except (nidaqmx.DaqError, AttributeError) as e:
+            logging.error(e)
+            logging.debug("Failed to read buffered counter")
+
+        return interval_counts
+
+    def get_ctr_position(self) -> typing.Tuple[int, int]:
+        """
+        Return number of sample clock ticks read and total counts since the start of the buffered counter
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.get_ctr_position()
+
+        return self.__ctr_history.samples, self.__ctr_history.total
+
+    def get_ctr_interval_counts(self, start_sample: int, end_sample: int) -> numpy.ndarray:
+        """
+        Return counts of each sample clock interval from start_sample to end_sample (exclusive)
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.get_ctr_interval_counts(start_sample, end_sample)
+
+        return self.__ctr_history.interval_counts(start_sample, end_sample)
+
+    def get_sample_period(self) -> float:
+        """
+        Return time between the sample clock ticks (s)
+        """
+
+        return 1.0 / float(self.__timing_conf.get("ai_sample_rate"))
+
     def measure_ai(self) -> list:
         """
         Reads analog input signals (voltages) from the DAQ
+
+        With buffered acquisition return mean voltages of the latest block
         """
 
+        if self.ai_buffered():
+            return self.__ai_latest
+
         try:
             ai_voltages = self.__ai_task.read()  # Voltages are ordered so that voltages[0] is ai0's voltage
             return ai_voltages
@@ -257,6 +610,112 @@ class NiDaq:
             logging.error(e)
             logging.debug("Failed to write analog output voltage")
 
+    def ai_samples_acquired(self, read_after: float = 0.0) -> int:
+        """
+        Return number of analog input samples the daq has acquired. The analog output waveforms are clocked by the same
+        sample clock, so this is the sample of the next output voltage
+
+        Acquisition process reads the count periodically. read_after (time.time()) waits for a count it read after that
+        """
+
+        if self.__acquisition is not None:
+            return self.__acquisition.ai_samples_acquired(read_after)
+        return self.__ai_task.in_stream.total_samp_per_chan_acquired
+
+    def __start_ao_waveform(self, voltages: numpy.ndarray) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Write the voltages as one buffered analog output waveform, one voltage per the analog inputs' sample clock tick
+
+        Sample clock can tick while the task starts, so the start is known within a window. Return the earliest analog
+        input sample when the waveform can start and the window's length (samples) or None if the waveform could not be
+        started
+        """
+
+        device_id = self.__nidaq_conf.get("device_id")
+        rate = float(self.__timing_conf.get("ai_sample_rate"))
+
+        try:
+            # Scale all the voltages to the daq's output voltages at once
+            m, b = scaling_coefficients(self.__conf, "hvo")
+            waveform = m * voltages + b
+
+            self.__ao_task.timing.cfg_samp_clk_timing(rate, source=f"/Dev{device_id}/ai/SampleClock",
+                                                      sample_mode=AcquisitionType.FINITE,
+                                                      samps_per_chan=len(waveform))
+            self.__ao_task.write(waveform, auto_start=False)
+            # First voltage is output on the first sample clock tick after the start, which is between these counts
+            before_start = self.ai_samples_acquired()
+            self.__ao_task.start()
+            after_start = self.ai_samples_acquired(read_after=time.time())
+            return before_start, after_start - before_start
+        except (nidaqmx.DaqError, ValueError) as e:
+            logging.error(e)
+            logging.debug("Failed to start the analog output waveform")
+            self.stop_ao_waveform()
+            return None
+
+    def start_voltage_staircase(self, voltages: list, settle_time: float,
+                                count_time: float) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Write all the voltages as one buffered analog output waveform. The daq steps through the voltages with the
+        analog inputs' sample clock. Every voltage is held for settle_time + count_time (s)
+
+        Requires the buffered counter, so the counts are sampled with the same clock.
+        Return counting windows for each voltage as (start sample, end sample) of the counter history
+        or empty list if the staircase could not be started
+        """
+
+        if not self.ctr_buffered():
+            logging.error("Voltage staircase requires the buffered analog inputs and counter")
+            return []
+
+        settle_samples, step_samples = staircase_steps(settle_time, count_time,
+                                                       float(self.__timing_conf.get("ai_sample_rate")))
+
+        start = self.__start_ao_waveform(numpy.repeat(numpy.asarray(voltages, dtype=float), step_samples))
+        if start is None:
+            return []
+        logging.info(f"Started voltage staircase of {len(voltages)} steps")
+
+        return staircase_windows(start, len(voltages), settle_samples, step_samples)
+
+    def start_voltage_ramp(self, start_voltage: float, end_voltage: float,
+                           ramp_time: float) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Ramp the voltage exponentially from start_voltage to end_voltage in ramp_time (s) as a buffered analog output
+        waveform. Voltage of sample i is start_voltage * (end_voltage / start_voltage) ** (i / samples)
+
+        Requires the buffered counter. Return the ramp as (start sample, end sample) of the counter history
+        or None if the ramp could not be started
+        """
+
+        if not self.ctr_buffered():
+            logging.error("Voltage ramp requires the buffered analog inputs and counter")
+            return None
+
+        waveform = ramp_waveform(start_voltage, end_voltage, ramp_time, float(self.__timing_conf.get("ai_sample_rate")))
+
+        start = self.__start_ao_waveform(waveform)
+        if start is None:
+            return None
+        logging.info(f"Started voltage ramp from {start_voltage:.1f} V to {end_voltage:.1f} V (start known within "
+                     f"{start[1]} samples)")
+
+        return ramp_samples(start, len(waveform))
+
+    def stop_ao_waveform(self) -> None:
+        """
+        Stop the voltage staircase or ramp and return the analog output to on demand writes used by set_ao
+        """
+
+        try:
+            self.__ao_task.stop()
+            self.__ao_task.timing.samp_timing_type = SampleTimingType.ON_DEMAND
+            logging.info("Stopped analog output waveform")
+        except nidaqmx.DaqError as e:
+            logging.error(e)
+            logging.debug("Failed to stop the analog output waveform")
+
     def scale_value(self, name: str, volt: float) -> float:
         """
         Converts value from an undesired unit(voltage) to a desired unit(E.g. L/min)
@@ -265,18 +724,10 @@ class NiDaq:
         Return the scaled value
         """
 
-        section = "NI_DAQ:Scaling"
         try:
             # y = m*x + b
-            x = volt
-            x1 = float(self.__conf.read(section, f"{name}_v_min"))
-            x2 = float(self.__conf.read(section, f"{name}_v_max"))
-            y1 = float(self.__conf.read(section, f"{name}_value_min"))
-            y2 = float(self.__conf.read(section, f"{name}_value_max"))
-            m = (y1 - y2) / (x1 - x2)
-            b = (x1 * y2 - x2 * y1) / (x1 - x2)
-
-            scaled_value = m * x + b
+            m, b = scaling_coefficients(self.__conf, name)
+            scaled_value = m * volt + b
 
         except ValueError as e:
             logging.error(e)
@@ -305,21 +756,14 @@ class NiDaq:
         # Update confs
         self.__conf.update_configuration(self.__nidaq_conf, "NI_DAQ")
         self.__conf.update_configuration(self.__scaling_conf, "NI_DAQ:Scaling")
+        self.__conf.update_configuration(self.__timing_conf, "NI_DAQ:Timing")
 
         # Update tasks
         self.close_tasks()
+        if self.__acquisition is not None:
+            logging.warning("Acquisition process keeps its settings until the program is restarted")
         try:
-            self.__ai_task = self.__create_ai_task()  # Analog input task
-            self.__ao_task = self.__create_ao_task()  # Analog output task
-
-            # Get line numbers and create tasks for the valves
-            conc_line = self.__nidaq_conf.get("conc_line_chan")
-            bypass_line = self.__nidaq_conf.get("bypass_line_chan")
-            self.conc_valve_task = self.__create_do_task(conc_line)  # Task to control total concentration valve
-            self.bypass_valve_task = self.__create_do_task(bypass_line)  # Task to control sample flow bypass valve
-
-            self.__counter_task = self.__create_counter_task()
-            self.__pulse_task = self.__create_pulse_task()
+            self.__create_tasks()
         except nidaqmx.DaqError as e:
             logging.error(e)
             logging.debug("Failed to update NIDAQ tasks")
@@ -0,0 +1,85 @@
+"""
+Deadline based periodic execution of the control loops
+"""
+
+import logging
+import math
+
+import clocks
+import timing_stats
+
+# Bins (s) of the period jitter histogram
+JITTER_EDGES = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+class DeadlineScheduler:
+    """
+    Paces a loop to the absolute deadlines start + n / rate, so the loop's run time does not make the period drift
+
+    A cycle that ends after the next deadline is an overrun. The deadlines it missed are skipped and counted instead of
+    running the late cycles back to back. Lateness of the wake ups and the period jitter (difference of the time between
+    two wake ups from the time between their deadlines) are recorded. Rate 0 = no pacing, the loop runs as fast as it
+    can
+    """
+
+    def __init__(self, name: str, rate: float, clock: clocks.Clock = None) -> None:
+        self.__name = name
+        self.__clock = clock if clock is not None else clocks.Clock()
+        self.__period = 1.0 / rate if rate > 0 else 0.0
+        self.__deadline = self.__clock.monotonic()  # Deadline of the current cycle
+        self.__last_lateness = None  # Lateness of the previous wake up
+
+        self.cycles = 0
+        self.overruns = 0  # Cycles that did not end before the next deadline
+        self.skipped = 0  # Deadlines skipped because of the overruns
+        self.stats = timing_stats.LatencyStats(name, log_interval=0)
+        self.jitter = timing_stats.Histogram(f"{name} period jitter", JITTER_EDGES)
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Change the rate (Hz). Deadlines continue from the current cycle
+        """
+
+        self.__period = 1.0 / rate if rate > 0 else 0.0
+
+    def start(self) -> None:
+        """
+        Start the deadlines from now
+        """
+
+        self.__deadline = self.__clock.monotonic()
+        self.__last_lateness = None
+
+    def wait(self) -> None:
+        """
+        End the cycle and sleep until the next deadline
+        """
+
+        self.cycles += 1
+        if self.__period == 0.0:
+            return
+
+        deadline = self.__deadline + self.__period
+        now = self.__clock.monotonic()
+        if now >= deadline:
+            # Skip to the first deadline that is still ahead
+            missed = math.floor((now - deadline) / self.__period) + 1
+            self.overruns += 1
+            self.skipped += missed
+            deadline += missed * self.__period
+            if self.overruns == 1 or self.overruns % 100 == 0:
+                logging.warning(f"{self.__name} has overrun {self.overruns} times")
+
+        self.__clock.sleep(deadline - now)
+        lateness = self.__clock.monotonic() - deadline
+        self.__deadline = deadline
+
+        self.stats.add("lateness", lateness)
+        if self.__last_lateness is not None:
+            self.jitter.add(abs(lateness - self.__last_lateness))
+        self.__last_lateness = lateness
+
+    def log_summary(self) -> None:
+        logging.info(f"{self.__name}: {self.cycles} cycles, {self.overruns} overruns, {self.skipped} skipped deadlines")
+        self.stats.log_summary()
+        logging.info(self.jitter.summary_str())
@@ -0,0 +1,167 @@
+"""
+Scan plan of the automatic measurement
+
+The plan's segments are defined in the [Scan_plan:<segment>] sections of config.ini. The planner orders the segments so
+that the slow transitions between them (blower's sheath flow changes and valve switching) are minimized and predicts
+how long one measurement cycle takes.
+"""
+
+import itertools
+import logging
+import typing
+
+import numpy
+
+import config
+import dma_physics
+
+# How each voltage of a segment is measured, see config.ini's Scan_plan section
+DWELL_POLICIES = ("fixed", "adaptive_settle", "adaptive_count", "adaptive", "staircase")
+
+
+class ScanSegment(typing.NamedTuple):
+    """
+    One segment of the measurement cycle
+    """
+
+    name: str
+    particle_d_list: numpy.ndarray  # Empty list = total concentration
+    sheath_flow: typing.Optional[float]  # Unit is L/min, None = flow is not changed
+    conc_valve: bool
+    bypass_valve: bool
+    dwell: str
+    settle_t: float  # Unit is s
+    pulse_count_t: float  # Unit is s
+    repeat: int
+
+    def adaptive_settle(self) -> bool:
+        return self.dwell in ("adaptive_settle", "adaptive")
+
+    def adaptive_count(self) -> bool:
+        return self.dwell in ("adaptive_count", "adaptive")
+
+
+def load_segments(conf: config.Config) -> typing.List[ScanSegment]:
+    """
+    Return scan plan's segments in the order of the config.ini file's sections
+    """
+
+    dma_conf = conf.get_configuration("Dma")
+    auto_measurement_conf = conf.get_configuration("Automatic_measurement")
+    segments = []
+
+    for section in conf.get_sections("Scan_plan:"):
+        segment_conf = conf.get_configuration(section)
+        name = section.split(":", 1)[1]
+
+        dwell = segment_conf.get("dwell")
+        if dwell not in DWELL_POLICIES:
+            logging.error(f"Invalid dwell policy {dwell} in segment {name}, using fixed")
+            dwell = "fixed"
+
+        particles = segment_conf.get("particles")
+        if particles:
+            particle_d_list = dma_physics.gen_particle_diameters_list(dma_conf, particles)
+        else:
+            particle_d_list = numpy.array([])
+
+        # Empty settle and count times are taken from the Automatic_measurement section
+        settle_t = segment_conf.get("settle_t") or auto_measurement_conf.get("between_voltages_wait_t")
+        pulse_count_t = segment_conf.get("pulse_count_t") or auto_measurement_conf.get("pulse_count_t")
+        sheath_flow = segment_conf.get("sheath_flow")
+
+        segments.append(ScanSegment(name, particle_d_list, float(sheath_flow) if sheath_flow else None,
+                                    segment_conf.get("conc_valve") == "1", segment_conf.get("bypass_valve") == "1",
+                                    dwell, float(settle_t), float(pulse_count_t), int(segment_conf.get("repeat"))))
+
+    return segments
+
+
+def transition_time(plan_conf: dict, previous: ScanSegment, segment: ScanSegment, flow: float = None) -> float:
+    """
+    Return estimated time (s) of changing the flow and the valves from the previous segment to the segment
+
+    flow is the sheath flow during the previous segment if the previous segment does not change it
+    """
+
+    flow = previous.sheath_flow if previous.sheath_flow is not None else flow
+    time = 0.0
+    if segment.sheath_flow is not None and segment.sheath_flow != flow:
+        time += float(plan_conf.get("flow_change_t"))
+    if (segment.conc_valve, segment.bypass_valve) != (previous.conc_valve, previous.bypass_valve):
+        time += float(plan_conf.get("valve_change_t"))
+
+    return time
+
+
+def cycle_transition_time(plan_conf: dict, segments: typing.List[ScanSegment]) -> float:
+    """
+    Return estimated time (s) of all the transitions in one cycle. Cycle is repeated, so the last segment is followed
+    by the first one
+    """
+
+    # Sheath flow at the end of the cycle, segments without a flow keep the flow
+    flows = [segment.sheath_flow for segment in segments if segment.sheath_flow is not None]
+    flow = flows[-1] if flows else None
+
+    time = 0.0
+    for i, segment in enumerate(segments):
+        time += transition_time(plan_conf, segments[i - 1], segment, flow)
+        flow = segments[i - 1].sheath_flow if segments[i - 1].sheath_flow is not None else flow
+
+    return time
+
+
+def order_segments(conf: config.Config, segments: typing.List[ScanSegment]) -> typing.List[ScanSegment]:
+    """
+    Return the segments in the order that minimizes the cycle's transition time
+
+    The first segment stays first. Up to 8 segments all orders are tried, more segments are ordered greedily by
+    picking the segment with the fastest transition next. Order of the sections is kept when the times are equal
+    """
+
+    plan_conf = conf.get_configuration("Scan_plan")
+    if plan_conf.get("optimize_order") != "1" or len(segments) < 3:
+        return list(segments)
+
+    first, rest = segments[0], list(segments[1:])
+    if len(segments) <= 8:
+        ordered = min(([first] + list(order) for order in itertools.permutations(rest)),
+                      key=lambda order: cycle_transition_time(plan_conf, order))
+    else:
+        ordered = [first]
+        flow = first.sheath_flow
+        while rest:
+            # min returns the first of the equal times
+            next_segment = min(rest, key=lambda segment: transition_time(plan_conf, ordered[-1], segment, flow))
+            rest.remove(next_segment)
+            ordered.append(next_segment)
+            flow = next_segment.sheath_flow if next_segment.sheath_flow is not None else flow
+
+    logging.info(f"Scan plan order: {', '.join(segment.name for segment in ordered)}")
+
+    return ordered
+
+
+def predict_cycle_duration(conf: config.Config, segments: typing.List[ScanSegment]) -> float:
+    """
+    Return predicted duration (s) of one measurement cycle
+
+    Adaptive dwell policies are predicted with their maximum times, so the prediction is an upper bound for them
+    """
+
+    plan_conf = conf.get_configuration("Scan_plan")
+    auto_measurement_conf = conf.get_configuration("Automatic_measurement")
+    settle_max_t = float(auto_measurement_conf.get("settle_max_t"))
+    cycle_wait_t = float(auto_measurement_conf.get("cycle_wait_t"))
+
+    duration = cycle_transition_time(plan_conf, segments)
+    for segment in segments:
+        if len(segment.particle_d_list) == 0:
+            duration += segment.repeat * segment.pulse_count_t  # Total concentration is counted once
+            continue
+
+        settle_t = settle_max_t if segment.adaptive_settle() else segment.settle_t
+        duration += segment.repeat * (len(segment.particle_d_list) * (settle_t + segment.pulse_count_t) + cycle_wait_t)
+
+    return duration
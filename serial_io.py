@@ -0,0 +1,375 @@
+"""
+Asyncio based serial I/O engine shared by the serial devices (cpc and flow meter)
+
+One event loop in its own thread serves all the serial devices. Every device has its own command queue. Commands of a
+device are written and answered one at a time, but different devices are served at the same time. Replies are read
+without blocking: on Linux the event loop watches the serial port's file descriptor, other ports (E.g. on Windows or the
+simulated ports) are polled with in_waiting.
+
+Device classes (detectors.CpcLegacy, flow_meters.FlowMeter4000) use the engine when it is given to their constructor,
+so adding an instrument does not need a new thread.
+
+Commands have priorities. Queued commands of a device are executed in the order of priority, so E.g. the cpc's D
+command is written before the queued background RD polls. A command that has already been written is not interrupted.
+PriorityLock gives the same order to the devices that are used without the engine.
+"""
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import time
+import typing
+from threading import Condition, Thread
+
+import serial
+
+import timing_stats
+
+# Command priorities, smaller is executed first
+PRIORITY_HIGH = 0  # Time-critical commands, E.g. the cpc's D command during the measurement
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2  # Polling, E.g. the cpc's RD for the GUI
+
+DEFAULT_TIMEOUT = 1.0  # Reply timeout (s) if neither the frame nor the serial port has one
+QUEUE_TIMEOUT = 5.0  # How long request waits for a queued command in addition to its reply timeout (s)
+
+
+class Frame(typing.NamedTuple):
+    """
+    Framing of a reply
+
+    Reply is complete after it has lines terminators. If quiet_gap > 0 bytes are still read after that until no bytes
+    have arrived for quiet_gap (s). Reply whose first line starts with error_prefix is complete after the first line.
+    Reply is waited for timeout (s), None = serial port's timeout
+    """
+
+    terminator: bytes
+    lines: int
+    quiet_gap: float = 0.0
+    error_prefix: bytes = None
+    timeout: float = None
+
+    def is_complete(self, reply: bytes) -> bool:
+        if self.error_prefix is not None and reply.startswith(self.error_prefix) and self.terminator in reply:
+            return True
+        return reply.count(self.terminator) >= self.lines
+
+
+class PriorityLock:
+    """
+    Lock whose waiters get it in the order of priority and then in the order of arrival
+
+    Used to share a serial port between threads without the engine
+    """
+
+    def __init__(self) -> None:
+        self.__condition = Condition()
+        self.__waiters = []  # Heap of (priority, arrival)
+        self.__arrivals = itertools.count()
+        self.__locked = False
+
+    def acquire(self, priority: int = PRIORITY_NORMAL) -> None:
+        with self.__condition:
+            waiter = (priority, next(self.__arrivals))
+            heapq.heappush(self.__waiters, waiter)
+            while self.__locked or self.__waiters[0] != waiter:
+                self.__condition.wait()
+            heapq.heappop(self.__waiters)
+            self.__locked = True
+
+    def release(self) -> None:
+        with self.__condition:
+            self.__locked = False
+            self.__condition.notify_all()
+
+
+def command_name(command: bytes) -> str:
+    """
+    Return command as a str without the terminator, used as the operation name in the latency stats
+    """
+
+    return command.decode("UTF-8", errors="replace").strip()
+
+
+class _Request(typing.NamedTuple):
+    command: bytes
+    frame: Frame
+    future: concurrent.futures.Future
+    priority: int
+    submit_time: float  # time.monotonic() when the command was submitted
+
+
+class _Device:
+    """
+    Serial port and the command queue of a device. Lives in the event loop's thread
+    """
+
+    def __init__(self, ser_connection: serial.Serial, stats: timing_stats.LatencyStats = None) -> None:
+        self.ser_connection = ser_connection
+        self.stats = stats  # Queue wait and round-trip times of the commands are recorded if given
+        self.queue = asyncio.PriorityQueue()  # (priority, arrival, request)
+        self.arrivals = itertools.count()  # Keeps the order of the commands with the same priority
+        self.tasks = []  # Worker and periodic tasks, cancelled when the device is removed
+        self.current = None  # Request that is being executed
+
+        # File descriptor is watched by the event loop if the port has one (pyserial on posix)
+        try:
+            self.fd = ser_connection.fileno()
+        except (AttributeError, serial.SerialException, OSError):
+            self.fd = None
+
+
+class SerialIoEngine:
+    """
+    Event loop thread that executes the serial devices' commands
+    """
+
+    def __init__(self, poll_interval: float = 0.002) -> None:
+        self.__poll_interval = poll_interval  # How often ports without a file descriptor are checked (s)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run, name="SerialIoEngine", daemon=True)
+        self.__devices = {}  # Device name -> _Device, only used in the event loop's thread
+
+        logging.info("Created SerialIoEngine")
+
+    def __run(self) -> None:
+        asyncio.set_event_loop(self.__loop)
+        logging.info("Started SerialIoEngine")
+        self.__loop.run_forever()
+        self.__loop.close()
+        logging.info("Stopped SerialIoEngine")
+
+    def start(self) -> None:
+        """
+        Start the event loop thread. Commands submitted before this are executed after the start
+        """
+
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """
+        Remove all the devices and stop the event loop thread
+        """
+
+        if not self.__thread.is_alive():
+            return
+
+        future = asyncio.run_coroutine_threadsafe(self.__remove_all_devices(), self.__loop)
+        future.result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+
+    def add_device(self, name: str, ser_connection: serial.Serial, stats: timing_stats.LatencyStats = None) -> None:
+        """
+        Register an opened serial port with the name. Replaces a device with the same name
+
+        If stats is given, each command's queue wait ("<command> wait") and round-trip time ("<command> rtt") are added
+        to it. The engine times the commands in real time
+        """
+
+        self.__call_soon(self.__add_device, name, ser_connection, stats)
+
+    def remove_device(self, name: str) -> None:
+        """
+        Unregister the device. Its unfinished commands get an empty reply
+        """
+
+        self.__call_soon(self.__remove_device, name)
+
+    def submit(self, name: str, command: bytes, frame: Frame,
+               priority: int = PRIORITY_NORMAL) -> concurrent.futures.Future:
+        """
+        Queue the command to the device. Return a future whose result is the reply (bytes)
+        """
+
+        future = concurrent.futures.Future()
+        request = _Request(command, frame, future, priority, time.monotonic())
+        if not self.__call_soon(self.__enqueue, name, request):
+            future.set_result(b"")
+        return future
+
+    def request(self, name: str, command: bytes, frame: Frame, priority: int = PRIORITY_NORMAL,
+                timeout: float = None) -> bytes:
+        """
+        Queue the command to the device and wait for the reply
+
+        Reply is waited for timeout (s), None = frame's timeout (DEFAULT_TIMEOUT if it has none) + QUEUE_TIMEOUT. If the
+        reply doesn't arrive in time, the command is cancelled and the reply is empty
+        """
+
+        if timeout is None:
+            timeout = (frame.timeout if frame.timeout is not None else DEFAULT_TIMEOUT) + QUEUE_TIMEOUT
+
+        future = self.submit(name, command, frame, priority)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # Not written if it is still queued
+            logging.debug(f"No reply from {name} to {command_name(command)} in {timeout} s")
+            return b""
+
+    def add_periodic(self, name: str, command: bytes, frame: Frame, interval: float,
+                     callback: typing.Callable[[bytes], None], priority: int = PRIORITY_BACKGROUND) -> None:
+        """
+        Send the command to the device every interval (s) and give the replies to the callback
+
+        Callback is called in the event loop's thread, so it must not block. Periodic commands stop when the device is
+        removed
+        """
+
+        self.__call_soon(self.__add_periodic, name, command, frame, interval, callback, priority)
+
+    def __call_soon(self, callback: typing.Callable, *args) -> bool:
+        """
+        Schedule the callback to the event loop's thread. Return False if the engine has been stopped
+        """
+
+        try:
+            self.__loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:  # Event loop is closed
+            logging.debug("SerialIoEngine has been stopped")
+            return False
+        return True
+
+    def __add_device(self, name: str, ser_connection: serial.Serial, stats: timing_stats.LatencyStats) -> None:
+        self.__remove_device(name)
+        device = _Device(ser_connection, stats)
+        device.tasks.append(self.__loop.create_task(self.__device_worker(name, device)))
+        self.__devices[name] = device
+        logging.info(f"Added {name} to SerialIoEngine (file descriptor: {device.fd})")
+
+    def __remove_device(self, name: str) -> None:
+        device = self.__devices.pop(name, None)
+        if device is None:
+            return
+
+        for task in device.tasks:
+            task.cancel()
+        # Unfinished commands are answered with an empty reply, also the one being executed
+        if device.current is not None and not device.current.future.done():
+            device.current.future.set_result(b"")
+        while not device.queue.empty():
+            request = device.queue.get_nowait()[2]
+            if not request.future.done():
+                request.future.set_result(b"")
+        logging.info(f"Removed {name} from SerialIoEngine")
+
+    async def __remove_all_devices(self) -> None:
+        for name in list(self.__devices):
+            self.__remove_device(name)
+
+    def __enqueue(self, name: str, request: _Request) -> None:
+        device = self.__devices.get(name)
+        if device is None:
+            logging.debug(f"No device {name} in SerialIoEngine")
+            request.future.set_result(b"")
+            return
+
+        device.queue.put_nowait((request.priority, next(device.arrivals), request))
+
+    def __add_periodic(self, name: str, command: bytes, frame: Frame, interval: float,
+                       callback: typing.Callable[[bytes], None], priority: int) -> None:
+        device = self.__devices.get(name)
+        if device is None:
+            logging.debug(f"No device {name} in SerialIoEngine")
+            return
+
+        periodic = self.__periodic(name, command, frame, interval, callback, priority)
+        device.tasks.append(self.__loop.create_task(periodic))
+
+    async def __periodic(self, name: str, command: bytes, frame: Frame, interval: float,
+                         callback: typing.Callable[[bytes], None], priority: int) -> None:
+        while True:
+            reply = await asyncio.wrap_future(self.submit(name, command, frame, priority))
+            try:
+                callback(reply)
+            except Exception as e:
+                logging.error(e)
+                logging.debug(f"Periodic {command} callback of {name} failed")
+            await asyncio.sleep(interval)
+
+    async def __device_worker(self, name: str, device: _Device) -> None:
+        """
+        Execute the device's commands one at a time in the order of priority
+        """
+
+        while True:
+            request = (await device.queue.get())[2]
+            if request.future.cancelled():  # Requester stopped waiting
+                continue
+
+            start_time = time.monotonic()
+            device.current = request
+            try:
+                device.ser_connection.write(request.command)
+                reply = await self.__read_reply(device, request.frame)
+            except (serial.SerialException, OSError) as e:
+                logging.error(e)
+                logging.debug(f"Serial I/O with {name} failed")
+                reply = b""
+            except asyncio.CancelledError:  # Device was removed during the command
+                if not request.future.done():
+                    request.future.set_result(b"")
+                raise
+            finally:
+                device.current = None
+
+            if device.stats is not None:
+                operation = command_name(request.command)
+                device.stats.add(f"{operation} wait", start_time - request.submit_time)
+                device.stats.add(f"{operation} rtt", time.monotonic() - start_time)
+
+            if not request.future.done():
+                request.future.set_result(reply)
+
+    async def __read_reply(self, device: _Device, frame: Frame) -> bytes:
+        """
+        Read until the reply is complete or the frame's timeout expires
+        """
+
+        timeout = frame.timeout if frame.timeout is not None else device.ser_connection.timeout
+        deadline = self.__loop.time() + (timeout if timeout is not None else DEFAULT_TIMEOUT)
+        reply = bytearray()
+        last_byte_time = self.__loop.time()
+        complete = False
+
+        while True:
+            waiting = device.ser_connection.in_waiting
+            if waiting > 0:
+                reply += device.ser_connection.read(waiting)
+                last_byte_time = self.__loop.time()
+                complete = complete or frame.is_complete(bytes(reply))
+
+            now = self.__loop.time()
+            if complete and now - last_byte_time >= frame.quiet_gap:
+                return bytes(reply)
+            if now >= deadline:
+                if not complete:
+                    logging.debug(f"Incomplete reply before the timeout: {bytes(reply)}")
+                return bytes(reply)
+
+            wait = deadline - now
+            if complete:
+                wait = min(wait, last_byte_time + frame.quiet_gap - now)
+            if waiting == 0:
+                await self.__wait_readable(device, wait)
+
+    async def __wait_readable(self, device: _Device, wait: float) -> None:
+        """
+        Wait until the port has bytes to read or wait (s) has passed
+        """
+
+        if device.fd is None:
+            await asyncio.sleep(min(self.__poll_interval, max(wait, 0.0)))
+            return
+
+        readable = asyncio.Event()
+        self.__loop.add_reader(device.fd, readable.set)
+        try:
+            await asyncio.wait_for(readable.wait(), max(wait, 0.0))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.__loop.remove_reader(device.fd)
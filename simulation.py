@@ -0,0 +1,597 @@
+"""
+Simulated DMPS hardware. Used to run the program without the real devices, E.g. to benchmark whole scan cycles on a
+plain Linux PC.
+
+SimulatedNiDaq has the same public methods as ni_daqs.NiDaq. SimulatedCpcSerial and SimulatedFlowMeterSerial mimic
+serial.Serial objects so they can be given to detectors.CpcLegacy and flow_meters.FlowMeter4000, which then run their
+normal command and parsing code against the simulated devices.
+All the simulated devices share one SimulatedEnvironment which holds the state of the physical system.
+The simulated devices read time and wait with the given clock, so with clocks.AcceleratedClock or clocks.VirtualClock
+the simulation runs faster than the real time.
+"""
+
+import abc
+import logging
+import math
+import typing  # Used for providing tuple type hint
+from threading import Lock
+
+import numpy
+
+import clocks
+import config
+import ni_daqs
+
+
+class SimulatedEnvironment:
+    """
+    State of the simulated DMPS: blower flow, high voltage, valves, gas and a synthetic aerosol.
+
+    Values change with time, so the state is integrated every time it is read.
+    The aerosol's concentration spectrum is defined directly over the dma voltage (log-normal), which is enough to
+    exercise the scan timing without inverting the dma physics
+    """
+
+    def __init__(self, conf: config.Config, clock: clocks.Clock) -> None:
+        self.__sim_conf = conf.get_configuration("Simulation")
+        self.__clock = clock
+        self.__lock = Lock()  # Simulated devices are used from multiple threads
+
+        self.__total_conc = float(self.__sim_conf.get("total_conc"))
+        self.__peak_voltage = float(self.__sim_conf.get("peak_voltage"))
+        self.__peak_width = float(self.__sim_conf.get("peak_width"))
+        self.__cpc_flow = float(self.__sim_conf.get("cpc_flow"))
+        self.__blower_flow_gain = float(self.__sim_conf.get("blower_flow_gain"))
+        self.__blower_time_constant = float(self.__sim_conf.get("blower_time_constant"))
+        self.__bypass_flow_factor = float(self.__sim_conf.get("bypass_flow_factor"))
+        self.__hv_time_constant = float(self.__sim_conf.get("hv_time_constant"))
+        self.gas_temp = float(self.__sim_conf.get("gas_temp"))  # °C
+        self.gas_pressure = float(self.__sim_conf.get("gas_pressure"))  # kPa
+        self.rh = float(self.__sim_conf.get("rh"))  # %
+
+        self.__duty_cycle = 0.0
+        self.__flow = 0.0  # L/min
+        self.__hv_target = 0.0  # V
+        self.__hv = 0.0  # V
+        self.__valves = {"conc": False, "bypass": False}
+        self.__counts = 0  # Cumulative counts of the cpc's pulses
+        self.__last_update = self.__clock.monotonic()
+
+        logging.info("Created SimulatedEnvironment object")
+
+    def __update(self) -> None:
+        """
+        Integrate the state from the last update to the current time. Lock must be held by the caller
+        """
+
+        now = self.__clock.monotonic()
+        dt = now - self.__last_update
+        self.__last_update = now
+        if dt <= 0.0:
+            return
+
+        # First order responses of the blower and the high voltage supply
+        target_flow = self.__blower_flow_gain * self.__duty_cycle
+        if self.__valves["bypass"]:
+            target_flow *= self.__bypass_flow_factor
+        self.__flow += (target_flow - self.__flow) * (1.0 - math.exp(-dt / self.__blower_time_constant))
+        self.__hv += (self.__hv_target - self.__hv) * (1.0 - math.exp(-dt / self.__hv_time_constant))
+
+        # Poisson distributed counts during dt
+        self.__counts += int(numpy.random.poisson(self.__conc() * self.__cpc_flow * dt))
+
+    def __conc(self) -> float:
+        """
+        Return the concentration (1/cm^3) that reaches the cpc with the current state. Lock must be held by the caller
+        """
+
+        if self.__valves["conc"]:  # Total concentration line
+            return self.__total_conc
+        if self.__hv <= 1.0:
+            return 0.0
+
+        # Log-normal spectrum over the dma voltage
+        log_ratio = math.log(self.__hv / self.__peak_voltage) / math.log(self.__peak_width)
+        return self.__total_conc * 0.1 * math.exp(-0.5 * log_ratio ** 2)
+
+    def set_duty_cycle(self, duty_cycle: float) -> None:
+        """
+        Set the blower's pwm duty cycle (0-1)
+        """
+
+        with self.__lock:
+            self.__update()
+            self.__duty_cycle = duty_cycle
+
+    def set_hv(self, voltage: float) -> None:
+        """
+        Set the high voltage supply's target voltage (V)
+        """
+
+        with self.__lock:
+            self.__update()
+            self.__hv_target = voltage
+
+    def set_valve(self, valve: str, state: bool) -> None:
+        """
+        Set state of the valve "conc" or "bypass"
+        """
+
+        with self.__lock:
+            self.__update()
+            self.__valves[valve] = state
+
+    def get_valve(self, valve: str) -> bool:
+        """
+        Return state of the valve "conc" or "bypass"
+        """
+
+        return self.__valves[valve]
+
+    def get_flow(self) -> float:
+        """
+        Return the blower flow (L/min)
+        """
+
+        with self.__lock:
+            self.__update()
+            return self.__flow
+
+    def get_hv(self) -> float:
+        """
+        Return the high voltage supply's actual output voltage (V)
+        """
+
+        with self.__lock:
+            self.__update()
+            return self.__hv
+
+    def get_conc(self) -> float:
+        """
+        Return the concentration (1/cm^3) that reaches the cpc
+        """
+
+        with self.__lock:
+            self.__update()
+            return self.__conc()
+
+    def get_counts(self) -> int:
+        """
+        Return the cumulative count of the cpc's pulses
+        """
+
+        with self.__lock:
+            self.__update()
+            return self.__counts
+
+
+class SimulatedSerial(abc.ABC):
+    """
+    Mimics serial.Serial. Commands written to the port are answered by handle_command after a latency.
+
+    Subclasses implement handle_command for a specific device
+    """
+
+    def __init__(self, latency: float, clock: clocks.Clock) -> None:
+        self.__latency = latency
+        self.__clock = clock
+        self.__is_open = False
+        self.__command = bytearray()  # Written bytes that don't form a full command yet
+        self.__in_buffer = bytearray()  # Bytes that can be read
+        self.__pending = []  # List of (ready time, str or function returning str) that arrive to the input buffer later
+
+        # Serial settings, set by the device classes like with serial.Serial
+        self.port = None
+        self.parity = None
+        self.baudrate = None
+        self.bytesize = None
+        self.stopbits = None
+        self.timeout = None
+        self.xonxoff = None
+        self.rtscts = None
+
+    def open(self) -> None:
+        self.__is_open = True
+
+    def close(self) -> None:
+        self.__is_open = False
+
+    def isOpen(self) -> bool:
+        return self.__is_open
+
+    @property
+    def is_open(self) -> bool:
+        return self.__is_open
+
+    @abc.abstractmethod
+    def handle_command(self, command: str) -> typing.List[typing.Tuple[float, typing.Union[str, typing.Callable]]]:
+        """
+        Return the reply to the command as a list of (delay after the latency (s), str) chunks
+
+        Chunk can be a function returning the str, it is called when the chunk arrives (E.g. a sample measured later)
+        """
+
+    def write(self, data: bytes) -> int:
+        """
+        Take the written bytes. Every full command (ends with \\r) is answered
+        """
+
+        self.__command += data
+        while b"\r" in self.__command:
+            command, _, self.__command = self.__command.partition(b"\r")
+            now = self.__clock.monotonic()
+            for delay, reply in self.handle_command(command.decode("UTF-8").strip()):
+                self.__pending.append((now + self.__latency + delay, reply))
+
+        return len(data)
+
+    def __receive(self) -> None:
+        """
+        Move the replies that have arrived to the input buffer
+        """
+
+        now = self.__clock.monotonic()
+        while self.__pending and self.__pending[0][0] <= now:
+            reply = self.__pending.pop(0)[1]
+            self.__in_buffer += (reply() if callable(reply) else reply).encode("UTF-8")
+
+    @property
+    def in_waiting(self) -> int:
+        """
+        Return number of bytes in the input buffer
+        """
+
+        self.__receive()
+        return len(self.__in_buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        """
+        Read size bytes or until timeout occurs like serial.Serial does
+        """
+
+        deadline = self.__clock.monotonic() + (self.timeout if self.timeout is not None else math.inf)
+        self.__receive()
+        while len(self.__in_buffer) < size and self.__clock.monotonic() < deadline:
+            wait_until = min(self.__pending[0][0], deadline) if self.__pending else deadline
+            self.__clock.sleep(max(wait_until - self.__clock.monotonic(), 0.0))
+            self.__receive()
+
+        data = bytes(self.__in_buffer[:size])
+        del self.__in_buffer[:size]
+        return data
+
+    def read_until(self, expected: bytes = b"\n", size: int = None) -> bytes:
+        """
+        Read until expected bytes are found or timeout occurs. Return what was read like serial.Serial does
+        """
+
+        deadline = self.__clock.monotonic() + (self.timeout if self.timeout is not None else math.inf)
+        while True:
+            self.__receive()
+            index = self.__in_buffer.find(expected)
+            if index >= 0:
+                line = bytes(self.__in_buffer[:index + len(expected)])
+                del self.__in_buffer[:index + len(expected)]
+                return line
+
+            # Wait for the next reply or until timeout
+            wait_until = self.__pending[0][0] if self.__pending else deadline
+            if wait_until >= deadline:
+                self.__clock.sleep(max(deadline - self.__clock.monotonic(), 0.0))
+                self.__receive()
+                line = bytes(self.__in_buffer)
+                self.__in_buffer.clear()
+                return line
+            self.__clock.sleep(max(wait_until - self.__clock.monotonic(), 0.0))
+
+
+class SimulatedCpcSerial(SimulatedSerial):
+    """
+    Simulated serial port of a TSI cpc that answers to legacy commands RD, D and RALL
+    """
+
+    def __init__(self, conf: config.Config, environment: SimulatedEnvironment, clock: clocks.Clock) -> None:
+        sim_conf = conf.get_configuration("Simulation")
+        super().__init__(float(sim_conf.get("cpc_latency")), clock)
+
+        self.__environment = environment
+        self.__clock = clock
+        self.__junk_lines = int(sim_conf.get("cpc_junk_lines"))
+        self.__d_counts = environment.get_counts()  # Counts when D command was used last time
+        self.__d_time = clock.monotonic()
+
+    def handle_command(self, command: str) -> typing.List[typing.Tuple[float, str]]:
+        if command == "RD":
+            return [(0.0, f"{self.__environment.get_conc():.2f}\r")]
+
+        elif command == "D":
+            # Accumulative time and counts since the last D command and the junk lines
+            counts = self.__environment.get_counts()
+            now = self.__clock.monotonic()
+            reply = [(0.0, f"{now - self.__d_time:.2f}\r"), (0.0, f"{counts - self.__d_counts},0\r")]
+            # Junk lines follow each other with a small gap like from the real cpc
+            reply.extend([(0.001 * (line + 1), "0,0\r") for line in range(self.__junk_lines)])
+            self.__d_counts = counts
+            self.__d_time = now
+            return reply
+
+        elif command == "RALL":
+            conc = self.__environment.get_conc()
+            return [(0.0, f"{conc:.2f},0000,39.0,10.0,{self.__environment.gas_pressure:.1f},42.5,0.5,70,FULL\r")]
+
+        return [(0.0, "ERROR\r")]
+
+
+class SimulatedFlowMeterSerial(SimulatedSerial):
+    """
+    Simulated serial port of a TSI 4000 series flow meter that answers to DAFTP and SSR commands
+    """
+
+    def __init__(self, conf: config.Config, environment: SimulatedEnvironment, clock: clocks.Clock) -> None:
+        super().__init__(float(conf.get_configuration("Simulation").get("flow_meter_latency")), clock)
+
+        self.__environment = environment
+        self.__sample_interval = 0.001  # Set with SSR, unit is s
+
+    def __sample(self) -> str:
+        flow = self.__environment.get_flow()
+        return f"{flow:.3f},{self.__environment.gas_temp:.2f},{self.__environment.gas_pressure:.2f}\r\n"
+
+    def handle_command(self, command: str) -> typing.List[typing.Tuple[float, typing.Union[str, typing.Callable]]]:
+        if command.startswith("DAFTP") and command[5:].isdigit() and int(command[5:]) > 0:
+            # Samples are measured at the sample interval after the OK
+            samples = int(command[5:])
+            return [(0.0, "OK\r\n")] + [(i * self.__sample_interval, self.__sample) for i in range(samples)]
+
+        elif command.startswith("SSR") and command[3:].isdigit() and 1 <= int(command[3:]) <= 1000:
+            self.__sample_interval = int(command[3:]) / 1000.0
+            return [(0.0, "OK\r\n")]
+
+        return [(0.0, "ERR1\r\n")]
+
+
+class SimulatedDoTask:
+    """
+    Mimics the parts of nidaqmx.Task used with the valve tasks
+    """
+
+    def __init__(self, name: str, environment: SimulatedEnvironment, valve: str) -> None:
+        self.name = name
+        self.__environment = environment
+        self.__valve = valve
+
+    def write(self, state: bool) -> None:
+        self.__environment.set_valve(self.__valve, state)
+
+    def read(self, number_of_samples_per_channel: int = 1) -> list:
+        return [self.__environment.get_valve(self.__valve)] * number_of_samples_per_channel
+
+    def close(self) -> None:
+        pass
+
+
+class SimulatedCounterWriter:
+    """
+    Mimics nidaqmx CounterWriter used to generate the blower's pwm pulses
+    """
+
+    def __init__(self, environment: SimulatedEnvironment) -> None:
+        self.__environment = environment
+
+    def write_one_sample_pulse_frequency(self, frequency: float, duty_cycle: float, timeout: float = 10.0) -> None:
+        self.__environment.set_duty_cycle(duty_cycle)
+
+
+class SimulatedNiDaq:
+    """
+    Simulated NI DAQ with the same public methods as ni_daqs.NiDaq
+    """
+
+    def __init__(self, conf: config.Config, environment: SimulatedEnvironment, clock: clocks.Clock) -> None:
+        self.__conf = conf
+        self.__clock = clock
+        self.__nidaq_conf = self.__conf.get_configuration("NI_DAQ")
+        self.__scaling_conf = self.__conf.get_configuration("NI_DAQ_Scaling")
+        self.__timing_conf = self.__conf.get_configuration("NI_DAQ_Timing")
+        self.__environment = environment
+        self.__latency = float(self.__conf.get_configuration("Simulation").get("daq_latency"))
+        self.__daq_flow_gain = float(self.__conf.get_configuration("Simulation").get("daq_flow_gain"))
+        self.__ctr_start = environment.get_counts()  # Counts when the counter task was reset
+
+        # Buffered analog input and counter "start" when the object is created
+        self.__ai_start_time = clock.time()
+        self.__ai_samples_read = 0
+        self.__ai_latest = None
+        self.__ctr_last_counts = environment.get_counts()  # Counts when the last counter block was read
+        self.__ctr_history = ni_daqs.CounterHistory(int(self.__timing_conf.get("ctr_history_size")))
+        self.__ctr_rst_position = (0, 0)
+        self.__ao_waveform = None  # Analog output waveform as (first sample, voltages)
+
+        conc_line = self.__nidaq_conf.get("conc_line_chan")
+        bypass_line = self.__nidaq_conf.get("bypass_line_chan")
+        self.conc_valve_task = SimulatedDoTask(f"do_task_line_{conc_line}", environment, "conc")
+        self.bypass_valve_task = SimulatedDoTask(f"do_task_line_{bypass_line}", environment, "bypass")
+        self.cw_writer = SimulatedCounterWriter(environment)
+
+        logging.info("Created SimulatedNiDaq object")
+
+    def close_tasks(self) -> None:
+        logging.info("Closed all simulated NIDAQ tasks")
+
+    def rst_ctr_task(self) -> None:
+        if self.ctr_buffered():
+            self.__ctr_rst_position = self.get_ctr_position()
+        else:
+            self.__ctr_start = self.__environment.get_counts()
+        logging.info("Counter task reset successfully")
+
+    def read_ctr_task(self) -> float:
+        if self.ctr_buffered():
+            counts = self.get_ctr_position()[1] - self.__ctr_rst_position[1]
+        else:
+            counts = self.__environment.get_counts() - self.__ctr_start
+        logging.info(f"Counter task read: {counts}")
+        return counts
+
+    def ctr_buffered(self) -> bool:
+        return self.ai_buffered() and self.__timing_conf.get("ctr_buffered") == "1"
+
+    def read_ctr_block(self) -> numpy.ndarray:
+        """
+        Return counts per sample clock interval of the latest block. Use after read_ai_block
+        """
+
+        samples = int(self.__timing_conf.get("ai_block_size"))
+        counts = self.__environment.get_counts()
+        # Spread the counts randomly over the intervals of the block
+        interval_counts = numpy.random.multinomial(counts - self.__ctr_last_counts, [1.0 / samples] * samples)
+        self.__ctr_last_counts = counts
+        self.__ctr_history.add(interval_counts)
+
+        return interval_counts
+
+    def get_ctr_position(self) -> typing.Tuple[int, int]:
+        return self.__ctr_history.samples, self.__ctr_history.total
+
+    def get_ctr_interval_counts(self, start_sample: int, end_sample: int) -> numpy.ndarray:
+        return self.__ctr_history.interval_counts(start_sample, end_sample)
+
+    def get_sample_period(self) -> float:
+        return 1.0 / float(self.__timing_conf.get("ai_sample_rate"))
+
+    def __sample_ai(self, samples: int) -> numpy.ndarray:
+        """
+        Return analog input voltages of the current state as an array of shape (channels, samples)
+        """
+
+        # Sensor values in the units of the scaling section
+        values = {"p": self.__environment.gas_pressure * 1000.0, "t": self.__environment.gas_temp,
+                  "rh": self.__environment.rh, "hvi": self.__environment.get_hv(),
+                  "f": self.__environment.get_flow() * self.__daq_flow_gain}
+
+        ai_min = int(self.__nidaq_conf.get("ai_min"))
+        ai_max = int(self.__nidaq_conf.get("ai_max"))
+        ai_voltages = numpy.zeros((ai_max - ai_min + 1, samples))
+        for name, value in values.items():
+            chan = int(self.__scaling_conf.get(f"{name}_chan"))
+            if ai_min <= chan <= ai_max:
+                m, b = ni_daqs.scaling_coefficients(self.__conf, name)
+                ai_voltages[chan - ai_min] = (value - b) / m  # Inverse of the scaling
+
+        return ai_voltages + numpy.random.normal(0.0, 1.0e-4, ai_voltages.shape)
+
+    def ai_buffered(self) -> bool:
+        return float(self.__timing_conf.get("ai_sample_rate")) > 0.0
+
+    def ai_samples_available(self) -> int:
+        rate = float(self.__timing_conf.get("ai_sample_rate"))
+        return int((self.__clock.time() - self.__ai_start_time) * rate) - self.__ai_samples_read
+
+    def read_ai_block(self) -> ni_daqs.AiBlock:
+        """
+        Wait until a block of samples would be measured and return it
+        """
+
+        rate = float(self.__timing_conf.get("ai_sample_rate"))
+        samples = int(self.__timing_conf.get("ai_block_size"))
+        missing = samples - self.ai_samples_available()
+        if missing > 0:
+            self.__clock.sleep(missing / rate)
+
+        # Output the waveform's voltage at the end of the block, the last voltage is held after the waveform
+        if self.__ao_waveform is not None:
+            first_sample, voltages = self.__ao_waveform
+            index = self.__ai_samples_read + samples - 1 - first_sample
+            if index >= 0:
+                self.__environment.set_hv(voltages[min(index, len(voltages) - 1)])
+
+        block = ni_daqs.AiBlock(self.__ai_start_time + self.__ai_samples_read / rate, 1.0 / rate,
+                                self.__sample_ai(samples))
+        self.__ai_samples_read += samples
+        self.__ai_latest = block.voltages.mean(axis=1).tolist()
+
+        return block
+
+    def measure_ai(self) -> list:
+        """
+        Return analog input voltages, voltages[0] is ai0's voltage
+        """
+
+        if self.ai_buffered():
+            return self.__ai_latest
+
+        if self.__latency > 0.0:
+            self.__clock.sleep(self.__latency)
+
+        return self.__sample_ai(1)[:, 0].tolist()
+
+    def set_ao(self, ao_voltage: float) -> None:
+        self.__environment.set_hv(ao_voltage)
+        logging.info("Voltage set to the analog output channel")
+
+    def ai_samples_acquired(self, read_after: float = 0.0) -> int:
+        return self.__ai_samples_read + self.ai_samples_available()
+
+    def __start_ao_waveform(self, voltages: numpy.ndarray) -> typing.Tuple[int, int]:
+        # Same (earliest start sample, start window) as NiDaq. Simulated waveform starts right away at the first sample
+        before_start = self.ai_samples_acquired()
+        self.__ao_waveform = (before_start, voltages)
+        return before_start, self.ai_samples_acquired() - before_start
+
+    def start_voltage_staircase(self, voltages: list, settle_time: float,
+                                count_time: float) -> typing.List[typing.Tuple[int, int]]:
+        if not self.ctr_buffered():
+            logging.error("Voltage staircase requires the buffered analog inputs and counter")
+            return []
+
+        settle_samples, step_samples = ni_daqs.staircase_steps(settle_time, count_time,
+                                                               float(self.__timing_conf.get("ai_sample_rate")))
+        start = self.__start_ao_waveform(numpy.repeat(numpy.asarray(voltages, dtype=float), step_samples))
+        logging.info(f"Started voltage staircase of {len(voltages)} steps")
+
+        return ni_daqs.staircase_windows(start, len(voltages), settle_samples, step_samples)
+
+    def start_voltage_ramp(self, start_voltage: float, end_voltage: float,
+                           ramp_time: float) -> typing.Optional[typing.Tuple[int, int]]:
+        if not self.ctr_buffered():
+            logging.error("Voltage ramp requires the buffered analog inputs and counter")
+            return None
+
+        waveform = ni_daqs.ramp_waveform(start_voltage, end_voltage, ramp_time,
+                                         float(self.__timing_conf.get("ai_sample_rate")))
+        start = self.__start_ao_waveform(waveform)
+        logging.info(f"Started voltage ramp from {start_voltage:.1f} V to {end_voltage:.1f} V (start known within "
+                     f"{start[1]} samples)")
+
+        return ni_daqs.ramp_samples(start, len(waveform))
+
+    def stop_ao_waveform(self) -> None:
+        self.__ao_waveform = None
+        logging.info("Stopped analog output waveform")
+
+    def scale_value(self, name: str, volt: float) -> float:
+        try:
+            m, b = ni_daqs.scaling_coefficients(self.__conf, name)
+            scaled_value = m * volt + b
+        except ValueError as e:
+            logging.error(e)
+            logging.debug(f"Failed to scale {name} value")
+            scaled_value = None
+
+        return scaled_value
+
+    def set_do(self, do_task: SimulatedDoTask, state: bool) -> None:
+        do_task.write(state)
+        logging.info(f"Changed {do_task.name} state to {state}")
+
+    def update_settings(self) -> None:
+        self.__conf.update_configuration(self.__nidaq_conf, "NI_DAQ")
+        self.__conf.update_configuration(self.__scaling_conf, "NI_DAQ:Scaling")
+        self.__conf.update_configuration(self.__timing_conf, "NI_DAQ:Timing")
+        self.__ai_start_time = self.__clock.time()
+        self.__ai_samples_read = 0
+        self.__ctr_last_counts = self.__environment.get_counts()
+        self.__ctr_history = ni_daqs.CounterHistory(int(self.__timing_conf.get("ctr_history_size")))
+        self.__ctr_rst_position = (0, 0)
+        self.__ao_waveform = None
+        logging.info("Updated simulated NIDAQ configuration")
@@ -2,27 +2,99 @@
 Contains class for dmps automatic measurement thread
 This file could also contain other classes for other type of measurement modes
 
-TODO: Refactor repetitive code
+Helpers shared by the measurement threads are module functions, so the threads keep their own private attributes
 """
 
 import logging
-import queue
 import typing  # Used for providing tuple type hint
 from datetime import datetime
 from multiprocessing import Lock
 from threading import Thread
-from time import sleep
-from time import time
 
 import numpy
 from pytz import timezone
 
+import clocks
 import config
 import detectors
+import dma_physics
 import flow_meters
+import mailboxes
+import measurement_bus
 import ni_daqs
+import scan_plans
 from threads import pid_ftp_thread
 
+MAILBOX_TIMEOUT = 5.0  # How long a mailbox's first value is waited before warning about it (s)
+
+
+def get_time(clock: clocks.Clock, time_zone: str, time_format: str) -> typing.Tuple[str, str]:
+    """
+    Get utc and local time of the clock
+    Return them formatted
+    """
+
+    # Current time in UTC
+    utc_time = datetime.fromtimestamp(clock.time(), timezone("UTC"))
+    # Convert to the time zone
+    local_time = utc_time.astimezone(timezone(time_zone))
+
+    # Format the times
+    utc_str = utc_time.strftime(time_format)
+    local_str = local_time.strftime(time_format)
+
+    return utc_str, local_str
+
+
+def wait_for_sample(daq: ni_daqs.NiDaq, daq_lock: Lock, clock: clocks.Clock, sample: int,
+                    stop: typing.Callable[[], bool]) -> None:
+    """
+    Wait until the daq thread has read the buffered counter up to the sample or stop returns True
+    """
+
+    daq_lock.acquire()
+    samples, _ = daq.get_ctr_position()
+    sample_period = daq.get_sample_period()
+    daq_lock.release()
+
+    while samples < sample and not stop():
+        clock.sleep((sample - samples) * sample_period)
+        daq_lock.acquire()
+        samples, _ = daq.get_ctr_position()
+        daq_lock.release()
+
+
+def wait_for_value(mailbox: mailboxes.LatestValue, name: str, stop: typing.Callable[[], bool]) -> typing.Any:
+    """
+    Wait until the mailbox has a value and return it. Return None if stop returns True before that
+    """
+
+    while not stop():
+        sample = mailbox.wait_newer_than(0, MAILBOX_TIMEOUT)
+        if sample is not None:
+            return sample.value
+        logging.warning(f"No {name} values in {MAILBOX_TIMEOUT} s, check that its thread is running")
+
+    return None
+
+
+def wait_for_flow(blower_pid_thread: pid_ftp_thread.BlowerPidThread, plan_conf: dict,
+                  stop: typing.Callable[[], bool]) -> None:
+    """
+    Wait until the blower pid has brought the flow to the target flow and report how long it took. Flow settle
+    settings are from the Scan_plan section
+    """
+
+    settled, settle_time = blower_pid_thread.wait_until_settled(
+        float(plan_conf.get("flow_settle_tol")), float(plan_conf.get("flow_settle_timeout")),
+        int(plan_conf.get("flow_settle_readings")), stop=stop)
+    target_flow = blower_pid_thread.get_target_flow()
+
+    if settled:
+        logging.info(f"Flow settled to {target_flow} L/min in {settle_time:.1f} s")
+    elif not stop():
+        logging.warning(f"Flow did not settle to {target_flow} L/min in {settle_time:.1f} s")
+
 
 class AutomaticMeasurementThread(Thread):
     """
@@ -31,184 +103,250 @@ class AutomaticMeasurementThread(Thread):
 
     def __init__(self, conf: config.Config, daq: ni_daqs.NiDaq, flow_meter: flow_meters.FlowMeter4000,
                  detector: detectors.CpcLegacy, blower_pid_thread: pid_ftp_thread.BlowerPidThread,
-                 flow_meter_queue: queue.Queue, voltage_queue: queue.Queue, conc_queue: queue.Queue,
-                 daq_ai_queue: queue.Queue, detector_lock: Lock, daq_lock: Lock) -> None:
+                 flow_meter_ftp: mailboxes.LatestValue, bus: measurement_bus.MeasurementBus,
+                 daq_ai: mailboxes.LatestValue, detector_lock: Lock, daq_lock: Lock,
+                 clock: clocks.Clock = None) -> None:
         Thread.__init__(self)  # Call Thread constructor
 
         # Initialize
         self.__conf = conf
+        self.__clock = clock if clock is not None else clocks.Clock()  # All waiting and timing is done with the clock
         self.__dma_conf = self.__conf.get_configuration("Dma")
         self.__auto_measurement_conf = self.__conf.get_configuration("Automatic_measurement")
+        self.__plan_conf = self.__conf.get_configuration("Scan_plan")
         self.__daq_conf = self.__conf.get_configuration("NI_DAQ")
         self.__daq_scaling_conf = self.__conf.get_configuration("NI_DAQ_Scaling")
         self.__daq = daq
         self.__flow_meter = flow_meter
         self.__detector = detector
         self.__blower_pid_thread = blower_pid_thread
-        self.__flow_queue = flow_meter_queue
-        self.__volt_queue = voltage_queue
-        self.__conc_queue = conc_queue
-        self.__daq_ai_queue = daq_ai_queue
+        self.__flow_meter_ftp = flow_meter_ftp
+        self.__bus = bus  # Bins, scans and total concentrations are published to the bus
+        self.__daq_ai = daq_ai
         self.__detector_lock = detector_lock
         self.__daq_lock = daq_lock
-        self.__gas_temp_0 = 293.0  # Unit is K, used in calc_x methods
 
         self.stop = False  # Used to stop the thead
-        self.reset_plot = False  # TODO: Remove?
         self.started = False
 
-        # Create lists of particle diameters, used in the measurements
-        # It is possible to generate more lists by adding parameters to the ini file and
-        # config.py and generating here a new list and assigning it to an instance variable
-
-        # E.g. Add content to:
-        # - the ini file(copy how it was done in Dma section),
-        # - config.py (new conf to __init__ and get_configuration method)
-        # - and add below line: self.__medium_particle_diameters = self.gen_particle_diameters_list("medium")
-        self.__s_particle_d_list = self.__gen_particle_diameters_list("small")
-        self.__l_particle_d_list = self.__gen_particle_diameters_list("large")
+        # Segments of the measurement cycle from the ini file's scan plan, ordered to minimize flow and valve changes
+        # More segments (E.g. medium particles) can be measured by adding a Scan_plan:<segment> section to the ini file
+        self.__segments = scan_plans.order_segments(conf, scan_plans.load_segments(conf))
 
         logging.info("Created AutomaticMeasurementThread object")
 
-    def __gen_particle_diameters_list(self, particle_size: str) -> list:
+    def __wait_for_settle(self, voltage: float) -> float:
         """
-        Return list of particle diameters with desired interval between diameters
+        Wait until the HV readback (and the daq flow if settle_flow_tol > 0) is within the tolerances for settle_samples
+        consecutive daq AI readings. Waits at least settle_min_t and at most settle_max_t (s)
 
-        You must give parameter from the ini file(E.g. small or large) depending on what kind of list you want
+        Return the time waited (s)
         """
 
-        p_d_min = float(self.__dma_conf.get(f"{particle_size}_p_d_min"))
-        p_d_max = float(self.__dma_conf.get(f"{particle_size}_p_d_max"))
-        p_d_list_size = int(self.__dma_conf.get(f"number_of_{particle_size}_p"))
+        min_wait = float(self.__auto_measurement_conf.get("settle_min_t"))
+        max_wait = float(self.__auto_measurement_conf.get("settle_max_t"))
+        hv_tol = float(self.__auto_measurement_conf.get("settle_hv_tol"))
+        hv_abs_tol = float(self.__auto_measurement_conf.get("settle_hv_abs_tol"))
+        flow_tol = float(self.__auto_measurement_conf.get("settle_flow_tol"))
+        required_samples = int(self.__auto_measurement_conf.get("settle_samples"))
+        hvi_chan = int(self.__daq_scaling_conf.get("hvi_chan"))
+        f_chan = int(self.__daq_scaling_conf.get("f_chan"))
+        target_flow = self.__blower_pid_thread.get_target_flow()
+
+        start_time = self.__clock.monotonic()
+        self.__clock.sleep(min_wait)
+
+        stable_samples = 0
+        seq = self.__daq_ai.seq  # Only the readings after the minimum wait are checked
+        while stable_samples < required_samples and not self.stop:
+            remaining = max_wait - (self.__clock.monotonic() - start_time)
+            if remaining <= 0.0:
+                logging.warning(f"HV did not settle to {voltage:.3f} V in {max_wait} s")
+                break
 
-        # Use log and then **10 to get list of diameters at correct interval
-        particle_diameter_list = numpy.linspace(numpy.log10(p_d_min), numpy.log10(p_d_max), p_d_list_size)
-        particle_diameter_list = numpy.power(10, particle_diameter_list)
+            sample = self.__daq_ai.wait_newer_than(seq, remaining)  # Updated by the daq thread
+            if sample is None:
+                continue
+            seq = sample.seq
+            ai_voltages = sample.value
+            hv_in = self.__daq.scale_value("hvi", ai_voltages[hvi_chan])
+            settled = abs(hv_in - voltage) <= hv_tol * abs(voltage) + hv_abs_tol
+            if flow_tol > 0.0:
+                settled = settled and abs(self.__daq.scale_value("f", ai_voltages[f_chan]) - target_flow) <= flow_tol
 
-        logging.info(f"Generated {particle_size} particle diameters list")
+            # Readings must be within the tolerances one after another
+            stable_samples = stable_samples + 1 if settled else 0
 
-        return particle_diameter_list
+        return self.__clock.monotonic() - start_time
 
-    def __calc_p_mean_free_path(self, gas_pressure: float, gas_temp: float) -> float:
-        """
-        Return particle's mean free path at gas_temp_0 and 1013.25 hPa
+    def __count_pulses_adaptive(self, max_count_time: float) -> typing.Tuple[float, float]:
         """
+        Count cpc's pulses with the daq until the counts' Poisson relative error (1 / sqrt(counts)) is under
+        count_target_rel_error or max_count_time is reached. Counts at least count_min_t (s)
 
-        mean_free_path_0 = 67.3e-9  # Unit is m
-        gas_pressure_0 = 101325.0
-        gas_pressure = gas_pressure * 1000.0  # kPa to Pa
-        gas_temp = gas_temp + 273.15  # °C to K
+        Return counts and the time counted (s)
+        """
 
-        particle_mean_free_path = mean_free_path_0 * ((gas_temp / self.__gas_temp_0) ** 2.0) * (
-                gas_pressure_0 / gas_pressure) * ((self.__gas_temp_0 + 110.4) / (gas_temp + 110.4))
+        target_counts = float(self.__auto_measurement_conf.get("count_target_rel_error")) ** -2.0
+        min_count_time = float(self.__auto_measurement_conf.get("count_min_t"))
+        check_interval = float(self.__auto_measurement_conf.get("count_check_t"))
 
-        return particle_mean_free_path
+        if not self.__daq.ctr_buffered():
+            self.__daq_lock.acquire()
+            self.__daq.rst_ctr_task()  # Reset daq's counter
+            self.__daq_lock.release()
+            reset_time = self.__clock.monotonic()
+
+            def read_counter() -> typing.Tuple[float, float]:
+                self.__daq_lock.acquire()
+                counts = self.__daq.read_ctr_task()  # Counts since the reset
+                self.__daq_lock.release()
+                return counts, self.__clock.monotonic() - reset_time
+        else:
+            # Counts and time from the buffered counter's position, the time is a whole number of sample intervals
+            self.__daq_lock.acquire()
+            start_samples, start_total = self.__daq.get_ctr_position()
+            sample_period = self.__daq.get_sample_period()
+            self.__daq_lock.release()
 
-    def __gen_cunningham_corrected_list(self, p_mean_free_path: float, p_d_list: list) -> list:
-        """
-        TODO: Make static?
-        Generates list of particle diameters with cunningham correction
-        """
+            def read_counter() -> typing.Tuple[float, float]:
+                self.__daq_lock.acquire()
+                samples, total = self.__daq.get_ctr_position()
+                self.__daq_lock.release()
+                return total - start_total, (samples - start_samples) * sample_period
 
-        p_cunn_corr_list = 1.0 + numpy.divide(2.0 * p_mean_free_path, p_d_list) * (
-                1.165 + 0.483 * numpy.exp(-0.997 * numpy.divide(p_d_list, 2.0 * p_mean_free_path)))
+        self.__clock.sleep(min(min_count_time, max_count_time))
+        daq_counts, counted_t = read_counter()
+        # Stop when enough counts or the time is up, the last check interval may go over max_count_time
+        while daq_counts < target_counts and counted_t < max_count_time and not self.stop:
+            self.__clock.sleep(check_interval)
+            daq_counts, counted_t = read_counter()
 
-        return p_cunn_corr_list
+        return daq_counts, max(counted_t, 1e-9)
 
-    def __calc_dyn_gas_visc(self, gas_temp: float) -> float:
+    def __count_pulses(self, pulse_count_time: float, window: typing.Tuple[int, int] = None,
+                       adaptive: bool = False) -> typing.Tuple[float, float]:
         """
-        Return dynamic gas viscosity at gas_temp_0 and 1013.25 hPa
-        """
-
-        n0 = 1.83245e-5  # Unit is kg/ms
-        gas_temp = gas_temp + 273.15  # Convert °C to K
+        Count cpc's pulses with the daq for pulse_count_time. If adaptive pulse_count_time is the maximum time
 
-        dynamic_gas_visc = n0 * ((gas_temp / self.__gas_temp_0) ** (3.0 / 2.0)) * (
-                (self.__gas_temp_0 + 110.4) / (gas_temp + 110.4))
+        With the buffered counter a counting window (start sample, end sample) can be given instead, E.g. a step of the
+        voltage staircase. Return counts and the time counted (s)
+        """
 
-        return dynamic_gas_visc
+        if window is None and adaptive:
+            return self.__count_pulses_adaptive(pulse_count_time)
 
-    def __gen_p_mobility_list(self, particle_cunningham_correction: list, dynamic_gas_visc: float,
-                              particle_diameters_list: list) -> list:
-        """
-        TODO: Make static?
-        Return list of particle motion values
-        """
+        if not self.__daq.ctr_buffered():
+            self.__daq_lock.acquire()
+            self.__daq.rst_ctr_task()  # Reset daq's counter
+            self.__daq_lock.release()
 
-        particle_mobility_list = numpy.divide(numpy.multiply(1.602E-19, particle_cunningham_correction),
-                                              numpy.multiply(3.0 * numpy.pi * dynamic_gas_visc,
-                                                             particle_diameters_list))
+            pulse_count_start_time = self.__clock.monotonic()  # Record zero point for pulse count time
+            self.__clock.sleep(pulse_count_time)  # Count the cpc's pulses for pulse_count_time
 
-        return particle_mobility_list
+            self.__daq_lock.acquire()
+            daq_counts = self.__daq.read_ctr_task()  # Read Cpc's counts measured by the daq
+            self.__daq_lock.release()
 
-    def __gen_dma_voltages_list(self, dma_sheath_flow: float, flow_meter_pressure: float,
-                                flow_meter_temp: float, particle_d_list: list) -> list:
-        """
-        Return list of dma voltages corresponding to desired particle diameters
-        """
+            # Calculate how long counted
+            return daq_counts, self.__clock.monotonic() - pulse_count_start_time
 
-        particle_mean_free_path = self.__calc_p_mean_free_path(flow_meter_pressure, flow_meter_temp)
-        cunningham_correction_list = self.__gen_cunningham_corrected_list(particle_mean_free_path, particle_d_list)
-        dynamic_gas_viscosity = self.__calc_dyn_gas_visc(flow_meter_temp)
-        particle_mobility_list = self.__gen_p_mobility_list(cunningham_correction_list, dynamic_gas_viscosity,
-                                                            particle_d_list)
-        # Convert to cm**3/s
-        dma_sheath_flow = dma_sheath_flow / 1000.0 / 60.0
+        # Buffered counter is latched on the sample clock, so the counting window is a whole number of sample clock
+        # intervals and its length is exact
+        self.__daq_lock.acquire()
+        sample_period = self.__daq.get_sample_period()
+        if window is None:
+            start_sample, _ = self.__daq.get_ctr_position()
+            window = (start_sample, start_sample + max(round(pulse_count_time / sample_period), 1))
+        self.__daq_lock.release()
 
-        # Read values from the ini file
-        length = float(self.__dma_conf.get("length"))
-        in_electrode_r = float(self.__dma_conf.get("in_electrode_r"))
-        out_electrode_r = float(self.__dma_conf.get("out_electrode_r"))
+        # Wait until the daq thread has read the whole window
+        wait_for_sample(self.__daq, self.__daq_lock, self.__clock, window[1], lambda: self.stop)
 
-        dma_voltages_list = numpy.multiply(
-            numpy.divide(dma_sheath_flow / 2.0 / numpy.pi / length, particle_mobility_list),
-            numpy.log(out_electrode_r / in_electrode_r))
+        self.__daq_lock.acquire()
+        interval_counts = self.__daq.get_ctr_interval_counts(*window)
+        self.__daq_lock.release()
 
-        return dma_voltages_list
+        return int(interval_counts.sum()), max(len(interval_counts), 1) * sample_period
 
-    def __get_time(self, time_zone: str, time_format: str) -> typing.Tuple[str, str]:
+    def __measure_conc(self, pulse_count_time: float, window: typing.Tuple[int, int] = None,
+                       adaptive: bool = False) -> typing.Tuple[float, float, float, float]:
         """
-        TODO: Make static?
-        Get utc and local time
-        Return them formatted
+        Count cpc's pulses with the daq and the cpc for pulse_count_time or for the buffered counter's window
+
+        Return concentration calculated from the daq's counts, from the cpc's counts and from the cpc's 1s average
+        and the time counted (s)
         """
 
-        # Current time in UTC
-        utc_time = datetime.now(timezone("UTC"))
-        # Convert to the time zone
-        local_time = utc_time.astimezone(timezone(time_zone))
+        # Start counting by cpc
+        self.__detector_lock.acquire()
+        self.__detector.read_d()  # Reset cpc's counter
+        self.__detector_lock.release()
+
+        daq_counts, counts_counted_t = self.__count_pulses(pulse_count_time, window, adaptive)
 
-        # Format the times
-        utc_str = utc_time.strftime(time_format)
-        local_str = local_time.strftime(time_format)
+        # Read the counts
+        self.__detector_lock.acquire()
+        cpc_counts = self.__detector.read_d()  # Read counts recorded by the Cpc (counts per second)
+        self.__detector_lock.release()
 
-        return utc_str, local_str
+        # Calculate concentration in different ways
+        cpc_conc = daq_counts / float(self.__auto_measurement_conf.get("flow")) / counts_counted_t
+        self.__detector_lock.acquire()
+        cpc_conc_s = self.__detector.read_rd() / float(self.__auto_measurement_conf.get("flow_c"))
+        self.__detector_lock.release()
+        cpc_conc_d = cpc_counts / float(self.__auto_measurement_conf.get("flow_d"))
 
-    def __conc_measurement_loop(self, dma_voltages_list: list, file, particle_d_list: list) -> None:
+        return cpc_conc, cpc_conc_d, cpc_conc_s, counts_counted_t
+
+    def __conc_measurement_loop(self, dma_voltages_list: list, file, particle_d_list: list,
+                                segment: scan_plans.ScanSegment) -> typing.List[dict]:
         """
-        Loop though list of dma voltages, set the voltages and measure concentration
+        Loop though list of dma voltages, set the voltages and measure concentration with the segment's dwell policy
+
+        Return the measured bins that were published to the bus
         """
 
-        # Time waited after voltage change (s)
-        between_voltages_wait = float(self.__auto_measurement_conf.get("between_voltages_wait_t"))
-        # Time to count cpc's pulses (s)
-        pulse_count_time = float(self.__auto_measurement_conf.get("pulse_count_t"))
+        between_voltages_wait = segment.settle_t  # Time waited after voltage change (s)
+        pulse_count_time = segment.pulse_count_t  # Time to count cpc's pulses (s)
 
-        # Loop through the voltages
-        for index, voltage in enumerate(dma_voltages_list, start=0):
+        # With the staircase the daq steps the voltages on its sample clock and the counting windows are known
+        # beforehand
+        windows = []
+        if segment.dwell == "staircase":
             self.__daq_lock.acquire()
-            self.__daq.set_ao(voltage)  # Set HV voltage
+            windows = self.__daq.start_voltage_staircase(dma_voltages_list, between_voltages_wait, pulse_count_time)
             self.__daq_lock.release()
+            if not windows:
+                logging.warning("Voltage staircase not available, setting the voltages one by one")
 
-            # Wait the voltage to settle
-            sleep(between_voltages_wait)
-
-            # Read flow, temp and pressure from the flow queue
-            # The queue is updated by blower pid thread
-            flow_meter_flow, flow_meter_temp, flow_meter_pressure = self.__flow_queue.get()
+        scan_bins = []
+        # Loop through the voltages
+        for index, voltage in enumerate(dma_voltages_list, start=0):
+            if windows:
+                # Wait until the voltage has settled, the daq has already set it
+                wait_for_sample(self.__daq, self.__daq_lock, self.__clock, windows[index][0], lambda: self.stop)
+            else:
+                self.__daq_lock.acquire()
+                self.__daq.set_ao(voltage)  # Set HV voltage
+                self.__daq_lock.release()
+
+                # Wait the voltage to settle
+                if segment.adaptive_settle():
+                    settle_time = self.__wait_for_settle(voltage)
+                    logging.info(f"Voltage {voltage:.3f} V (bin {index}) settled in {settle_time:.2f} s")
+                else:
+                    self.__clock.sleep(between_voltages_wait)
+
+            # Read the latest flow, temp and pressure
+            # The mailbox is updated by blower pid thread
+            ftp = wait_for_value(self.__flow_meter_ftp, "flow meter", lambda: self.stop)
+            # Read the latest AI voltages
+            ai_voltages = wait_for_value(self.__daq_ai, "daq ai", lambda: self.stop)  # List index = channel number
+            if ftp is None or ai_voltages is None:  # Thread was stopped
+                break
+            flow_meter_flow, flow_meter_temp, flow_meter_pressure = ftp
 
-            # Read AI voltages from the daq queue
-            ai_voltages = self.__daq_ai_queue.get()  # List index = channel number
             # HV_in
             chan = int(self.__daq_scaling_conf.get("hvi_chan"))  # channel number
             hv_in_v = ai_voltages[chan]
@@ -216,183 +354,281 @@ class AutomaticMeasurementThread(Thread):
             chan = int(self.__daq_scaling_conf.get("f_chan"))  # channel number
             daq_flow = self.__daq.scale_value("f", ai_voltages[chan])
 
-            # Start counting by cpc and daq
-            self.__detector_lock.acquire()
-            self.__detector.read_d()  # Reset cpc's counter
-            self.__detector_lock.release()
-
-            self.__daq_lock.acquire()
-            self.__daq.rst_ctr_task()  # Reset daq's counter
-            self.__daq_lock.release()
-
-            pulse_count_start_time = time()  # Record zero point for pulse count time
-            sleep(pulse_count_time)  # Count the cpc's pulses for pulse_count_time
-
-            # Read the counts
-            self.__detector_lock.acquire()
-            cpc_counts = self.__detector.read_d()  # Read counts recorded by the Cpc (counts per second)
-            self.__detector_lock.release()
-
-            self.__daq_lock.acquire()
-            daq_counts = self.__daq.read_ctr_task()  # Read Cpc's counts measured by the daq
-            self.__daq_lock.release()
-
-            # Calculate how long counted
-            counts_counted_t = time() - pulse_count_start_time
-
-            # Calculate concentration in different ways
-            cpc_conc = daq_counts / float(self.__auto_measurement_conf.get("flow")) / counts_counted_t
-            self.__detector_lock.acquire()
-            cpc_conc_s = self.__detector.read_rd() / float(self.__auto_measurement_conf.get("flow_c"))
-            self.__detector_lock.release()
-            cpc_conc_d = cpc_counts / float(self.__auto_measurement_conf.get("flow_d"))
+            # Count the cpc's pulses and calculate the concentration in different ways
+            cpc_conc, cpc_conc_d, cpc_conc_s, count_t = self.__measure_conc(
+                pulse_count_time, windows[index] if windows else None, segment.adaptive_count())
 
-            # Send data to queue to be plotted by GUI
-            self.__volt_queue.put_nowait(voltage)
-            self.__conc_queue.put_nowait(cpc_conc)
+            # Publish the bin, E.g. to be plotted by GUI
+            scan_bin = {"segment": segment.name, "diameter": particle_d_list[index], "voltage": voltage,
+                        "hv_in": hv_in_v, "conc": cpc_conc, "conc_d": cpc_conc_d, "conc_s": cpc_conc_s,
+                        "count_t": count_t}
+            self.__bus.publish("bin", scan_bin)
+            scan_bins.append(scan_bin)
 
             # Get current utc and local time
-            time_utc, time_local = self.__get_time("Europe/Helsinki", "%Y-%m-%d %H:%M:%S %Z%z")
+            time_utc, time_local = get_time(self.__clock, "Europe/Helsinki", "%Y-%m-%d %H:%M:%S %Z%z")
 
+            line = (f"{time_local}    {flow_meter_temp:.3f}    {flow_meter_pressure:.3f}    {daq_flow:.3f}    "
+                    f"{flow_meter_flow:.3f}    {particle_d_list[index] * 1e9:.3f}    {hv_in_v:.3f}    {voltage:.3f}    "
+                    f"{cpc_conc:.3f}    {cpc_conc_d:.3f}    {cpc_conc_s:.3f}    {count_t:.3f}")
             # Write to the file
-            file.write(
-                f"{time_local}    {flow_meter_temp:.3f}    {flow_meter_pressure:.3f}    {daq_flow:.3f}    {flow_meter_flow:.3f}    {particle_d_list[index] * 1e9:.3f}    {hv_in_v:.3f}    {voltage:.3f}    {cpc_conc:.3f}    {cpc_conc_d:.3f}    {cpc_conc_s:.3f}")
+            file.write(line)
             file.write("\n")
             # Print TODO: Send to the gui
-            print(
-                f"{time_local}    {flow_meter_temp:.3f}    {flow_meter_pressure:.3f}    {daq_flow:.3f}    {flow_meter_flow:.3f}    {particle_d_list[index] * 1e9:.3f}    {hv_in_v:.3f}    {voltage:.3f}    {cpc_conc:.3f}    {cpc_conc_d:.3f}    {cpc_conc_s:.3f}")
+            print(line)
 
             # If true, the thread must be stopped so exit the loop
             if self.stop:
                 break
 
+        if windows:
+            self.__daq_lock.acquire()
+            self.__daq.stop_ao_waveform()
+            self.__daq_lock.release()
+
+        return scan_bins
+
+    def __measure_segment(self, segment: scan_plans.ScanSegment, file) -> None:
+        """
+        Set the segment's valves and flow and measure the concentration of its particle sizes
+        Segment without particle sizes measures the total concentration
+        """
+
+        self.__daq_lock.acquire()
+        self.__daq.set_do(self.__daq.conc_valve_task, segment.conc_valve)  # True = total conc, False = dma conc
+        self.__daq.set_do(self.__daq.bypass_valve_task, segment.bypass_valve)  # True = low flow, False = high flow
+        self.__daq_lock.release()
+
+        # Pid uses the valve state for the feed-forward even if the flow stays the same
+        flow = segment.sheath_flow if segment.sheath_flow is not None else self.__blower_pid_thread.get_target_flow()
+        self.__blower_pid_thread.set_target_flow(flow, segment.bypass_valve)
+        wait_for_flow(self.__blower_pid_thread, self.__plan_conf, lambda: self.stop)  # Valves change the flow too
+
+        ###############################
+        # Measure Total concentration #
+        ###############################
+        if len(segment.particle_d_list) == 0:
+            # Count the cpc's pulses and calculate the concentration in different ways
+            cpc_conc, cpc_conc_d, cpc_conc_s, count_t = self.__measure_conc(segment.pulse_count_t,
+                                                                            adaptive=segment.adaptive_count())
+            logging.info(f"Total concentration ({segment.name}): {cpc_conc:.3f} {cpc_conc_d:.3f} {cpc_conc_s:.3f}")
+            self.__bus.publish("total", {"segment": segment.name, "conc": cpc_conc, "conc_d": cpc_conc_d,
+                                         "conc_s": cpc_conc_s, "count_t": count_t})
+            return
+
+        ###################################
+        # Measure the segment's particles #
+        ###################################
+        # Sheath flow is used in dma voltage list calculations. Unit is L/min
+        dma_sheath_flow = self.__blower_pid_thread.get_target_flow()
+        # Updated by blower pid thread
+        ftp = wait_for_value(self.__flow_meter_ftp, "flow meter", lambda: self.stop)
+        if ftp is None:  # Thread was stopped
+            return
+        tsi_flow, tsi_temp, tsi_pressure = ftp
+        dma_voltages = dma_physics.gen_dma_voltages_list(self.__dma_conf, dma_sheath_flow, tsi_pressure, tsi_temp,
+                                                         segment.particle_d_list)
+        scan_time_utc, scan_time_local = get_time(self.__clock, "Europe/Helsinki", "%Y-%m-%d %H:%M:%S %Z%z")
+
+        # Print header
+        print(
+            "Time                             Temp      P          Daq_f    Tsi_f     P_size   HV_in   HV_out     "
+            "conc    conc_d    conc_s    count_t")
+
+        # Set voltages and measure concentration. Print and write to the file
+        scan_bins = self.__conc_measurement_loop(dma_voltages, file, segment.particle_d_list, segment)
+        # Gas state of the voltage calculation is published for the inversion
+        self.__bus.publish("scan", {"segment": segment.name, "bins": scan_bins, "time": scan_time_local,
+                                    "sheath_flow": dma_sheath_flow, "temp": tsi_temp, "pressure": tsi_pressure})
+
+        # Set HV to zero
+        self.__daq_lock.acquire()
+        self.__daq.set_ao(0.0)
+        self.__daq_lock.release()
+
+        # file.write("\n")
+        # Waiting time after one particle list measurement loop (s)
+        self.__clock.sleep(float(self.__auto_measurement_conf.get("cycle_wait_t")))
+
     def run(self):
         """
         When the thread is started measure cpc concentration with various methods until self.stop is set to False
         """
 
         logging.info(f"Started the automatic measurement thread")
-        # Waiting time after one measurement loop (s)
-        cycle_wait_time = float(self.__auto_measurement_conf.get("cycle_wait_t"))
 
         # Ensure that run method is in infinite loop until self.stop is set to True (and self.started is True)
         while not self.started and not self.stop:
-            sleep(1)
+            self.__clock.sleep(1)
+
+        if self.started:
+            cycle_duration = scan_plans.predict_cycle_duration(self.__conf, self.__segments)
+            order = ", ".join(f"{segment.name} x{segment.repeat}" for segment in self.__segments)
+            logging.info(f"Scan plan: {order}, predicted cycle duration {cycle_duration:.0f} s")
 
         while not self.stop and self.started:
-            # Create a new data file for each day
-            file_time_utc, file_time_local = self.__get_time("Europe/Helsinki", "%Y%m%d")
+            # Create a new data file for each day. Each size bin is a line with the columns Time, Temp, P, Daq_f, Tsi_f,
+            # P_size, HV_in, HV_out, conc, conc_d, conc_s and count_t (counting time, s). Older files lack count_t
+            file_time_utc, file_time_local = get_time(self.__clock, "Europe/Helsinki", "%Y%m%d")
             file = open(f"data/DMPS-4_{file_time_local}.scan", "a")
 
-            ###########################
-            # Measure small particles #
-            ###########################
-            dma_sheath_flow = 20.0  # Used in dma voltage list calculations. Unit is L/min
-            self.__daq_lock.acquire()
-            self.__daq.set_do(self.__daq.conc_valve_task, False)  # Dma concentration
-            self.__daq.set_do(self.__daq.bypass_valve_task, False)  # High flow
-            self.__daq_lock.release()
+            # Measure the segments in the planned order
+            for segment in self.__segments:
+                for _ in range(segment.repeat):
+                    if self.stop:
+                        break
+                    self.__measure_segment(segment, file)
 
-            self.__blower_pid_thread.set_target_flow(dma_sheath_flow)
+            file.close()
 
-            tsi_flow, tsi_temp, tsi_pressure = self.__flow_queue.get()  # Updated by blower pid thread
-            dma_voltages = self.__gen_dma_voltages_list(dma_sheath_flow, tsi_pressure, tsi_temp,
-                                                        self.__s_particle_d_list)
+        self.__daq.set_ao(0.0)
+        logging.info(f"Ended the Automatic measurement thread")
 
-            # Print header
-            print(
-                "Time                             Temp      P          Daq_f    Tsi_f     P_size   HV_in   HV_out     "
-                "conc    conc_d    conc_s")
 
-            # Set voltages and measure concentration
-            self.__conc_measurement_loop(dma_voltages, file, self.__s_particle_d_list)
+class ContinuousScanThread(Thread):
+    """
+    Thread ramps the DMA voltage exponentially and counts cpc's pulses in short time bins during the ramp (SMPS)
 
-            # Set HV to zero
-            self.__daq_lock.acquire()
-            self.__daq.set_ao(0.0)
-            self.__daq_lock.release()
+    The daq outputs the ramp and counts the pulses with the same sample clock, so each bin's voltage is known exactly.
+    Bins are converted to particle diameters. Has the same start and stop attributes as AutomaticMeasurementThread
+    """
 
-            # file.write("\n")
-            sleep(cycle_wait_time)  # Waiting time after one particle list measurement loop (s)
-            self.reset_plot = True  # TODO: OK?
+    def __init__(self, conf: config.Config, daq: ni_daqs.NiDaq, blower_pid_thread: pid_ftp_thread.BlowerPidThread,
+                 flow_meter_ftp: mailboxes.LatestValue, bus: measurement_bus.MeasurementBus, daq_lock: Lock,
+                 clock: clocks.Clock = None) -> None:
+        Thread.__init__(self)  # Call Thread constructor
 
-            ###########################
-            # Measure large particles #
-            ###########################
-            dma_sheath_flow = 5.0  # Used in dma voltage list calculations. Unit is L/min
-            self.__daq_lock.acquire()
-            self.__daq.set_do(self.__daq.conc_valve_task, False)  # Dma concentration
-            self.__daq.set_do(self.__daq.bypass_valve_task, True)  # Low flow
-            self.__daq_lock.release()
+        self.__clock = clock if clock is not None else clocks.Clock()
+        self.__dma_conf = conf.get_configuration("Dma")
+        self.__auto_measurement_conf = conf.get_configuration("Automatic_measurement")
+        self.__scan_conf = conf.get_configuration("Continuous_scan")
+        self.__plan_conf = conf.get_configuration("Scan_plan")  # Flow settle settings
+        self.__daq = daq
+        self.__blower_pid_thread = blower_pid_thread
+        self.__flow_meter_ftp = flow_meter_ftp
+        self.__bus = bus  # Bins and scans are published to the bus
+        self.__daq_lock = daq_lock
 
-            self.__blower_pid_thread.set_target_flow(dma_sheath_flow)
+        self.stop = False  # Used to stop the thead
+        self.started = False
 
-            tsi_flow, tsi_temp, tsi_pressure = self.__flow_queue.get()  # updated by blower pid thread
-            dma_voltages = self.__gen_dma_voltages_list(dma_sheath_flow, tsi_pressure, tsi_temp,
-                                                        self.__l_particle_d_list)
+        logging.info("Created ContinuousScanThread object")
 
-            # Print header
-            print(
-                "Time                             Temp      P          Daq_f    Tsi_f     P_size   HV_in   HV_out     "
-                "conc    conc_d    conc_s")
+    def __scan(self, start_voltage: float, end_voltage: float) -> typing.Optional[typing.Tuple[numpy.ndarray,
+                                                                                               numpy.ndarray, float]]:
+        """
+        Ramp the voltage and count the pulses
 
-            # Set voltages and measure conc. Print and write to the file
-            self.__conc_measurement_loop(dma_voltages, file, self.__l_particle_d_list)
+        Return bins' voltages, bins' counts and the bin length (s) or None if the scan failed or was stopped
+        """
 
-            # Set HV to zero
-            self.__daq_lock.acquire()
-            self.__daq.set_ao(0.0)
-            self.__daq_lock.release()
+        ramp_time = float(self.__scan_conf.get("ramp_t"))
 
-            # file.write("\n")
-            sleep(cycle_wait_time)  # Waiting time after one measurement loop (s)
-            self.reset_plot = True  # TODO: OK?
+        self.__daq_lock.acquire()
+        sample_period = self.__daq.get_sample_period()
+        ramp = self.__daq.start_voltage_ramp(start_voltage, end_voltage, ramp_time)
+        self.__daq_lock.release()
+        if ramp is None:
+            return None
 
-            ###############################
-            # Measure Total concentration #
-            ###############################
-            pulse_count_time = float(
-                self.__auto_measurement_conf.get("pulse_count_t"))  # Time to count cpc's pulses (s)
+        # Counts reach the cpc delay_t after the voltage
+        delay_samples = round(float(self.__scan_conf.get("delay_t")) / sample_period)
+        wait_for_sample(self.__daq, self.__daq_lock, self.__clock, ramp[1] + delay_samples, lambda: self.stop)
 
-            self.__daq_lock.acquire()
-            self.__daq.set_do(self.__daq.conc_valve_task, True)  # Total conc
-            self.__daq.set_do(self.__daq.bypass_valve_task, True)  # Low flow, does not really matter(?)
-            self.__daq_lock.release()
+        self.__daq_lock.acquire()
+        self.__daq.stop_ao_waveform()
+        interval_counts = self.__daq.get_ctr_interval_counts(ramp[0] + delay_samples, ramp[1] + delay_samples)
+        self.__daq_lock.release()
 
-            # Start counting by cpc and daq
-            self.__detector_lock.acquire()
-            self.__detector.read_d()  # Reset cpc's counter
-            self.__detector_lock.release()
+        ramp_samples = ramp[1] - ramp[0]
+        if self.stop or len(interval_counts) < ramp_samples:
+            return None
 
-            self.__daq_lock.acquire()
-            self.__daq.rst_ctr_task()  # Reset daq's counter
-            self.__daq_lock.release()
+        # Sum the sample clock intervals to bins, the incomplete bin at the end of the ramp is dropped
+        bin_samples = max(round(float(self.__scan_conf.get("bin_t")) / sample_period), 1)
+        bins = ramp_samples // bin_samples
+        bin_counts = interval_counts[:bins * bin_samples].reshape(bins, bin_samples).sum(axis=1)
+
+        # Voltage in the middle of each bin, same exponential as the ramp
+        bin_centers = (numpy.arange(bins) + 0.5) * bin_samples / ramp_samples
+        bin_voltages = start_voltage * (end_voltage / start_voltage) ** bin_centers
+
+        return bin_voltages, bin_counts, bin_samples * sample_period
+
+    def run(self) -> None:
+        """
+        When the thread is started scan until self.stop is set to True
+        """
 
-            pulse_count_start_time = time()  # Record zero point for pulse count time
-            sleep(pulse_count_time)  # Count the cpc's pulses for pulse_count_time
+        logging.info("Started the continuous scan thread")
+
+        while not self.started and not self.stop:
+            self.__clock.sleep(1)
 
-            # Read the counts
-            self.__detector_lock.acquire()
-            cpc_counts = self.__detector.read_d()  # Read counts recorded by the Cpc (counts per second)
-            self.__detector_lock.release()
+        while not self.stop and self.started:
+            file_time_utc, file_time_local = get_time(self.__clock, "Europe/Helsinki", "%Y%m%d")
+            file = open(f"data/DMPS-4_{file_time_local}.ramp", "a")
 
+            dma_sheath_flow = float(self.__scan_conf.get("sheath_flow"))  # Unit is L/min
             self.__daq_lock.acquire()
-            daq_counts = self.__daq.read_ctr_task()  # Read Cpc's counts measured by the daq
+            self.__daq.set_do(self.__daq.conc_valve_task, False)  # Dma concentration
+            self.__daq.set_do(self.__daq.bypass_valve_task, self.__scan_conf.get("bypass_valve") == "1")
             self.__daq_lock.release()
 
-            # Calculate how long counted
-            counts_counted_t = time() - pulse_count_start_time
+            self.__blower_pid_thread.set_target_flow(dma_sheath_flow, self.__scan_conf.get("bypass_valve") == "1")
+            wait_for_flow(self.__blower_pid_thread, self.__plan_conf, lambda: self.stop)
+
+            # Scan the voltages of the particle list's smallest and largest diameters
+            # Updated by blower pid thread
+            ftp = wait_for_value(self.__flow_meter_ftp, "flow meter", lambda: self.stop)
+            if ftp is None:  # Thread was stopped
+                file.close()
+                continue
+            tsi_flow, tsi_temp, tsi_pressure = ftp
+            particle_d_list = dma_physics.gen_particle_diameters_list(self.__dma_conf,
+                                                                      self.__scan_conf.get("particles"))
+            start_voltage, end_voltage = dma_physics.gen_dma_voltages_list(
+                self.__dma_conf, dma_sheath_flow, tsi_pressure, tsi_temp, [particle_d_list[0], particle_d_list[-1]])
+
+            # Wait at the start voltage so that the voltage and the flow settle before the ramp
+            self.__daq_lock.acquire()
+            self.__daq.set_ao(start_voltage)
+            self.__daq_lock.release()
+            self.__clock.sleep(float(self.__scan_conf.get("retrace_t")))
 
-            # Calculate concentration in different ways
-            cpc_conc = daq_counts / float(self.__auto_measurement_conf.get("flow")) / counts_counted_t
-            self.__detector_lock.acquire()
-            cpc_conc_s = self.__detector.read_rd() / float(self.__auto_measurement_conf.get("flow_c"))
-            self.__detector_lock.release()
-            cpc_conc_d = cpc_counts / float(self.__auto_measurement_conf.get("flow_d"))
+            time_utc, time_local = get_time(self.__clock, "Europe/Helsinki", "%Y-%m-%d %H:%M:%S %Z%z")
+            scan = self.__scan(start_voltage, end_voltage)
+            if scan is None:
+                if not self.stop:
+                    logging.error("Continuous scan failed, buffered analog inputs and counter are required")
+                file.close()
+                continue
 
-            self.reset_plot = True  # TODO: OK?
+            bin_voltages, bin_counts, bin_time = scan
+            bin_diameters = dma_physics.gen_p_diameters_list(self.__dma_conf, dma_sheath_flow, tsi_pressure,
+                                                             tsi_temp, bin_voltages)
+            bin_concs = bin_counts / float(self.__auto_measurement_conf.get("flow")) / bin_time
 
+            # Print header
+            print("Time                             Temp      P          Tsi_f     P_size   HV_out     counts    conc")
+
+            scan_bins = []
+            for voltage, diameter, counts, conc in zip(bin_voltages, bin_diameters, bin_counts, bin_concs):
+                # Publish the bin, E.g. to be plotted by GUI
+                scan_bin = {"segment": "continuous", "diameter": diameter, "voltage": voltage, "counts": int(counts),
+                            "conc": conc, "count_t": bin_time}
+                self.__bus.publish("bin", scan_bin)
+                scan_bins.append(scan_bin)
+
+                line = (f"{time_local}    {tsi_temp:.3f}    {tsi_pressure:.3f}    {tsi_flow:.3f}    "
+                        f"{diameter * 1e9:.3f}    {voltage:.3f}    {counts:d}    {conc:.3f}")
+                file.write(line)
+                file.write("\n")
+                print(line)
+
+            self.__bus.publish("scan", {"segment": "continuous", "bins": scan_bins, "time": time_local,
+                                        "sheath_flow": dma_sheath_flow, "temp": tsi_temp, "pressure": tsi_pressure})
             file.close()
 
         self.__daq.set_ao(0.0)
-        logging.info(f"Ended the Automatic measurement thread")
+        logging.info("Ended the continuous scan thread")
@@ -3,44 +3,83 @@ Thread for accessing values from the DAQ
 """
 
 import logging
-import queue
 from multiprocessing import Lock
 from threading import Thread
 
+import clocks
+import config
+import mailboxes
 import ni_daqs
 
 
 class DaqThread(Thread):
     """
-    Measure AI voltages from the daq and put them to a queue
+    Measure AI voltages from the daq and put them to a mailbox
+
+    With buffered acquisition the voltages are read in blocks measured by the daq's sample clock. Mean of each block is
+    put to the ai mailbox with the block's start time. Buffered counter's blocks are read at the same time and kept in
+    the daq's counter history
     """
 
-    def __init__(self, daq: ni_daqs.NiDaq, daq_ai_queue: queue.Queue, daq_lock: Lock) -> None:
+    def __init__(self, conf: config.Config, daq: ni_daqs.NiDaq, daq_ai: mailboxes.LatestValue, daq_lock: Lock,
+                 clock: clocks.Clock = None) -> None:
         Thread.__init__(self)  # Call Thread constructor
 
+        self.__timing_conf = conf.get_configuration("NI_DAQ_Timing")
         self.__daq = daq
-        self.__ai_queue = daq_ai_queue
+        self.__ai = daq_ai
         self.__daq_lock = daq_lock
+        self.__clock = clock if clock is not None else clocks.Clock()
         self.stop = False  # If set to True this thread's run loop stops
 
         logging.info("Created DaqThread")
 
+    def __read_block(self) -> None:
+        """
+        Wait until the next block of samples is measured, read it and publish it
+        """
+
+        rate = float(self.__timing_conf.get("ai_sample_rate"))
+        block_size = int(self.__timing_conf.get("ai_block_size"))
+
+        # Sleep while the daq measures the block instead of waiting for it while holding the lock
+        self.__daq_lock.acquire()
+        missing = block_size - self.__daq.ai_samples_available()
+        self.__daq_lock.release()
+        if missing > 0:
+            self.__clock.sleep(missing / rate)
+            return
+
+        self.__daq_lock.acquire()
+        block = self.__daq.read_ai_block()
+        if self.__daq.ctr_buffered():
+            self.__daq.read_ctr_block()  # Same sample clock, so the counter's block is ready too
+        self.__daq_lock.release()
+
+        if block is None:
+            self.__clock.sleep(block_size / rate)  # Don't spin if the read fails
+            return
+
+        # Average of the block, timestamped with the block's start so the consumers' latencies include the block
+        timestamp = self.__clock.monotonic() - (self.__clock.time() - block.start_time)
+        self.__ai.put(block.voltages.mean(axis=1).tolist(), timestamp)
+
     def run(self) -> None:
         """
-        Measure AI voltages from the daq and put them to a queue
+        Measure AI voltages from the daq and put them to the mailbox
         """
 
         logging.info("Started DaqThread")
 
         while not self.stop:
+            if self.__daq.ai_buffered():
+                self.__read_block()
+                continue
+
             self.__daq_lock.acquire()  # Wait until the daq is not in use
             voltages = self.__daq.measure_ai()
             self.__daq_lock.release()
 
-            if self.__ai_queue.full():  # If queue of max size 1 is full consume value and update queue with a new one
-                self.__ai_queue.get_nowait()
-                self.__ai_queue.put_nowait(voltages)
-            elif self.__ai_queue.empty():  # If queue is empty put new values there
-                self.__ai_queue.put_nowait(voltages)
+            self.__ai.put(voltages)
 
         logging.info("Stopped DaqThread")
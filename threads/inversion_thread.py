@@ -0,0 +1,175 @@
+"""
+Thread that inverts the completed scans to size distributions in the background
+"""
+
+import itertools
+import logging
+import queue
+import time
+import typing
+from threading import Thread
+
+import numpy
+
+import charging
+import clocks
+import config
+import inversion_pool
+import measurement_bus
+import timing_stats
+from threads import automatic_measurement
+
+
+class InversionThread(Thread):
+    """
+    Take the completed scans from the bus, invert them in the inversion pool's workers and publish the size
+    distributions to the bus ("size_distribution") and to the data file
+
+    Without workers (Inversion workers = 0 or the workers did not start) the scans are inverted in this thread. Either
+    way the measurement threads and the GUI don't wait for the inversion
+    """
+
+    def __init__(self, conf: config.Config, bus: measurement_bus.MeasurementBus, clock: clocks.Clock = None) -> None:
+        Thread.__init__(self)  # Call Thread constructor
+
+        self.__inversion_conf = conf.get_configuration("Inversion")
+        self.__dma_conf = conf.get_configuration("Dma")
+        self.__bus = bus
+        self.__clock = clock if clock is not None else clocks.Clock()
+        self.__queue_size = int(self.__inversion_conf.get("queue_size"))
+        # Scans that have not been submitted yet, the oldest scans are dropped if the inversion falls behind
+        self.__subscription = bus.subscribe("Inversion", ("scan",), size=self.__queue_size)
+        self.__pool = None
+        self.__scan_ids = itertools.count(1)
+        self.dropped = 0  # Scans dropped because the pool's queue was full
+        self.stats = timing_stats.LatencyStats("Inversion")  # Latency and compute time of the inverted scans
+        self.stop = False  # If set to True this thread's run loop stops
+
+        logging.info("Created InversionThread")
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Scans waiting for the inversion or being inverted
+        """
+
+        pool = self.__pool
+        return len(self.__subscription) + (pool.queue_depth if pool is not None else 0)
+
+    def __job(self, scan: dict) -> typing.Optional[inversion_pool.InversionJob]:
+        """
+        Return the scan as an inversion job or None if it can't be inverted
+        """
+
+        bins = numpy.array([(scan_bin["diameter"], scan_bin["voltage"], scan_bin["conc"])
+                            for scan_bin in scan["bins"]], dtype=float).reshape(-1, 3)
+        # Grid's diameters must increase, E.g. the stopped scan's bins or a descending scan are not in order
+        bins = bins[numpy.all(numpy.isfinite(bins), axis=1)]
+        bins = bins[numpy.argsort(bins[:, 0])]
+        if len(bins) < 2 or "sheath_flow" not in scan:
+            logging.debug(f"Scan of {scan['segment']} with {len(bins)} valid bins is not inverted")
+            return None
+
+        return inversion_pool.InversionJob(next(self.__scan_ids), scan["segment"], scan["time"], bins[:, 1],
+                                           bins[:, 0], bins[:, 2], scan["sheath_flow"], scan["temp"],
+                                           scan["pressure"], time.monotonic())
+
+    def __publish(self, result: inversion_pool.InversionResult) -> None:
+        """
+        Publish the size distribution to the bus and write it to the data file
+        """
+
+        job = result.job
+        if result.distribution is None:
+            logging.error(f"Inversion of the scan {job.scan_id} ({job.segment}) failed")
+            return
+
+        self.stats.add("latency", result.latency)
+        self.stats.add("compute", result.compute_time)
+        queue_depth = self.queue_depth
+
+        self.__bus.publish("size_distribution", {"segment": job.segment, "time": job.time, "diameter": job.diameters,
+                                                 "dndlogdp": result.distribution, "latency": result.latency,
+                                                 "queue_depth": queue_depth})
+
+        file_time_utc, file_time_local = automatic_measurement.get_time(self.__clock, "Europe/Helsinki", "%Y%m%d")
+        with open(f"data/DMPS-4_{file_time_local}.inv", "a") as file:
+            for diameter, dndlogdp in zip(job.diameters, result.distribution):
+                file.write(f"{job.time}    {job.segment}    {job.temp:.3f}    {job.pressure:.3f}    "
+                           f"{job.sheath_flow:.3f}    {diameter * 1e9:.3f}    {dndlogdp:.3f}\n")
+
+        logging.debug(f"Inverted scan {job.scan_id} ({job.segment}) in {result.compute_time * 1e3:.1f} ms, latency "
+                      f"{result.latency * 1e3:.1f} ms, queue depth {queue_depth}")
+
+    def __submit(self, job: inversion_pool.InversionJob) -> None:
+        """
+        Give the job to the pool or invert it in this thread if there is no pool
+        """
+
+        if self.__pool is not None and not self.__pool.alive:
+            logging.error("All inversion workers have stopped, inverting the scans in the inversion thread")
+            waiting = self.__pool.stop()
+            self.__publish_results()
+            self.__pool = None
+            for waiting_job in waiting:
+                self.__submit(waiting_job)
+
+        if self.__pool is None:
+            start_time = time.perf_counter()
+            distribution = inversion_pool.invert_job(self.__inversion_conf, self.__dma_conf, job)
+            compute_time = time.perf_counter() - start_time
+            self.__publish(inversion_pool.InversionResult(job, distribution, compute_time,
+                                                          time.monotonic() - job.submit_time))
+        elif not self.__pool.submit(job):
+            self.dropped += 1
+            logging.warning(f"Inversion queue is full, dropped scan {job.scan_id} ({job.segment}), "
+                            f"{self.dropped} dropped")
+
+    def __publish_results(self) -> None:
+        while True:
+            try:
+                result = self.__pool.results.get_nowait()
+            except queue.Empty:
+                return
+            self.__publish(result)
+
+    def run(self) -> None:
+        """
+        Invert the scans until self.stop is set to True
+        """
+
+        logging.info("Started the inversion thread")
+
+        # Table is computed once here, so the workers only read it
+        charging.get_table(self.__inversion_conf.get("charging_table_file"))
+
+        workers = int(self.__inversion_conf.get("workers"))
+        if workers > 0:
+            self.__pool = inversion_pool.InversionPool(workers, self.__queue_size)
+            if not self.__pool.start():
+                logging.warning("Inverting the scans in the inversion thread instead")
+                self.__pool = None
+
+        while not self.stop:
+            message = self.__subscription.get(timeout=0.1)
+            if message is not None:
+                job = self.__job(message.value)
+                if job is not None:
+                    self.__submit(job)
+
+            if self.__pool is not None:
+                self.__publish_results()
+
+        if self.__pool is not None:
+            self.__pool.stop()
+            self.__publish_results()  # Jobs that were finished before the stop
+
+        logging.info("Ended the inversion thread")
+
+    def log_timing(self) -> None:
+        """
+        Log the inversion's latency and compute time summaries and the dropped scans
+        """
+
+        self.stats.log_summary()
+        logging.info(f"Inversion: dropped {self.dropped} scans, queue depth {self.queue_depth}")
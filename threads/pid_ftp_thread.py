@@ -3,40 +3,139 @@ This file provides separate thread for running pid control on the blower
 """
 
 import logging
-import queue
+import math
 import typing  # Used for providing tuple type hint
 from multiprocessing import Lock
-from threading import Thread
+from threading import Lock as ThreadLock, Thread
 
 import nidaqmx
 from simple_pid import PID
 
+import clocks
 import config
+import flow_control
 import flow_meters
+import mailboxes
 import ni_daqs
+import periodic
+import timing_stats
 
 
 class BlowerPidThread(Thread):
     """
     Measures flow, temp and pressure from the flow meter and controls blower with pid to reach the target flow
+
+    With Pid:Daq_flow enabled the pid's feedback is the daq's flow channel, which is read from the daq_ai mailbox at
+    the section's control rate. The flow meter is then read in a second thread and only calibrates the daq's flow: the
+    daq flow is multiplied with a gain that follows flow meter flow / daq flow with the calibration time constant
     """
 
     def __init__(self, conf: config.Config, daq: ni_daqs.NiDaq, flow_meter: flow_meters.FlowMeter4000,
-                 ftp_queue: queue.Queue, flow_meter_lock: Lock, daq_lock: Lock, target_flow: float = 5) -> None:
+                 ftp: mailboxes.LatestValue, flow_meter_lock: Lock, daq_lock: Lock, target_flow: float = 5,
+                 clock: clocks.Clock = None, daq_ai: mailboxes.LatestValue = None) -> None:
         Thread.__init__(self)  # Call Thread constructor
 
         self.__pid_conf = conf.get_configuration("Pid")
+        self.__pid_timing_conf = conf.get_configuration("Pid_Timing")
+        self.__daq_flow_conf = conf.get_configuration("Pid_Daq_flow")
+        self.__streaming_conf = conf.get_configuration("Flow_Meter_Streaming")
+        self.__feed_forward_conf = conf.get_configuration("Pid_Feed_forward")
+        self.__daq_scaling_conf = conf.get_configuration("NI_DAQ_Scaling")
         self.__daq = daq
         self.__flow_meter = flow_meter
-        self.__ftp_queue = ftp_queue  # Put values read from the flow meter to this queue
+        self.__ftp = ftp  # Put values read from the flow meter to this mailbox
         self.__fw_lock = flow_meter_lock  # Used for waiting while serial settings are changed in the maintenance mode
         self.__daq_lock = daq_lock
+        self.__clock = clock if clock is not None else clocks.Clock()  # Pid's time steps are measured with the clock
         self.stop = False  # If set to True this thread's run loop stops
+        self.__last_time = self.__clock.monotonic()  # Time of the last pid update
+
+        # Polled control loop runs at the deadlines of the scheduler
+        self.__scheduler = periodic.DeadlineScheduler("Blower pid", float(self.__pid_timing_conf.get("control_rate")),
+                                                      self.__clock)
+        self.__stats = timing_stats.LatencyStats("Blower pid", log_interval=0)  # Flow reading and control latencies
+        self.__written = None  # (frequency, duty cycle) written last time to the blower
+        self.__write_time = -float("inf")  # Time of the last write
+        self.skipped_writes = 0  # Writes skipped because the duty cycle had not changed
+
+        # Daq flow feedback, the daq's ai voltages are put to the mailbox by the daq thread
+        self.__daq_ai = daq_ai
+        self.__daq_feedback = self.__daq_flow_conf.get("enabled") == "1" and daq_ai is not None
+        self.__daq_scheduler = None
+        if self.__daq_feedback:
+            self.__daq_scheduler = periodic.DeadlineScheduler(
+                "Blower daq pid", self.__daq_control_rate(conf.get_configuration("NI_DAQ_Timing")), self.__clock)
+        self.__daq_flow = None  # Latest uncalibrated flow of the daq's flow channel
+        self.calibration_gain = 1.0  # Flow meter flow / daq flow
+        self.__calibration_time = None  # Time of the last calibration
 
         frequency, sample_time, p, i, d = self.__read_pid_settings()  # Read settings from the dict
         self.__frequency = frequency
+        if self.__daq_feedback:
+            # Faster loop has its own tunings
+            sample_time = float(self.__daq_flow_conf.get("sample_time"))
+            p, i, d = (float(self.__daq_flow_conf.get(name)) for name in ("p", "i", "d"))
+        else:
+            sample_time = self.__streaming_sample_time(sample_time)
         self.__pid = PID(p, i, d, setpoint=target_flow, sample_time=sample_time)  # Create PID object
-        logging.info("Created BlowerPidThread")
+        # Same limits as the counter writer's duty cycle, so the integral term does not wind up while the output is
+        # clamped, E.g. when the blower slows down to a lower flow
+        self.__pid.output_limits = (5.0e-6, 999.995000e-3)
+        # Pid is used by the control loop, the measurement thread (set_target_flow) and the GUI (update_pid_settings)
+        self.__pid_lock = ThreadLock()
+
+        # Flow changes start from the learned duty cycle of the new flow and use the tunings of its flow range
+        self.__feed_forward = None
+        if self.__feed_forward_conf.get("enabled") == "1":
+            self.__feed_forward = flow_control.FeedForwardTable(float(self.__feed_forward_conf.get("learning_rate")),
+                                                                self.__feed_forward_conf.get("table_file"))
+        self.__gain_schedule = flow_control.GainSchedule(conf.get_configuration("Pid_Gain_schedule"))
+        self.__bypass_valve = None  # Bypass valve state given with the target flow, None = not known
+        self.__control_value = None  # Latest duty cycle computed by the pid
+        self.__steady_since = None  # Time since the flow has been within steady_tolerance of the target
+        self.__integral_hold_until = None  # Integral term is held until this time after a feed-forward jump
+        self.__apply_gain_schedule(target_flow)
+        logging.info(f"Created BlowerPidThread ({'daq' if self.__daq_feedback else 'flow meter'} flow feedback)")
+
+    def __daq_control_rate(self, timing_conf: dict) -> float:
+        """
+        Return the rate of the daq flow control loop
+
+        Loop only acts on new ai values, which the daq thread puts once per block. Control rate above the block rate is
+        lowered to it with a warning
+        """
+
+        control_rate = float(self.__daq_flow_conf.get("control_rate"))
+        sample_rate = float(timing_conf.get("ai_sample_rate"))
+        if sample_rate <= 0.0:
+            logging.warning("Daq flow feedback without buffered analog inputs (NI_DAQ:Timing ai_sample_rate = 0), "
+                            "the pid runs at the rate of the daq's single reads instead of the control rate")
+            return control_rate
+
+        block_rate = sample_rate / int(timing_conf.get("ai_block_size"))
+        if block_rate < control_rate:
+            logging.warning(f"Daq's ai blocks arrive at {block_rate:g} Hz, slower than Pid:Daq_flow control_rate "
+                            f"{control_rate:g} Hz. Pid runs at {block_rate:g} Hz, raise ai_sample_rate or lower "
+                            f"ai_block_size to reach the control rate")
+            return block_rate
+
+        return control_rate
+
+    def __streaming_sample_time(self, sample_time: float) -> float:
+        """
+        Return the pid's sample time for the flow meter feedback
+
+        In the flow meter's streaming mode every sample updates the pid, so the sample time is the stream's sample
+        interval. Otherwise simple_pid would skip the samples that come within the sample time
+        """
+
+        if self.__streaming_conf.get("enabled") != "1":
+            return sample_time
+
+        interval = int(self.__streaming_conf.get("sample_interval")) / 1000.0
+        if interval != sample_time:
+            logging.info(f"Pid's sample time is the flow meter's sample interval {interval} s, not {sample_time} s")
+        return interval
 
     def __read_pid_settings(self) -> typing.Tuple[float, float, float, float, float]:
         """
@@ -51,14 +150,104 @@ class BlowerPidThread(Thread):
 
         return frequency, sample_time, p, i, d
 
-    def set_target_flow(self, flow: float) -> None:
+    def set_target_flow(self, flow: float, bypass_valve: bool = None) -> None:
+        """
+        Set target flow to the pid. bypass_valve is the valve's state during the flow, None = not known
+
+        If the flow or the valve changes, the pid continues from the feed-forward duty cycle of the new flow, which is
+        written to the blower at once. Without a feed-forward the pid continues from its latest duty cycle
+        """
+
+        with self.__pid_lock:
+            changed = flow != self.__pid.setpoint or (bypass_valve is not None and bypass_valve != self.__bypass_valve)
+            if bypass_valve is not None:
+                self.__bypass_valve = bypass_valve
+
+            duty_cycle = None
+            if changed and self.__feed_forward is not None and self.__bypass_valve is not None:
+                duty_cycle = self.__feed_forward.lookup(flow, self.__bypass_valve)
+
+            self.__pid.auto_mode = False  # Pause updating pid control
+            self.__pid.setpoint = flow  # Set PID target flow
+            self.__apply_gain_schedule(flow)
+            self.__steady_since = None
+            if duty_cycle is not None:
+                # Integral term starts from the feed-forward, so the pid does not need to integrate to the new duty
+                # cycle
+                self.__pid.set_auto_mode(True, last_output=duty_cycle)
+                self.__control_value = duty_cycle
+                hold_t = float(self.__feed_forward_conf.get("integral_hold_t"))
+                self.__integral_hold_until = self.__clock.monotonic() + hold_t
+                self.__write_control(duty_cycle, self.__clock.monotonic())
+                logging.info(f"Feed-forward duty cycle {duty_cycle:.4f} for {flow} L/min")
+            else:
+                self.__pid.set_auto_mode(True, last_output=self.__control_value)  # Continue updating pid control
+
+    def __apply_gain_schedule(self, flow: float) -> None:
+        """
+        Use the tunings of the flow's range if the gain schedule is used. Call with the pid lock
+        """
+
+        tunings = self.__gain_schedule.tunings(flow)
+        if tunings is not None:
+            self.__pid.tunings = tunings
+            logging.info(f"Pid tunings {tunings} for {flow} L/min")
+
+    def __learn_feed_forward(self, flow: float, now: float) -> None:
         """
-        Set target flow to the pid
+        Learn the integral term as the target flow's duty cycle when the flow has been steady for steady_t
         """
 
-        self.__pid.auto_mode = False  # Pause updating pid control
-        self.__pid.setpoint = flow  # Set PID target flow
-        self.__pid.auto_mode = True  # Continue updating pid control
+        if self.__feed_forward is None or self.__bypass_valve is None:
+            return
+
+        if abs(flow - self.__pid.setpoint) > float(self.__feed_forward_conf.get("steady_tolerance")):
+            self.__steady_since = None
+        elif self.__steady_since is None:
+            self.__steady_since = now
+        elif now - self.__steady_since >= float(self.__feed_forward_conf.get("steady_t")):
+            self.__feed_forward.learn(self.__pid.setpoint, self.__bypass_valve, self.__pid.components[1])
+            self.__steady_since = now
+
+    def get_target_flow(self) -> float:
+        """
+        Return the pid's target flow
+        """
+
+        return self.__pid.setpoint
+
+    def wait_until_settled(self, tolerance: float, timeout: float, readings: int = 3,
+                           stop: typing.Callable[[], bool] = None) -> typing.Tuple[bool, float]:
+        """
+        Wait until the flow meter's flow is within tolerance (L/min) of the target flow for readings consecutive
+        readings, until timeout (s) or until stop returns True (E.g. the waiting thread's stop flag)
+
+        Return True if the flow settled and the time waited (s)
+        """
+
+        start_time = self.__clock.monotonic()
+        seq = self.__ftp.seq
+        readings_within = 0
+
+        while not self.stop and not (stop is not None and stop()):
+            elapsed = self.__clock.monotonic() - start_time
+            if elapsed >= timeout:
+                return False, elapsed
+
+            # Stop is checked at least every 0.1 s
+            sample = self.__ftp.wait_newer_than(seq, min(timeout - elapsed, 0.1))
+            if sample is None:
+                continue
+            seq = sample.seq
+            flow = sample.value[0]
+            if flow is not None and abs(flow - self.__pid.setpoint) <= tolerance:
+                readings_within += 1
+            else:
+                readings_within = 0
+            if readings_within >= readings:
+                return True, self.__clock.monotonic() - start_time
+
+        return False, self.__clock.monotonic() - start_time
 
     def update_pid_settings(self, target_flow: float, sample_time: float, p: float, i: float,
                             d: float, frequency: float) -> None:
@@ -66,47 +255,150 @@ class BlowerPidThread(Thread):
         Update PID settings
         """
 
-        self.__pid.auto_mode = False  # Pause updating pid control
-        self.__pid.setpoint = target_flow
-        self.__pid.sample_time = sample_time
-        self.__pid.tunings = (p, i, d)
-        self.__frequency = frequency
-        self.__pid.auto_mode = True  # Continue updating pid control
+        with self.__pid_lock:
+            self.__pid.auto_mode = False  # Pause updating pid control
+            self.__pid.setpoint = target_flow
+            if self.__daq_feedback:
+                logging.info("Pid uses the tunings of the Pid:Daq_flow section with the daq flow feedback")
+            else:
+                self.__pid.sample_time = self.__streaming_sample_time(sample_time)
+                self.__pid.tunings = (p, i, d)
+            self.__frequency = frequency
+            self.__pid.set_auto_mode(True, last_output=self.__control_value)  # Continue updating pid control
 
-    def run(self):
+    def log_timing(self) -> None:
         """
-        Measure flow, temperature and pressure from the flow meter. Only flow is used for controlling the blower.
-        Update pid control and control blower with pid.
+        Log the control loop's timing statistics
         """
 
-        logging.info("Started measuring flow meter values and controlling blower with pid")
-        control = 0  # Ensure that control is initialized to 0
+        self.__scheduler.log_summary()
+        if self.__daq_scheduler is not None:
+            self.__daq_scheduler.log_summary()
+            logging.info(f"Blower pid: daq flow calibration gain {self.calibration_gain:.4f}")
+        self.__stats.log_summary()
+        logging.info(f"Blower pid: {self.skipped_writes} unchanged writes skipped")
 
-        # Run until self.stop is set to True
-        while not self.stop:
-            # Ensures that flow meter's data is not tried to read at the same time that serial settings are changed
-            self.__fw_lock.acquire()
-            ftp = self.__flow_meter.read_ftp()  # Measure flow, temperature and pressure
-            self.__fw_lock.release()
+    def __write_control(self, control: float, sample_time: float) -> None:
+        """
+        Write the pulse frequency and duty cycle to the blower unless the same values were written less than rewrite_t
+        ago. Record the control latency from sample_time (clock's monotonic time when the flow was measured)
+        """
+
+        now = self.__clock.monotonic()
+        if (self.__frequency, control) == self.__written and \
+                now - self.__write_time < float(self.__pid_timing_conf.get("rewrite_t")):
+            self.skipped_writes += 1
+            return
+
+        # Write pulse according to pid control and frequency
+        # Timeout is set to default 10 -> 10s time to write the pulse
+        self.__daq_lock.acquire()
+        try:
+            self.__daq.cw_writer.write_one_sample_pulse_frequency(
+                self.__frequency, control)
+            self.__written = (self.__frequency, control)
+            self.__write_time = now
+        except nidaqmx.DaqError as e:
+            logging.error(e)
+            logging.debug("Tried to use counter writer too often!")
+        self.__daq_lock.release()
 
-            # Put the ftp values to the queue to be shared with other threads
-            if self.__ftp_queue.full():  # If queue of max size 1 is full consume value and update queue with a new one
-                self.__ftp_queue.get_nowait()
-                self.__ftp_queue.put_nowait(ftp)
-            elif self.__ftp_queue.empty():  # If queue is empty put new ftp values there
-                self.__ftp_queue.put_nowait(ftp)
+        self.__stats.add("control latency", self.__clock.monotonic() - sample_time)
 
-            flow = ftp[0]  # Get flow from the ftp
+    def __share(self, ftp: typing.Tuple[float, float, float]) -> None:
+        """
+        Share the flow meter's sample with the other threads, wait_until_settled waits for them too
+        """
+
+        self.__ftp.put(ftp)  # Share the ftp values with other threads
+
+    def __control(self, ftp: typing.Tuple[float, float, float], sample_time: float = None) -> None:
+        """
+        Share the flow meter's sample, update the pid with its flow and write the control to the blower
+
+        sample_time is the clock's monotonic time when the sample was requested, None = now
+        """
+
+        self.__share(ftp)
+        self.__update_pid(ftp[0], sample_time if sample_time is not None else self.__clock.monotonic())
+
+    def __calibrate(self, ftp: typing.Tuple[float, float, float], sample_time: float = None) -> None:
+        """
+        Share the flow meter's sample and move the daq flow's calibration gain towards the flow meter's flow
+        """
+
+        self.__share(ftp)
+
+        flow, daq_flow = ftp[0], self.__daq_flow
+        if flow is None or daq_flow is None or daq_flow <= 0.0 or flow <= 0.0:
+            return  # Ratio is not defined, E.g. blower is stopped
+
+        now = self.__clock.monotonic()
+        if self.__calibration_time is not None:
+            dt = now - self.__calibration_time
+            weight = 1.0 - math.exp(-dt / float(self.__daq_flow_conf.get("calibration_t")))
+            self.calibration_gain += (flow / daq_flow - self.calibration_gain) * weight
+        self.__calibration_time = now
+
+    def __pid_step(self, flow: float, dt: float, hold_integral: bool) -> float:
+        """
+        Update the pid and return its output. Call with the pid lock
+
+        With hold_integral the integral term keeps its value. The pid is then updated with a zero integral gain, so it
+        adds nothing to the integral term but the output still has it
+        """
+
+        if not hold_integral:
+            return self.__pid(flow, dt)
+
+        ki = self.__pid.Ki
+        self.__pid.Ki = 0.0
+        try:
+            return self.__pid(flow, dt)
+        finally:
+            self.__pid.Ki = ki
+
+    def __update_pid(self, flow: typing.Optional[float], sample_time: float) -> None:
+        """
+        Update the pid with the flow and write the control to the blower
+
+        sample_time is the clock's monotonic time when the flow was measured. Pid's time steps are the times between the
+        samples, so a block of streamed samples that arrives at once still has the samples' time steps
+        """
+
+        with self.__pid_lock:
+            # Time step for the pid. Simple_pid would use the real time, which is wrong with an accelerated clock
+            now = self.__clock.monotonic()
+            dt = max(sample_time - self.__last_time, 1e-16)
 
             # Check that the flow can be read
             if flow is None:
                 self.__pid.auto_mode = False  # Do not try to update the control value
                 control = 0.0
                 logging.warning("Flow is None, pid control is  temporarily disabled")
-            elif flow is not None:
-                # Compute new output from the PID according to the systems current flow
-                self.__pid.auto_mode = True
-                control = self.__pid(flow)
+            else:
+                # Compute new output from the PID according to the systems current flow. After a failed read the pid
+                # continues from its latest duty cycle
+                if not self.__pid.auto_mode:
+                    self.__pid.set_auto_mode(True, last_output=self.__control_value)
+                # Integral term is not updated while the output is saturated and the error would push it further, so
+                # a large flow change does not wind it up. After a feed-forward jump it is held until the flow is near
+                # the target, so it does not overshoot the feed-forward
+                error = self.__pid.setpoint - flow
+                low, high = self.__pid.output_limits
+                hold_integral = self.__control_value is not None and \
+                    (self.__control_value <= low and error < 0 or self.__control_value >= high and error > 0)
+                if self.__integral_hold_until is not None:
+                    if abs(error) <= float(self.__feed_forward_conf.get("integral_band")) or \
+                            now >= self.__integral_hold_until:
+                        self.__integral_hold_until = None
+                    else:
+                        hold_integral = True
+                control = self.__pid_step(flow, dt, hold_integral)
+                self.__control_value = control
+                self.__learn_feed_forward(flow, now)
+                if dt >= self.__pid.sample_time:
+                    self.__last_time = sample_time  # Pid was updated
 
                 # Ensure that NI DAQ counter writer can handle the control value
                 if control > 999.995000e-3:
@@ -116,15 +408,82 @@ class BlowerPidThread(Thread):
                     control = 5.0e-6
                     logging.debug("Pid control value is under 0.05!")
 
-            # Write pulse according to pid control and frequency
-            # Timeout is set to default 10 -> 10s time to write the pulse
-            self.__daq_lock.acquire()
-            try:
-                self.__daq.cw_writer.write_one_sample_pulse_frequency(
-                    self.__frequency, control)
-            except nidaqmx.DaqError as e:
-                logging.error(e)
-                logging.debug("Tried to use counter writer too often!")
-            self.__daq_lock.release()
+            self.__write_control(control, sample_time)
+
+    def __read_flow_meter(self, handler: typing.Callable[[typing.Tuple[float, float, float], float], None]) -> None:
+        """
+        Read the flow meter until the thread is stopped and give the samples and their times to the handler
+
+        Polled flow meter is read at the deadlines of Pid:Timing control_rate. In the flow meter's streaming mode the
+        handler gets every sample of a block with its timestamp as soon as it is read
+        """
+
+        self.__scheduler.start()
+
+        # Run until self.stop is set to True
+        while not self.stop:
+            # Ensures that flow meter's data is not tried to read at the same time that serial settings are changed
+            self.__fw_lock.acquire()
+            if self.__flow_meter.streaming():
+                block = self.__flow_meter.read_ftp_stream(handler)  # Measure a block of samples
+                self.__fw_lock.release()
+                if len(block) == 0:
+                    handler((None, None, None))  # Like a failed read_ftp
+                continue
+
+            sample_time = self.__clock.monotonic()
+            ftp = self.__flow_meter.read_ftp()  # Measure flow, temperature and pressure
+            self.__fw_lock.release()
+            self.__stats.add("read_ftp", self.__clock.monotonic() - sample_time)
+            handler(ftp, sample_time)
+            self.__scheduler.wait()
+
+    def __daq_control_loop(self) -> None:
+        """
+        Update the pid with the daq's calibrated flow at the deadlines of Pid:Daq_flow control_rate until the thread is
+        stopped. Cycles without a new ai value from the daq thread are skipped
+
+        Control latency is measured from the start of the ai block, so it includes the block's acquisition time
+        """
+
+        f_chan = int(self.__daq_scaling_conf.get("f_chan"))
+        seq = self.__daq_ai.seq
+        self.__daq_scheduler.start()
+
+        while not self.stop:
+            sample = self.__daq_ai.read()
+            if sample.seq > seq:
+                seq = sample.seq
+                if sample.value is None:  # Daq read failed
+                    self.__daq_flow = None
+                    self.__update_pid(None, sample.timestamp)
+                else:
+                    self.__daq_flow = self.__daq.scale_value("f", sample.value[f_chan])
+                    self.__update_pid(self.calibration_gain * self.__daq_flow, sample.timestamp)
+            self.__daq_scheduler.wait()
+
+    def run(self):
+        """
+        Measure flow, temperature and pressure from the flow meter. Only flow is used for controlling the blower.
+        Update pid control and control blower with pid.
+
+        With the daq flow feedback the pid is updated from the daq's flow channel and the flow meter is read in the
+        calibration thread
+        """
+
+        logging.info("Started measuring flow meter values and controlling blower with pid")
+        self.__last_time = self.__clock.monotonic()
+
+        if self.__daq_feedback:
+            calibration_thread = Thread(target=self.__read_flow_meter, args=(self.__calibrate,),
+                                        name="FlowMeterCalibration")
+            calibration_thread.start()
+            self.__daq_control_loop()
+            calibration_thread.join()
+        else:
+            self.__read_flow_meter(self.__control)
+
+        if self.__feed_forward is not None:
+            self.__feed_forward.save()
 
         logging.info("Ended BlowerPidThread")
@@ -0,0 +1,110 @@
+"""
+Statistics of latencies, E.g. how long serial commands take to be answered
+"""
+
+import collections
+import logging
+import typing
+from threading import Lock
+
+import numpy
+
+
+class LatencyStats:
+    """
+    Keeps the latest latencies of named operations and summarizes them
+
+    Summary of an operation is logged every log_interval latencies, 0 = never
+    """
+
+    def __init__(self, name: str, size: int = 1000, log_interval: int = 100) -> None:
+        self.__name = name
+        self.__size = size
+        self.__log_interval = log_interval
+        self.__latencies = {}  # Operation -> deque of the latest latencies (s)
+        self.__counts = {}  # Operation -> number of latencies added
+        self.__lock = Lock()  # Operations can be timed from several threads
+
+    def add(self, operation: str, latency: float) -> None:
+        """
+        Add latency (s) of the operation
+        """
+
+        with self.__lock:
+            self.__latencies.setdefault(operation, collections.deque(maxlen=self.__size)).append(latency)
+            self.__counts[operation] = self.__counts.get(operation, 0) + 1
+            count = self.__counts[operation]
+
+        if self.__log_interval > 0 and count % self.__log_interval == 0:
+            logging.info(self.summary_str(operation))
+
+    def summary(self, operation: str) -> typing.Dict[str, float]:
+        """
+        Return count, mean, median, 95th percentile and max latency (s) of the operation's latest latencies
+        """
+
+        with self.__lock:
+            latencies = numpy.array(self.__latencies.get(operation, ()))
+            count = self.__counts.get(operation, 0)
+
+        if len(latencies) == 0:
+            return {"count": count, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+
+        return {"count": count, "mean": float(latencies.mean()), "p50": float(numpy.percentile(latencies, 50)),
+                "p95": float(numpy.percentile(latencies, 95)), "max": float(latencies.max())}
+
+    def summary_str(self, operation: str) -> str:
+        """
+        Return the operation's summary as a string in milliseconds
+        """
+
+        s = self.summary(operation)
+        return (f"{self.__name} {operation}: n={s['count']} mean={s['mean'] * 1e3:.1f} ms p50={s['p50'] * 1e3:.1f} ms "
+                f"p95={s['p95'] * 1e3:.1f} ms max={s['max'] * 1e3:.1f} ms")
+
+    def operations(self) -> typing.List[str]:
+        """
+        Return names of the timed operations
+        """
+
+        with self.__lock:
+            return list(self.__latencies)
+
+    def log_summary(self) -> None:
+        """
+        Log summaries of all the operations
+        """
+
+        for operation in self.operations():
+            logging.info(self.summary_str(operation))
+
+
+class Histogram:
+    """
+    Counts of values in bins. Bin i holds the values edges[i - 1] <= value < edges[i], the first and the last bin hold
+    the values below and above the edges
+    """
+
+    def __init__(self, name: str, edges: typing.Sequence[float]) -> None:
+        self.__name = name
+        self.__edges = numpy.asarray(edges, dtype=float)
+        self.__counts = numpy.zeros(len(edges) + 1, dtype=numpy.int64)
+        self.__lock = Lock()
+
+    def add(self, value: float) -> None:
+        with self.__lock:
+            self.__counts[numpy.searchsorted(self.__edges, value, side="right")] += 1
+
+    def counts(self) -> typing.List[int]:
+        with self.__lock:
+            return self.__counts.tolist()
+
+    def summary_str(self) -> str:
+        """
+        Return the counts as a string with the bins in milliseconds
+        """
+
+        edges_ms = [f"{edge * 1e3:g}" for edge in self.__edges]
+        labels = [f"<{edges_ms[0]}"] + [f"{a}-{b}" for a, b in zip(edges_ms, edges_ms[1:])] + [f">={edges_ms[-1]}"]
+        bins = " ".join(f"{label}:{count}" for label, count in zip(labels, self.counts()))
+        return f"{self.__name} (ms): {bins}"